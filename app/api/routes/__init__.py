@@ -4,4 +4,5 @@ from .receipts import router as receipts_router
 from .categories import router as categories_router
 from .imap_settings import router as imap_settings_router
 from .analytics import router as analytics_router
-from .budgets import router as budget_router  # ตรวจสอบให้แน่ใจว่ามีบรรทัดนี้
\ No newline at end of file
+from .budgets import router as budget_router  # ตรวจสอบให้แน่ใจว่ามีบรรทัดนี้
+from .sync_jobs import router as sync_jobs_router
\ No newline at end of file
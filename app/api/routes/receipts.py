@@ -1,4 +1,6 @@
 ﻿from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import FileResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, date
@@ -7,6 +9,9 @@ from ...models.user import User
 from ...models.receipt import Receipt
 from ...schemas.receipt import ReceiptCreate, ReceiptUpdate, ReceiptResponse
 from ...services.auth_service import get_current_user
+from ...services.attachment_store import attachment_store
+from ...services.backfill import BACKFILL_FIELDS
+from ...services.sync_job_service import enqueue_backfill_job
 
 router = APIRouter(prefix="/receipts", tags=["receipts"])
 
@@ -30,12 +35,19 @@ def create_receipt(
         currency=receipt.currency,
         receipt_number=receipt.receipt_number,
         payment_method=receipt.payment_method,
-        notes=receipt.notes,
-        receipt_file_path=receipt.receipt_file_path
+        notes=receipt.notes
     )
     
     db.add(db_receipt)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # email_id ต้องไม่ซ้ำกันในใบเสร็จของผู้ใช้คนเดียวกัน (uq_receipts_user_email)
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="มีใบเสร็จที่ใช้ email_id นี้อยู่แล้ว"
+        )
     db.refresh(db_receipt)
     
     return db_receipt
@@ -81,6 +93,22 @@ def get_receipts(
     receipts = query.offset(skip).limit(limit).all()
     return receipts
 
+@router.post("/backfill", status_code=status.HTTP_202_ACCEPTED)
+def backfill_user_receipts(
+    dry_run: bool = False,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """เพิ่มงานแยกข้อมูลใบเสร็จทั้งหมดของผู้ใช้ใหม่จากอีเมลในแคชเข้าคิว (worker จะเป็นผู้ทำ)
+    ดูความคืบหน้าและสรุปการเปลี่ยนแปลงได้ที่ /sync-jobs/{job_id}"""
+    job = enqueue_backfill_job(db, current_user.id, dry_run)
+    
+    return {
+        "status": "accepted",
+        "message": "เพิ่มงานแยกข้อมูลใบเสร็จใหม่เข้าคิวแล้ว",
+        "job_id": job.id
+    }
+
 @router.get("/{receipt_id}", response_model=ReceiptResponse)
 def get_receipt(
     receipt_id: int,
@@ -101,6 +129,37 @@ def get_receipt(
     
     return receipt
 
+@router.get("/{receipt_id}/attachment")
+def download_receipt_attachment(
+    receipt_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """ดาวน์โหลดไฟล์แนบของใบเสร็จแบบสตรีม"""
+    receipt = db.query(Receipt).filter(
+        Receipt.id == receipt_id,
+        Receipt.user_id == current_user.id
+    ).first()
+    
+    if not receipt:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="ไม่พบใบเสร็จ"
+        )
+    
+    file_path = attachment_store.absolute_path(receipt.receipt_file_path)
+    if not file_path:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="ไม่พบไฟล์แนบ"
+        )
+    
+    return FileResponse(
+        file_path,
+        media_type=receipt.receipt_file_type or "application/octet-stream",
+        filename=receipt.receipt_file_name or receipt.receipt_file_path.split("/")[-1]
+    )
+
 @router.put("/{receipt_id}", response_model=ReceiptResponse)
 def update_receipt(
     receipt_id: int,
@@ -125,6 +184,10 @@ def update_receipt(
     for key, value in update_data.items():
         setattr(db_receipt, key, value)
     
+    # ข้อมูลที่ผู้ใช้แก้เองจะไม่ถูกเขียนทับเมื่อแยกข้อมูลจากอีเมลใหม่
+    if update_data.keys() & set(BACKFILL_FIELDS + ("category_id",)):
+        db_receipt.user_edited = True
+    
     db.commit()
     db.refresh(db_receipt)
     
@@ -0,0 +1,29 @@
+﻿from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from ...database import get_db
+from ...models.user import User
+from ...models.sync_job import SyncJob
+from ...schemas.sync_job import SyncJobResponse
+from ...services.auth_service import get_current_user
+
+router = APIRouter(prefix="/sync-jobs", tags=["sync-jobs"])
+
+@router.get("/{job_id}", response_model=SyncJobResponse)
+def get_sync_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """ดึงสถานะและความคืบหน้าของงานซิงค์"""
+    job = db.query(SyncJob).filter(
+        SyncJob.id == job_id,
+        SyncJob.user_id == current_user.id
+    ).first()
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="ไม่พบงานซิงค์"
+        )
+    
+    return job
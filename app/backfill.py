@@ -0,0 +1,36 @@
+﻿import argparse
+import json
+
+from .database import SessionLocal
+from . import models  # noqa: F401 โหลด model ทั้งหมดก่อนใช้งาน
+from .services.backfill import backfill_receipts
+
+
+def main():
+    """แยกข้อมูลใบเสร็จที่บันทึกไว้ใหม่จากอีเมลในแคช: python -m app.backfill --user-id 1 หรือ --all"""
+    parser = argparse.ArgumentParser(description="แยกข้อมูลใบเสร็จใหม่จากอีเมลในแคช")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--user-id", type=int, help="ทำเฉพาะใบเสร็จของผู้ใช้คนนี้")
+    target.add_argument("--all", action="store_true", help="ทำกับใบเสร็จของผู้ใช้ทุกคน")
+    parser.add_argument("--chunk-size", type=int, default=None, help="จำนวนใบเสร็จต่อหนึ่งชุด")
+    parser.add_argument("--workers", type=int, default=None, help="จำนวน process สำหรับแยกข้อมูล (0 = ไม่ใช้ process pool)")
+    parser.add_argument("--dry-run", action="store_true", help="แสดงผลการเปลี่ยนแปลงโดยไม่บันทึก")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        summary = backfill_receipts(
+            db,
+            user_id=None if args.all else args.user_id,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            dry_run=args.dry_run
+        )
+    finally:
+        db.close()
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,44 @@ class Settings(BaseSettings):
     ENCRYPTION_KEY: str
     CORS_ORIGINS: list[str] = ["http://localhost:3000"]
     API_V1_PREFIX: str = "/api/v1"
+    IMAP_FETCH_BATCH_SIZE: int = 50
+    IMAP_TIMEOUT: float = 60.0
+    IMAP_MAX_CONNECTIONS_PER_SYNC: int = 4
+    SYNC_SHARD_SIZE: int = 1000
+    IMAP_COMPRESS: bool = True
+    IMAP_COMPRESS_LEVEL: int = 6
+    IMAP_CREDENTIAL_TTL: float = 300.0
+    IMAP_POOL_IDLE_TIMEOUT: float = 300.0
+    IMAP_POOL_MAX_LIFETIME: float = 1800.0
+    IMAP_POOL_MAX_IDLE_PER_SETTING: int = 4
+    IMAP_POOL_MAX_IDLE: int = 50
+    ATTACHMENT_STORE_DIR: str = "storage/attachments"
+    ATTACHMENT_CHUNK_SIZE: int = 65536
+    MESSAGE_CACHE_DIR: str = "storage/messages"
+    MESSAGE_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    MESSAGE_CACHE_EVICT_INTERVAL: float = 3600.0
+    SYNC_QUEUE_SIZE: int = 100
+    SYNC_WRITE_BATCH_SIZE: int = 50
+    SYNC_EXTRACT_WORKERS: int = 2
+    SYNC_PROCESS_POOL_MIN: int = 50
+    SYNC_PROGRESS_INTERVAL: float = 2.0
+    SYNC_JOB_MAX_ATTEMPTS: int = 3
+    SYNC_JOB_RETRY_DELAY: int = 60
+    SYNC_JOB_LOCK_TIMEOUT: int = 3600
+    SYNC_WORKER_POLL_INTERVAL: float = 5.0
+    SYNC_SCHEDULE_INTERVAL: float = 60.0
+    SYNC_SCHEDULE_BATCH_SIZE: int = 500
+    SYNC_SCHEDULE_MAX_EMAILS: int = 200
+    SYNC_MIN_INTERVAL: int = 300
+    SYNC_MAX_INTERVAL: int = 6 * 3600
+    IMAP_MAX_SYNCS_PER_HOST: int = 5
+    VENDOR_TEMPLATE_DIR: str = os.path.join(os.path.dirname(__file__), "vendor_templates")
+    VENDOR_TEMPLATE_RELOAD_INTERVAL: float = 5.0
+    BACKFILL_CHUNK_SIZE: int = 1000
+    IMAP_IDLE_TIMEOUT: float = 25 * 60
+    IMAP_NOOP_INTERVAL: float = 60.0
+    IDLE_RELOAD_INTERVAL: float = 60.0
+    IDLE_RECONNECT_MAX_DELAY: float = 300.0
 
     model_config = SettingsConfigDict(
         env_file=os.path.join(os.path.dirname(__file__), ".env")
@@ -0,0 +1,33 @@
+﻿import asyncio
+import logging
+import signal
+
+from .database import Base, engine
+from . import models  # noqa: F401 โหลด model ทั้งหมดก่อนใช้งาน
+from .services.idle_listener import run_idle_listeners
+
+# ตั้งค่า logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def _run():
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    logger.info("เริ่มรอแจ้งเตือนอีเมลใหม่ด้วย IMAP IDLE")
+    await run_idle_listeners(stop_event)
+    logger.info("หยุดรอแจ้งเตือนอีเมลใหม่")
+
+
+def main():
+    """ตัวรอแจ้งเตือนอีเมลใหม่ของบัญชีที่เปิด idle_enabled: python -m app.idle_listener"""
+    # สร้างตารางในฐานข้อมูล (กรณีเริ่มก่อน API)
+    Base.metadata.create_all(bind=engine)
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ from .config import settings
 from .models import User, Category, Receipt
 from .services.init_data import create_initial_categories
 from .database import SessionLocal
-from .api.routes import auth_router, users_router, receipts_router, categories_router, imap_settings_router, analytics_router, budget_router
+from .api.routes import auth_router, users_router, receipts_router, categories_router, imap_settings_router, analytics_router, budget_router, sync_jobs_router
 from .services.init_data import create_initial_categories
 from .services.init_data import update_categories
 from .database import SessionLocal
@@ -45,6 +45,7 @@ app.include_router(categories_router, prefix=settings.API_V1_PREFIX)
 app.include_router(imap_settings_router, prefix=settings.API_V1_PREFIX)
 app.include_router(analytics_router, prefix=settings.API_V1_PREFIX)
 app.include_router(budget_router, prefix=settings.API_V1_PREFIX)  # ตรวจสอบให้มีแค่บรรทัดนี้
+app.include_router(sync_jobs_router, prefix=settings.API_V1_PREFIX)
 
 @app.get("/")
 def read_root():
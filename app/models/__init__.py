@@ -2,4 +2,6 @@
 from .category import Category
 from .receipt import Receipt
 from .imap_setting import ImapSetting
-from .budget import Budget  # เพิ่มบรรทัดนี้
\ No newline at end of file
+from .budget import Budget  # เพิ่มบรรทัดนี้
+from .sync_job import SyncJob
+from .imap_folder_state import ImapFolderState
\ No newline at end of file
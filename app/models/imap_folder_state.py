@@ -0,0 +1,24 @@
+﻿from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy.sql import func
+from sqlalchemy.orm import relationship
+from ..database import Base
+
+class ImapFolderState(Base):
+    __tablename__ = "imap_folder_states"
+    __table_args__ = (
+        # แต่ละโฟลเดอร์ของบัญชีมีสถานะการซิงค์เพียงรายการเดียว
+        UniqueConstraint("imap_setting_id", "folder", name="uq_imap_folder_states_setting_folder"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    imap_setting_id = Column(Integer, ForeignKey("imap_settings.id", ondelete="CASCADE"), index=True, nullable=False)
+    folder = Column(String(255), nullable=False)
+    
+    # สถานะการซิงค์แบบ incremental ของโฟลเดอร์นี้ (เหมือนกับของโฟลเดอร์หลักใน ImapSetting)
+    uid_validity = Column(BigInteger, nullable=True)
+    last_uid = Column(BigInteger, default=0, nullable=False)
+    highest_modseq = Column(BigInteger, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    
+    # ความสัมพันธ์
+    imap_setting = relationship("ImapSetting", back_populates="folder_states")
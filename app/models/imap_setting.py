@@ -1,4 +1,4 @@
-﻿from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+﻿from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from ..database import Base
@@ -16,7 +16,33 @@ class ImapSetting(Base):
     use_ssl = Column(Boolean, default=True)
     folder = Column(String(50), default="INBOX")
     last_sync = Column(DateTime, nullable=True)
+    
+    # สถานะการซิงค์แบบ incremental (UIDVALIDITY ของโฟลเดอร์และ UID ล่าสุดที่ประมวลผลแล้ว)
+    uid_validity = Column(BigInteger, nullable=True)
+    last_uid = Column(BigInteger, default=0, nullable=False)
+    # HIGHESTMODSEQ ล่าสุดของโฟลเดอร์ (CONDSTORE/QRESYNC) ใช้ตรวจอีเมลที่ถูกลบโดยไม่ต้องไล่ทั้งโฟลเดอร์
+    highest_modseq = Column(BigInteger, nullable=True)
+    
+    # การซิงค์อัตโนมัติ (ช่วงเวลาปรับตามจำนวนอีเมลใหม่ที่พบ)
+    auto_sync = Column(Boolean, default=True, nullable=False)
+    sync_interval = Column(Integer, nullable=True)
+    next_sync_at = Column(DateTime, index=True, nullable=True)
+    
+    # รับแจ้งเตือนอีเมลใหม่ทันทีผ่าน IMAP IDLE (ทำงานใน process app.idle_listener)
+    idle_enabled = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=func.now())
     
     # ความสัมพันธ์
-    user = relationship("User", back_populates="imap_settings")
\ No newline at end of file
+    user = relationship("User", back_populates="imap_settings")
+    # โฟลเดอร์เพิ่มเติมที่ซิงค์นอกจากโฟลเดอร์หลัก (เช่น [Gmail]/All Mail หรือ label ของ Gmail)
+    folder_states = relationship(
+        "ImapFolderState",
+        back_populates="imap_setting",
+        cascade="all, delete-orphan",
+        order_by="ImapFolderState.id"
+    )
+    
+    @property
+    def additional_folders(self):
+        """ชื่อโฟลเดอร์เพิ่มเติมทั้งหมดของบัญชีนี้"""
+        return [folder_state.folder for folder_state in self.folder_states]
\ No newline at end of file
@@ -1,14 +1,28 @@
-﻿from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Text
+﻿from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, Boolean, ForeignKey, Text, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from ..database import Base
 
 class Receipt(Base):
     __tablename__ = "receipts"
+    __table_args__ = (
+        # ใบเสร็จจากอีเมลเดียวกันของผู้ใช้คนเดียวกันต้องมีเพียงรายการเดียว
+        UniqueConstraint("user_id", "email_id", name="uq_receipts_user_email"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     email_id = Column(String(255), index=True, nullable=True)
+    message_id = Column(String(255), index=True, nullable=True)
+    content_hash = Column(String(64), index=True, nullable=True)
+    # ตำแหน่งอีเมลต้นฉบับบนเซิร์ฟเวอร์ (ใช้อ่านอีเมลจากแคชเมื่อแยกข้อมูลใหม่)
+    imap_setting_id = Column(Integer, ForeignKey("imap_settings.id", ondelete="SET NULL"), index=True, nullable=True)
+    # โฟลเดอร์เพิ่มเติมที่อีเมลอยู่ (NULL คือโฟลเดอร์หลักของการตั้งค่า IMAP)
+    imap_folder = Column(String(255), nullable=True)
+    imap_uidvalidity = Column(BigInteger, nullable=True)
+    imap_uid = Column(BigInteger, nullable=True)
+    # อีเมลต้นฉบับถูกลบหรือย้ายออกจากโฟลเดอร์แล้ว
+    source_deleted = Column(Boolean, default=False, nullable=False)
     email_subject = Column(String(255), nullable=True)
     email_from = Column(String(100), index=True, nullable=True)
     email_date = Column(DateTime, nullable=True)
@@ -21,6 +35,10 @@ class Receipt(Base):
     payment_method = Column(String(50), nullable=True)
     notes = Column(Text, nullable=True)
     receipt_file_path = Column(String(255), nullable=True)
+    receipt_file_name = Column(String(255), nullable=True)
+    receipt_file_type = Column(String(100), nullable=True)
+    # ผู้ใช้แก้ไขข้อมูลที่แยกจากอีเมลเอง (การแยกข้อมูลใหม่จะไม่เขียนทับ)
+    user_edited = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=func.now())
     
     # ความสัมพันธ์กับตารางอื่น
@@ -0,0 +1,49 @@
+﻿from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Text, JSON
+from sqlalchemy.sql import func
+from ..database import Base
+
+class SyncJob(Base):
+    __tablename__ = "sync_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # งานแยกข้อมูลใบเสร็จใหม่ (backfill) ทำกับใบเสร็จทั้งหมดของผู้ใช้ จึงไม่มีการตั้งค่า IMAP
+    imap_setting_id = Column(Integer, ForeignKey("imap_settings.id", ondelete="CASCADE"), index=True, nullable=True)
+    # ชนิดงาน: sync, backfill
+    kind = Column(String(20), default="sync", nullable=False)
+    
+    # สถานะ: pending, running, completed, failed
+    status = Column(String(20), index=True, default="pending", nullable=False)
+    days_back = Column(Integer, default=30, nullable=False)
+    max_emails = Column(Integer, default=50, nullable=False)
+    full_resync = Column(Boolean, default=False, nullable=False)
+    dry_run = Column(Boolean, default=False, nullable=False)
+    # มีคำขอซิงค์เข้ามาระหว่างที่งานนี้กำลังทำ จะเพิ่มงานซิงค์ใหม่เมื่องานนี้เสร็จ
+    # ตามค่าที่คำขอเหล่านั้นระบุ (รวมแล้ว)
+    rerun_requested = Column(Boolean, default=False, nullable=False)
+    rerun_days_back = Column(Integer, nullable=True)
+    rerun_max_emails = Column(Integer, nullable=True)
+    rerun_full_resync = Column(Boolean, default=False, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    # งานที่ผู้ใช้สั่งเองมีลำดับความสำคัญสูงกว่างานจากตัวตั้งเวลา
+    priority = Column(Integer, default=0, nullable=False)
+    # งานที่ล้มเหลวจะลองใหม่ได้หลังเวลานี้
+    run_after = Column(DateTime, nullable=True)
+    
+    # ความคืบหน้า และ UID ล่าสุดที่บันทึกสำเร็จ (ใช้ทำงานต่อเมื่อลองใหม่)
+    total = Column(Integer, default=0, nullable=False)
+    processed = Column(Integer, default=0, nullable=False)
+    receipts_created = Column(Integer, default=0, nullable=False)
+    checkpoint_uid = Column(BigInteger, nullable=True)
+    error = Column(Text, nullable=True)
+    # สรุปผลของงาน backfill
+    result = Column(JSON, nullable=True)
+    
+    # worker ที่กำลังทำงานนี้อยู่
+    locked_by = Column(String(100), nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
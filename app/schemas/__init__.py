@@ -2,5 +2,6 @@
 from .token import Token, TokenData
 from .category import CategoryCreate, CategoryUpdate, CategoryResponse
 from .receipt import ReceiptCreate, ReceiptUpdate, ReceiptResponse
-from .imap_setting import ImapSettingCreate, ImapSettingUpdate, ImapSettingResponse
-from .budget import BudgetCreate, BudgetUpdate, BudgetResponse, BudgetWithSpentResponse
\ No newline at end of file
+from .imap_setting import ImapSettingCreate, ImapSettingUpdate, ImapFoldersUpdate, ImapSettingResponse
+from .budget import BudgetCreate, BudgetUpdate, BudgetResponse, BudgetWithSpentResponse
+from .sync_job import SyncJobResponse
\ No newline at end of file
@@ -1,5 +1,5 @@
 ﻿from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import Optional, List
 from datetime import datetime
 
 class ImapSettingBase(BaseModel):
@@ -9,6 +9,9 @@ class ImapSettingBase(BaseModel):
     username: str
     use_ssl: bool = True
     folder: str = "INBOX"
+    auto_sync: bool = True
+    idle_enabled: bool = False
+    additional_folders: List[str] = []
 
 class ImapSettingCreate(ImapSettingBase):
     password: str
@@ -22,10 +25,18 @@ class ImapSettingUpdate(BaseModel):
     use_ssl: Optional[bool] = None
     folder: Optional[str] = None
 
+class ImapFoldersUpdate(BaseModel):
+    additional_folders: List[str]
+
 class ImapSettingResponse(ImapSettingBase):
     id: int
     user_id: int
     last_sync: Optional[datetime] = None
+    uid_validity: Optional[int] = None
+    last_uid: int = 0
+    highest_modseq: Optional[int] = None
+    sync_interval: Optional[int] = None
+    next_sync_at: Optional[datetime] = None
     created_at: datetime
     
     model_config = {"from_attributes": True}
\ No newline at end of file
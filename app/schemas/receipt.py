@@ -17,7 +17,6 @@ class ReceiptBase(BaseModel):
 
 class ReceiptCreate(ReceiptBase):
     email_id: Optional[str] = None
-    receipt_file_path: Optional[str] = None
 
 class ReceiptUpdate(BaseModel):
     email_subject: Optional[str] = None
@@ -31,13 +30,17 @@ class ReceiptUpdate(BaseModel):
     receipt_number: Optional[str] = None
     payment_method: Optional[str] = None
     notes: Optional[str] = None
-    receipt_file_path: Optional[str] = None
 
 class ReceiptResponse(ReceiptBase):
     id: int
     user_id: int
     email_id: Optional[str] = None
+    message_id: Optional[str] = None
+    source_deleted: bool = False
+    user_edited: bool = False
     receipt_file_path: Optional[str] = None
+    receipt_file_name: Optional[str] = None
+    receipt_file_type: Optional[str] = None
     created_at: datetime
     
     model_config = {"from_attributes": True}
\ No newline at end of file
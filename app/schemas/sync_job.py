@@ -0,0 +1,23 @@
+﻿from pydantic import BaseModel
+from typing import Optional, Dict, Any
+from datetime import datetime
+
+class SyncJobResponse(BaseModel):
+    id: int
+    imap_setting_id: Optional[int] = None
+    kind: str = "sync"
+    status: str
+    days_back: int
+    max_emails: int
+    full_resync: bool
+    attempts: int
+    total: int
+    processed: int
+    receipts_created: int
+    error: Optional[str] = None
+    result: Optional[Dict[str, Any]] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    created_at: datetime
+    
+    model_config = {"from_attributes": True}
@@ -0,0 +1,372 @@
+﻿import asyncio
+import logging
+import re
+import ssl
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+
+from ..config import settings
+from ..models.imap_setting import ImapSetting
+from ..services.encryption_service import decrypt_password_cached
+from .imap_compression import wrap_deflate_streams
+from .imap_service import (
+    HEADER_FETCH_ITEMS,
+    build_email_data,
+    build_search_query,
+    compress_uid_set,
+    parse_esearch_response,
+    parse_fetch_response,
+    parse_header_data,
+    plan_text_fetches,
+    select_search_results
+)
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# บรรทัดที่ลงท้ายด้วย literal {n} (ข้อมูล n ไบต์ตามมาในบรรทัดถัดไป)
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r?\n?$")
+
+# คำตอบแบบ untagged เช่น "* 12 FETCH (...)" หรือ "* SEARCH 1 2 3"
+_UNTAGGED_RE = re.compile(rb"\* (?:(\d+) )?([A-Z-]+)(?: (.*))?$", re.DOTALL)
+
+# response code ในคำตอบ เช่น "* OK [UIDVALIDITY 3857529045] UIDs valid"
+_RESPONSE_CODE_RE = re.compile(rb"\[([A-Z-]+)(?: ([^\]]*))?\]")
+
+# ความยาวสูงสุดของหนึ่งบรรทัด (ผลการค้นหาแบบไม่มี ESEARCH อาจยาวมาก)
+_MAX_LINE_BYTES = 8 * 1024 * 1024
+
+
+def _quote(value: str) -> bytes:
+    """ใส่เครื่องหมายคำพูดให้ค่าที่ส่งในคำสั่ง IMAP"""
+    return b'"' + value.replace("\\", "\\\\").replace('"', '\\"').encode("utf-8") + b'"'
+
+
+class AsyncIMAPClient:
+    """IMAP client แบบ asyncio ที่มีเมธอดเหมือน IMAPClient (connect, search, fetch แบบเป็นชุด, disconnect)
+    การเชื่อมต่อหนึ่งตัวไม่ใช้ thread ของตัวเอง จึงรอแจ้งเตือนหลายบัญชีพร้อมกันใน process เดียวได้
+    ปัจจุบันใช้เฉพาะใน IdleListener ส่วนการซิงค์ใน worker ยังใช้ IMAPClient"""
+
+    def __init__(self, imap_setting: ImapSetting, timeout: float = None):
+        self.imap_setting = imap_setting
+        self.timeout = timeout or settings.IMAP_TIMEOUT
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.capabilities = ()
+        self.uid_validity = None
+        self.exists = 0
+        self.compression_enabled = False
+        self._tag_counter = 0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if not await self.connect():
+            raise ConnectionError(f"ไม่สามารถเชื่อมต่อกับ IMAP ID: {self.imap_setting.id}")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self) -> bool:
+        """เชื่อมต่อและล็อกอินเข้าสู่เซิร์ฟเวอร์ IMAP"""
+        try:
+            # ถอดรหัสรหัสผ่าน
+            decrypted_password = decrypt_password_cached(self.imap_setting.password_encrypted)
+
+            ssl_context = ssl.create_default_context() if self.imap_setting.use_ssl else None
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.imap_setting.server,
+                    self.imap_setting.port,
+                    ssl=ssl_context,
+                    limit=_MAX_LINE_BYTES
+                ),
+                self.timeout
+            )
+
+            # ข้อความต้อนรับจากเซิร์ฟเวอร์
+            greeting = await self._read_response()
+            if not greeting or not self._head(greeting).startswith(b"* OK"):
+                raise ConnectionError(f"เซิร์ฟเวอร์ตอบกลับไม่ถูกต้อง: {greeting!r}")
+
+            status, _ = await self._command(b"LOGIN", _quote(self.imap_setting.username), _quote(decrypted_password))
+            if status != "OK":
+                raise ConnectionError("ล็อกอินไม่สำเร็จ")
+            logger.info(f"เชื่อมต่อกับ IMAP สำเร็จ: {self.imap_setting.email}")
+
+            # เซิร์ฟเวอร์บางรายแจ้งความสามารถเพิ่มเติมหลังล็อกอิน
+            status, untagged = await self._command(b"CAPABILITY")
+            if status == "OK" and untagged.get("CAPABILITY"):
+                self.capabilities = tuple(untagged["CAPABILITY"][0].decode().upper().split())
+
+            # บีบอัดข้อมูลที่รับส่ง (RFC 4978) เหมือน IMAPClient
+            if settings.IMAP_COMPRESS and self.has_capability("COMPRESS=DEFLATE"):
+                status, _ = await self._command(b"COMPRESS", b"DEFLATE")
+                if status == "OK":
+                    self.reader, self.writer = wrap_deflate_streams(
+                        self.reader, self.writer, _MAX_LINE_BYTES, settings.IMAP_COMPRESS_LEVEL
+                    )
+                    self.compression_enabled = True
+            return True
+
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการเชื่อมต่อกับ IMAP: {str(e)}")
+            await self._close()
+            return False
+
+    async def disconnect(self):
+        """ยกเลิกการเชื่อมต่อ"""
+        if self.writer:
+            try:
+                await self._command(b"LOGOUT")
+            except Exception:
+                pass
+            await self._close()
+
+    def has_capability(self, capability: str) -> bool:
+        """ตรวจสอบว่าเซิร์ฟเวอร์รองรับความสามารถที่ระบุหรือไม่"""
+        return bool(self.writer) and capability.upper() in self.capabilities
+
+    async def select_folder(self) -> Optional[int]:
+        """เลือกโฟลเดอร์และคืนค่า UIDVALIDITY ของโฟลเดอร์"""
+        status, untagged = await self._command(b"SELECT", _quote(self.imap_setting.folder or "INBOX"))
+        if status != "OK":
+            logger.error(f"ไม่สามารถเลือกโฟลเดอร์ {self.imap_setting.folder}: {status}")
+            return None
+
+        uid_validity = untagged.get("UIDVALIDITY")
+        if uid_validity and uid_validity[0]:
+            self.uid_validity = int(uid_validity[0])
+        self._has_new_mail(untagged)
+
+        return self.uid_validity
+
+    async def idle(self, timeout: float) -> bool:
+        """รอการแจ้งเตือนจากเซิร์ฟเวอร์ด้วย IDLE นานไม่เกิน timeout วินาที (RFC 2177)
+        คืนค่า True เมื่อมีอีเมลใหม่เข้ามาในโฟลเดอร์"""
+        async with self._lock:
+            try:
+                return await self._idle(timeout)
+            except asyncio.CancelledError:
+                # ถูกยกเลิกระหว่าง IDLE สถานะของการเชื่อมต่อไม่แน่นอนแล้ว จึงปิด socket ทันที
+                self.writer.close()
+                self.reader = None
+                self.writer = None
+                raise
+
+    async def _idle(self, timeout: float) -> bool:
+        """ส่ง IDLE แล้วรอ EXISTS จนหมดเวลา จากนั้นส่ง DONE (ต้องถือ lock อยู่แล้ว)"""
+        tag = self._next_tag()
+        self.writer.write(tag + b" IDLE\r\n")
+        await self.writer.drain()
+
+        # รอให้เซิร์ฟเวอร์ตอบรับ (+) ก่อนเริ่มรอ
+        while True:
+            response = await self._read_response()
+            if not response:
+                raise ConnectionError("เซิร์ฟเวอร์ปิดการเชื่อมต่อ")
+            head = self._head(response)
+            if head.startswith(b"+"):
+                break
+            if head.startswith(tag + b" "):
+                raise ConnectionError(f"เซิร์ฟเวอร์ไม่รับคำสั่ง IDLE: {head!r}")
+
+        new_mail = False
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not new_mail:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                response = await self._read_response(remaining)
+            except asyncio.TimeoutError:
+                break
+            if not response:
+                raise ConnectionError("เซิร์ฟเวอร์ปิดการเชื่อมต่อ")
+            new_mail = self._track_exists(self._head(response))
+
+        # จบ IDLE แล้วอ่านคำตอบที่เหลือจนถึงบรรทัดผลลัพธ์
+        self.writer.write(b"DONE\r\n")
+        await self.writer.drain()
+        while True:
+            response = await self._read_response()
+            if not response:
+                raise ConnectionError("เซิร์ฟเวอร์ปิดการเชื่อมต่อ")
+            head = self._head(response)
+            if head.startswith(tag + b" "):
+                return new_mail
+            new_mail = self._track_exists(head) or new_mail
+
+    async def noop(self) -> bool:
+        """ส่ง NOOP เพื่อรับการเปลี่ยนแปลงของโฟลเดอร์ (ใช้แทน IDLE) คืนค่า True เมื่อมีอีเมลใหม่"""
+        status, untagged = await self._command(b"NOOP")
+        if status != "OK":
+            raise ConnectionError(f"NOOP ไม่สำเร็จ: {status}")
+        return self._has_new_mail(untagged)
+
+    def _track_exists(self, head: bytes) -> bool:
+        """อัปเดตจำนวนอีเมลจากคำตอบ untagged หนึ่งบรรทัด (EXISTS หรือ EXPUNGE)"""
+        match = _UNTAGGED_RE.match(head)
+        if not match or not match.group(1):
+            return False
+        return self._has_new_mail({match.group(2).decode("ascii"): [match.group(1)]})
+
+    def _has_new_mail(self, untagged: Dict[str, list]) -> bool:
+        """อัปเดตจำนวนอีเมลในโฟลเดอร์จากคำตอบ EXPUNGE/EXISTS และตรวจว่าเพิ่มขึ้นหรือไม่"""
+        self.exists -= len(untagged.get("EXPUNGE") or [])
+        exists = untagged.get("EXISTS")
+        if not exists:
+            return False
+        count = int(exists[-1])
+        increased = count > self.exists
+        self.exists = count
+        return increased
+
+    async def search_emails(self, days: int = 30, limit: int = 50, search_criteria: str = None, since_uid: int = 0) -> List[int]:
+        """ค้นหา UID ของอีเมล ถ้าระบุ since_uid จะค้นหาเฉพาะอีเมลที่ใหม่กว่า UID นั้น"""
+        try:
+            # เลือกโฟลเดอร์
+            await self.select_folder()
+
+            combined_criteria = build_search_query(days, search_criteria, since_uid)
+            logger.info(f"ค้นหาอีเมลด้วยเงื่อนไข: {combined_criteria}")
+            if self.has_capability("ESEARCH"):
+                # ESEARCH คืนผลเป็นช่วง UID ที่กระชับกว่ารายการเต็ม
+                status, untagged = await self._command(b"UID SEARCH RETURN (ALL)", combined_criteria.encode("utf-8"))
+                all_message_ids = parse_esearch_response(untagged.get("ESEARCH")) if status == "OK" else []
+            else:
+                status, untagged = await self._command(b"UID SEARCH", combined_criteria.encode("utf-8"))
+                data = untagged.get("SEARCH") or [b""]
+                all_message_ids = b" ".join(data).split() if status == "OK" else []
+
+            return select_search_results(all_message_ids, since_uid, limit)
+
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการค้นหาอีเมล: {str(e)}")
+            return []
+
+    async def fetch_headers(self, message_ids: List[int], chunk_size: int = None) -> AsyncIterator[Dict[str, Any]]:
+        """ดึงเฉพาะ header ที่ใช้คัดกรองและขนาดของอีเมล โดยไม่ดาวน์โหลดเนื้อหา"""
+        chunk_size = chunk_size or settings.IMAP_FETCH_BATCH_SIZE
+        uids = sorted(set(int(uid) for uid in message_ids))
+
+        for start in range(0, len(uids), chunk_size):
+            for message in await self._fetch_items(uids[start:start + chunk_size], HEADER_FETCH_ITEMS):
+                header_data = parse_header_data(message)
+                if header_data:
+                    yield header_data
+
+    async def fetch_raw_text_parts(self, header_datas: List[Dict[str, Any]], chunk_size: int = None) -> AsyncIterator[tuple]:
+        """ดึงส่วนข้อความแบบยังไม่ถอดรหัส คืนค่า (header_data, ข้อมูลจาก FETCH)"""
+        for chunk, items in plan_text_fetches(header_datas, chunk_size):
+            for message in await self._fetch_items(chunk.keys(), items):
+                header_data = chunk.get(message["UID"])
+                if header_data:
+                    yield header_data, message
+
+    async def fetch_text_parts(self, header_datas: List[Dict[str, Any]], chunk_size: int = None) -> AsyncIterator[Dict[str, Any]]:
+        """ดึงเฉพาะส่วน text/plain และ text/html ตาม BODYSTRUCTURE แล้วคืนค่าเป็นข้อมูลอีเมล"""
+        async for header_data, message in self.fetch_raw_text_parts(header_datas, chunk_size):
+            email_data = build_email_data(header_data, message)
+            if email_data:
+                yield email_data
+
+    async def fetch_emails(self, message_ids: List[int], chunk_size: int = None) -> AsyncIterator[Dict[str, Any]]:
+        """ดึงอีเมลหลายฉบับด้วย UID FETCH ครั้งละชุด แล้วส่งคืนทีละฉบับตามที่ได้รับ"""
+        chunk_size = chunk_size or settings.IMAP_FETCH_BATCH_SIZE
+        uids = sorted(set(int(uid) for uid in message_ids))
+
+        for start in range(0, len(uids), chunk_size):
+            for message in await self._fetch_items(uids[start:start + chunk_size], "(UID RFC822)"):
+                if not isinstance(message.get("RFC822"), bytes):
+                    continue
+                email_data = build_email_data({}, message)
+                if email_data:
+                    yield email_data
+
+    async def _fetch_items(self, message_ids, items: str) -> List[Dict[str, Any]]:
+        """ส่ง UID FETCH หนึ่งครั้งและแยกคำตอบ ถ้าเกิดข้อผิดพลาดจะคืนรายการว่าง"""
+        uid_set = compress_uid_set(message_ids)
+        try:
+            status, untagged = await self._command(b"UID FETCH", uid_set.encode("ascii"), items.encode("ascii"))
+            if status != "OK":
+                logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {uid_set}: {status}")
+                return []
+            return parse_fetch_response(untagged.get("FETCH", []))
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {uid_set}: {str(e)}")
+            return []
+
+    async def _command(self, *args: bytes) -> Tuple[str, Dict[str, list]]:
+        """ส่งคำสั่งแล้วอ่านคำตอบจนถึงบรรทัดผลลัพธ์ของคำสั่งนั้น
+        คืนค่า (สถานะ, คำตอบ untagged แยกตามชนิดในรูปแบบเดียวกับ imaplib)"""
+        async with self._lock:
+            tag = self._next_tag()
+            self.writer.write(tag + b" " + b" ".join(args) + b"\r\n")
+            await self.writer.drain()
+
+            untagged: Dict[str, list] = {}
+            while True:
+                response = await self._read_response()
+                if not response:
+                    raise ConnectionError("เซิร์ฟเวอร์ปิดการเชื่อมต่อ")
+                head = self._head(response)
+
+                if head.startswith(tag + b" "):
+                    return head[len(tag) + 1:].split(b" ", 1)[0].decode("ascii", errors="replace").upper(), untagged
+
+                match = _UNTAGGED_RE.match(head)
+                if not match:
+                    continue
+                number, kind, rest = match.groups()
+                kind = kind.decode("ascii")
+                data = number + (b" " + rest if rest else b"") if number else (rest or b"")
+
+                # แทนที่ส่วนหัวด้วยข้อมูลที่ตัด "* " และชนิดออกแล้ว (เหมือน imaplib)
+                if isinstance(response[0], tuple):
+                    response[0] = (data, response[0][1])
+                else:
+                    response[0] = data
+                untagged.setdefault(kind, []).extend(response)
+
+                # เก็บ response code ของคำตอบสถานะ เช่น [UIDVALIDITY n] แยกไว้ด้วย
+                if kind in ("OK", "NO", "BAD"):
+                    for code, value in _RESPONSE_CODE_RE.findall(head):
+                        untagged.setdefault(code.decode("ascii"), []).append(value)
+
+    def _next_tag(self) -> bytes:
+        """tag ของคำสั่งถัดไป"""
+        self._tag_counter += 1
+        return f"A{self._tag_counter:04d}".encode("ascii")
+
+    async def _read_response(self, timeout: float = None) -> list:
+        """อ่านคำตอบหนึ่งรายการ รวม literal ที่ตามมา คืนค่าเป็นรายการแบบเดียวกับ imaplib
+        เช่น [(b'1 (UID 5 RFC822 {10}', b'<10 ไบต์>'), b')']"""
+        parts = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), timeout or self.timeout)
+            if not line:
+                return parts
+            match = _LITERAL_RE.search(line)
+            if not match:
+                parts.append(line.rstrip(b"\r\n"))
+                return parts
+            literal = await asyncio.wait_for(self.reader.readexactly(int(match.group(1))), self.timeout)
+            parts.append((line.rstrip(b"\r\n"), literal))
+
+    @staticmethod
+    def _head(response: list) -> bytes:
+        """บรรทัดแรกของคำตอบ"""
+        first = response[0]
+        return first[0] if isinstance(first, tuple) else first
+
+    async def _close(self):
+        """ปิด socket"""
+        if self.writer:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
@@ -0,0 +1,73 @@
+﻿import hashlib
+import logging
+import os
+import re
+import tempfile
+from typing import Dict, Iterable, Optional
+
+from ..config import settings
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+_SHA256_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class AttachmentStore:
+    """ที่เก็บไฟล์แนบบนดิสก์ โดยใช้ค่า sha256 ของเนื้อหาเป็นชื่อไฟล์ (ไฟล์ซ้ำจะถูกเก็บเพียงครั้งเดียว)"""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = os.path.abspath(root_dir)
+
+    def put_stream(self, chunks: Iterable[bytes]) -> Dict[str, object]:
+        """เขียนข้อมูลทีละส่วนลงไฟล์ชั่วคราว แล้วย้ายไปยังตำแหน่งตาม sha256"""
+        tmp_dir = os.path.join(self.root_dir, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+
+            sha256 = digest.hexdigest()
+            relative_path = self.relative_path(sha256)
+            final_path = os.path.join(self.root_dir, relative_path)
+
+            if os.path.exists(final_path):
+                # มีไฟล์นี้อยู่แล้ว ไม่ต้องเก็บซ้ำ
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+
+            return {"sha256": sha256, "path": relative_path, "size": size}
+
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def relative_path(self, sha256: str) -> str:
+        """แบ่งไดเรกทอรีตามอักษรต้นของ sha256 เช่น ab/cd/abcd..."""
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def absolute_path(self, relative_path: str) -> Optional[str]:
+        """คืนค่าตำแหน่งไฟล์จริง ถ้าเป็นตำแหน่งรูปแบบ ab/cd/<sha256> ที่ที่เก็บสร้างและมีไฟล์อยู่จริง
+        (ไม่รับตำแหน่งอื่น เช่น ไฟล์ที่กำลังเขียนใน tmp/)"""
+        if not relative_path:
+            return None
+        sha256 = os.path.basename(relative_path)
+        if not _SHA256_RE.fullmatch(sha256) or relative_path != self.relative_path(sha256):
+            return None
+        path = os.path.join(self.root_dir, relative_path)
+        if not os.path.isfile(path):
+            return None
+        return path
+
+
+attachment_store = AttachmentStore(settings.ATTACHMENT_STORE_DIR)
@@ -0,0 +1,174 @@
+﻿import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Callable
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models.receipt import Receipt
+from .category_service import auto_categorize_vendor
+from .message_cache import message_cache
+from .sync_service import extract_raw_receipt
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# ฟิลด์ที่ได้จากการแยกข้อมูลใบเสร็จ และจะถูกแทนที่เมื่อแยกข้อมูลใหม่ได้ค่าต่างไป
+BACKFILL_FIELDS = ("vendor_name", "receipt_date", "amount", "currency")
+
+# จำนวนตัวอย่างการเปลี่ยนแปลงที่แสดงในสรุปผล
+MAX_DIFF_SAMPLES = 20
+
+
+def _comparable(value):
+    """ปรับค่าให้เปรียบเทียบกับค่าในฐานข้อมูลได้ (ฐานข้อมูลเก็บวันที่แบบไม่มี timezone)"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None, microsecond=0)
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+def _extract_task(source: tuple) -> tuple:
+    """แยกข้อมูลใบเสร็จจากอีเมลในแคช (ทำงานใน process pool ได้)
+    คืนค่า (พบอีเมลในแคชหรือไม่, ข้อมูลใบเสร็จ)"""
+    imap_setting_id, imap_folder, uid_validity, uid = source
+    raw_email = message_cache.get(imap_setting_id, uid_validity, uid, imap_folder)
+    if raw_email is None:
+        return False, None
+    return True, extract_raw_receipt(uid, raw_email)
+
+
+def backfill_receipts(
+    db: Session,
+    user_id: Optional[int] = None,
+    chunk_size: int = None,
+    workers: int = None,
+    dry_run: bool = False,
+    progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Dict[str, Any]:
+    """แยกข้อมูลใบเสร็จที่บันทึกไว้แล้วใหม่จากอีเมลในแคช แล้วอัปเดตฟิลด์ที่เปลี่ยนแบบครั้งละชุด
+    ถ้าไม่ระบุ user_id จะทำกับใบเสร็จของผู้ใช้ทุกคน (progress_callback จะถูกเรียกด้วยสรุปผลหลังจบแต่ละชุด)"""
+    started = time.perf_counter()
+    chunk_size = chunk_size or settings.BACKFILL_CHUNK_SIZE
+    workers = settings.SYNC_EXTRACT_WORKERS if workers is None else workers
+
+    summary = {
+        "total": 0,
+        "scanned": 0,
+        "missing_source": 0,
+        "not_receipt": 0,
+        "updated": 0,
+        "skipped_user_edited": 0,
+        "changed_fields": {field: 0 for field in BACKFILL_FIELDS + ("category_id",)},
+        "samples": [],
+        "dry_run": dry_run
+    }
+
+    # หมวดหมู่ของชื่อผู้ขายที่เปลี่ยน (ค้นหาครั้งเดียวต่อชื่อ)
+    category_cache = {}
+
+    def categorize(vendor_name: str) -> Optional[int]:
+        if vendor_name not in category_cache:
+            category_cache[vendor_name] = auto_categorize_vendor(vendor_name, db)
+        return category_cache[vendor_name]
+
+    # ใบเสร็จที่ผู้ใช้แก้ไขเองจะไม่ถูกแยกข้อมูลใหม่
+    edited_query = db.query(Receipt).filter(Receipt.imap_uid.isnot(None), Receipt.user_edited.is_(True))
+    if user_id is not None:
+        edited_query = edited_query.filter(Receipt.user_id == user_id)
+    summary["skipped_user_edited"] = edited_query.count()
+
+    receipts = db.query(Receipt).filter(Receipt.imap_uid.isnot(None), Receipt.user_edited.is_(False))
+    if user_id is not None:
+        receipts = receipts.filter(Receipt.user_id == user_id)
+    summary["total"] = receipts.count()
+
+    executor = None
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    try:
+        last_id = 0
+        while True:
+            # แบ่งหน้าด้วย id (keyset) เพื่อไม่ให้ช้าลงเมื่ออ่านลึกขึ้นเหมือน OFFSET
+            query = db.query(
+                Receipt.id, Receipt.imap_setting_id, Receipt.imap_folder, Receipt.imap_uidvalidity, Receipt.imap_uid,
+                *(getattr(Receipt, field) for field in BACKFILL_FIELDS)
+            ).filter(Receipt.id > last_id, Receipt.imap_uid.isnot(None), Receipt.user_edited.is_(False))
+            if user_id is not None:
+                query = query.filter(Receipt.user_id == user_id)
+            rows = query.order_by(Receipt.id).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            sources = [(row.imap_setting_id, row.imap_folder, row.imap_uidvalidity, row.imap_uid) for row in rows]
+            if executor:
+                results = executor.map(_extract_task, sources, chunksize=max(1, len(sources) // (workers * 4)))
+            else:
+                results = map(_extract_task, sources)
+
+            updates = _collect_updates(rows, results, summary, categorize)
+            if updates and not dry_run:
+                db.execute(update(Receipt), updates)
+                db.commit()
+            summary["updated"] += len(updates)
+            if progress_callback:
+                progress_callback(summary)
+            logger.info(f"แยกข้อมูลใบเสร็จใหม่แล้ว {summary['scanned']} รายการ อัปเดต {summary['updated']} รายการ")
+
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    summary["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def _collect_updates(
+    rows: List[Any],
+    results,
+    summary: Dict[str, Any],
+    categorize: Callable[[str], Optional[int]]
+) -> List[Dict[str, Any]]:
+    """เปรียบเทียบผลการแยกข้อมูลกับค่าเดิม และสร้างรายการอัปเดตของใบเสร็จที่เปลี่ยน
+    (ถ้าชื่อผู้ขายเปลี่ยนจะจัดหมวดหมู่ใหม่ด้วย)"""
+    updates = []
+    for row, (found, receipt_data) in zip(rows, results):
+        summary["scanned"] += 1
+        if not found:
+            summary["missing_source"] += 1
+            continue
+        if receipt_data is None or (receipt_data.get("amount") or 0) <= 0:
+            # แยกข้อมูลใหม่แล้วไม่ใช่ใบเสร็จ (หรือหาจำนวนเงินไม่พบ) จะไม่ลบหรือแก้ใบเสร็จเดิม
+            summary["not_receipt"] += 1
+            continue
+
+        changed = [
+            field for field in BACKFILL_FIELDS
+            if _comparable(receipt_data.get(field)) != _comparable(getattr(row, field))
+        ]
+        if not changed:
+            continue
+
+        for field in changed:
+            summary["changed_fields"][field] += 1
+            if len(summary["samples"]) < MAX_DIFF_SAMPLES:
+                summary["samples"].append({
+                    "receipt_id": row.id,
+                    "field": field,
+                    "old": getattr(row, field),
+                    "new": receipt_data.get(field)
+                })
+
+        update_row = {"id": row.id, **{field: receipt_data.get(field) for field in BACKFILL_FIELDS}}
+        if "vendor_name" in changed:
+            update_row["category_id"] = categorize(receipt_data.get("vendor_name"))
+            summary["changed_fields"]["category_id"] += 1
+        updates.append(update_row)
+    return updates
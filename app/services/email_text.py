@@ -0,0 +1,81 @@
+﻿import html
+import re
+from typing import Any, Dict, Iterable, Tuple
+
+# ส่วนที่ไม่ใช่เนื้อหาที่แสดงผล (CSS, สคริปต์, ส่วนหัวของเอกสาร และ comment)
+_HIDDEN_RE = re.compile(
+    r"<(script|style|head)\b[^>]*>.*?</\1\s*>|<!--.*?-->|<![^>]*>|<\?[^>]*>",
+    re.IGNORECASE | re.DOTALL
+)
+# แท็ก HTML (ต้องตามด้วยช่องว่าง / หรือ > จึงไม่ตัดที่อยู่อีเมลแบบ <name@example.com> ในข้อความ)
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^>]*)?/?>")
+# แท็กที่ขึ้นบรรทัดใหม่เมื่อแสดงผล
+_BLOCK_TAGS = frozenset({
+    "address", "article", "blockquote", "body", "br", "caption", "center", "dd", "div", "dl", "dt",
+    "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "html", "li", "ol", "p",
+    "pre", "section", "table", "tbody", "tfoot", "thead", "tr", "ul"
+})
+# ช่องของตาราง แยกด้วย tab ให้ป้ายกำกับและค่าในแถวเดียวกันยังอยู่บรรทัดเดียวกัน
+_CELL_TAGS = frozenset({"td", "th"})
+
+_SOURCE_SPACE_RE = re.compile(r"\s+")
+_INVISIBLE_RE = re.compile("[\u200b-\u200d\u2060\ufeff\xad]")
+_SPACE_RE = re.compile(r"[^\S\n\t]+")
+_TAB_RE = re.compile(r" ?\t[\t ]*")
+_NEWLINE_RE = re.compile(r"[ \t]*\n\s*")
+
+
+def _replace_tag(match: re.Match) -> str:
+    name = match.group(2).lower()
+    if name in _CELL_TAGS:
+        return "\t"
+    if name in _BLOCK_TAGS:
+        return "\n"
+    return ""
+
+
+def _collapse_whitespace(text: str) -> str:
+    """ลบอักขระที่มองไม่เห็น ย่อช่องว่างซ้ำ และลบบรรทัดว่าง"""
+    text = _INVISIBLE_RE.sub("", text)
+    text = _SPACE_RE.sub(" ", text)
+    text = _TAB_RE.sub("\t", text)
+    text = _NEWLINE_RE.sub("\n", text)
+    return text.strip()
+
+
+def html_to_text(content: str) -> str:
+    """แปลง HTML เป็นข้อความ: ตัดแท็กและ CSS ถอดรหัส entity ขึ้นบรรทัดใหม่ตามแท็กแบบบล็อก และแยกช่องตารางด้วย tab"""
+    if not content:
+        return ""
+    content = _HIDDEN_RE.sub(" ", content)
+    # ช่องว่างและการขึ้นบรรทัดในซอร์ส HTML ไม่มีผลต่อการแสดงผล
+    content = _SOURCE_SPACE_RE.sub(" ", content)
+    content = _TAG_RE.sub(_replace_tag, content)
+    return _collapse_whitespace(html.unescape(content))
+
+
+def plain_to_text(content: str) -> str:
+    """จัดรูปแบบข้อความธรรมดาให้เหมือนผลจาก html_to_text (คงการขึ้นบรรทัดเดิมไว้)"""
+    if not content:
+        return ""
+    return _collapse_whitespace(content.replace("\r\n", "\n").replace("\r", "\n"))
+
+
+def build_email_text(parts: Iterable[Tuple[str, str]]) -> str:
+    """รวมส่วนข้อความ [(content_type, เนื้อหา)] เป็นข้อความที่ใช้แยกข้อมูลใบเสร็จ"""
+    texts = []
+    for content_type, content in parts:
+        text = html_to_text(content) if content_type == "text/html" else plain_to_text(content)
+        if text:
+            texts.append(text)
+    return "\n".join(texts)
+
+
+def email_text(email_data: Dict[str, Any]) -> str:
+    """ข้อความของอีเมลที่จัดรูปแบบแล้ว คำนวณครั้งเดียวแล้วเก็บไว้ใน email_data["text"]
+    (ข้อมูลที่ไม่ได้สร้างจาก IMAPClient จะไม่รู้ชนิดของแต่ละส่วน จึงแปลงเนื้อหาทั้งหมดแบบ HTML)"""
+    text = email_data.get("text")
+    if text is None:
+        text = html_to_text(email_data.get("body") or "")
+        email_data["text"] = text
+    return text
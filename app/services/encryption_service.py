@@ -1,4 +1,8 @@
-﻿from cryptography.fernet import Fernet
+﻿import threading
+import time
+from typing import Dict, Tuple
+
+from cryptography.fernet import Fernet
 from ..config import settings
 
 # สร้าง key สำหรับการเข้ารหัส
@@ -13,4 +17,25 @@ def encrypt_password(password: str) -> str:
 def decrypt_password(encrypted_password: str) -> str:
     """ถอดรหัสรหัสผ่าน"""
     decrypted_password = cipher_suite.decrypt(encrypted_password.encode())
-    return decrypted_password.decode()
\ No newline at end of file
+    return decrypted_password.decode()
+
+# รหัสผ่านที่ถอดรหัสแล้ว แยกตามข้อความที่เข้ารหัส: (รหัสผ่าน, เวลาหมดอายุ)
+_decrypted_passwords: Dict[str, Tuple[str, float]] = {}
+_decrypted_passwords_lock = threading.Lock()
+
+def decrypt_password_cached(encrypted_password: str) -> str:
+    """ถอดรหัสรหัสผ่านโดยจำผลไว้ในหน่วยความจำ IMAP_CREDENTIAL_TTL วินาที
+    (เมื่อเปลี่ยนรหัสผ่าน ข้อความที่เข้ารหัสจะเปลี่ยนไปด้วย จึงไม่ใช้ค่าเก่า)"""
+    now = time.monotonic()
+    with _decrypted_passwords_lock:
+        cached = _decrypted_passwords.get(encrypted_password)
+        if cached and cached[1] > now:
+            return cached[0]
+    
+    decrypted_password = decrypt_password(encrypted_password)
+    with _decrypted_passwords_lock:
+        # ลบรายการที่หมดอายุไม่ให้ค้างในหน่วยความจำ
+        for key in [key for key, (_, expires_at) in _decrypted_passwords.items() if expires_at <= now]:
+            del _decrypted_passwords[key]
+        _decrypted_passwords[encrypted_password] = (decrypted_password, now + settings.IMAP_CREDENTIAL_TTL)
+    return decrypted_password
@@ -0,0 +1,143 @@
+﻿import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..database import SessionLocal
+from ..models.imap_setting import ImapSetting
+from .async_imap_service import AsyncIMAPClient
+from .sync_job_service import enqueue_sync_job, MANUAL_PRIORITY
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+
+class IdleListener:
+    """เชื่อมต่อค้างไว้กับบัญชี IMAP หนึ่งบัญชี และรอแจ้งเตือนอีเมลใหม่ด้วย IDLE (หรือ NOOP ถ้าเซิร์ฟเวอร์ไม่รองรับ)
+    เมื่อมีอีเมลใหม่จะเพิ่มงานซิงค์แบบ incremental เข้าคิว ให้ worker ดึงเฉพาะ UID ใหม่ไปประมวลผล"""
+
+    def __init__(self, imap_setting_id: int, session_factory: Callable[[], Session] = SessionLocal):
+        self.imap_setting_id = imap_setting_id
+        self.session_factory = session_factory
+
+    async def run(self):
+        """วนเชื่อมต่อและรออีเมลใหม่จนกว่าจะถูกยกเลิก ถ้าการเชื่อมต่อหลุดจะเชื่อมต่อใหม่โดยเพิ่มเวลารอเป็นเท่าตัว"""
+        delay = 1.0
+        reconnected = False
+        while True:
+            imap_setting = await asyncio.to_thread(self._load_setting)
+            if imap_setting is None:
+                logger.info(f"ไม่พบการตั้งค่า IMAP ID: {self.imap_setting_id} หยุดรอแจ้งเตือน")
+                return
+
+            try:
+                async with AsyncIMAPClient(imap_setting) as client:
+                    if await client.select_folder() is None:
+                        raise ConnectionError(f"ไม่สามารถเลือกโฟลเดอร์ {imap_setting.folder}")
+                    delay = 1.0
+
+                    # อีเมลที่เข้ามาระหว่างการเชื่อมต่อหลุดจะไม่มีแจ้งเตือน จึงซิงค์หนึ่งครั้งหลังเชื่อมต่อใหม่
+                    if reconnected:
+                        await asyncio.to_thread(self._enqueue_sync)
+
+                    await self._listen(client)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"การรอแจ้งเตือนของ IMAP ID: {self.imap_setting_id} ผิดพลาด: {str(e)} เชื่อมต่อใหม่ใน {delay:.0f} วินาที")
+
+            reconnected = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.IDLE_RECONNECT_MAX_DELAY)
+
+    async def _listen(self, client: AsyncIMAPClient):
+        """รอแจ้งเตือนไปเรื่อย ๆ (ออกจาก IDLE ก่อนครบ 29 นาทีตาม RFC 2177 แล้วเริ่มใหม่)"""
+        use_idle = client.has_capability("IDLE")
+        if not use_idle:
+            logger.info(f"เซิร์ฟเวอร์ของ IMAP ID: {self.imap_setting_id} ไม่รองรับ IDLE ใช้ NOOP ทุก {settings.IMAP_NOOP_INTERVAL:.0f} วินาทีแทน")
+
+        while True:
+            if use_idle:
+                new_mail = await client.idle(settings.IMAP_IDLE_TIMEOUT)
+            else:
+                await asyncio.sleep(settings.IMAP_NOOP_INTERVAL)
+                new_mail = await client.noop()
+
+            if new_mail:
+                logger.info(f"มีอีเมลใหม่ใน IMAP ID: {self.imap_setting_id}")
+                await asyncio.to_thread(self._enqueue_sync)
+
+    def _load_setting(self) -> Optional[ImapSetting]:
+        """โหลดการตั้งค่า IMAP ล่าสุดจากฐานข้อมูล"""
+        db = self.session_factory()
+        try:
+            imap_setting = db.get(ImapSetting, self.imap_setting_id)
+            if imap_setting is None or not imap_setting.idle_enabled:
+                return None
+            db.expunge(imap_setting)
+            return imap_setting
+        finally:
+            db.close()
+
+    def _enqueue_sync(self):
+        """เพิ่มงานซิงค์ของบัญชีนี้เข้าคิว (ถ้ามีงานค้างอยู่แล้วจะใช้งานเดิม)"""
+        db = self.session_factory()
+        try:
+            imap_setting = db.get(ImapSetting, self.imap_setting_id)
+            if imap_setting is None:
+                return
+            job = enqueue_sync_job(
+                db,
+                imap_setting,
+                max_emails=settings.SYNC_SCHEDULE_MAX_EMAILS,
+                priority=MANUAL_PRIORITY
+            )
+            logger.info(f"เพิ่มงานซิงค์ ID: {job.id} จากแจ้งเตือนของ IMAP ID: {self.imap_setting_id}")
+        finally:
+            db.close()
+
+
+def load_idle_setting_ids(db: Session) -> List[int]:
+    """ID ของบัญชีที่เปิดการรอแจ้งเตือนด้วย IDLE"""
+    rows = db.query(ImapSetting.id).filter(ImapSetting.idle_enabled.is_(True)).all()
+    return [imap_setting_id for imap_setting_id, in rows]
+
+
+async def run_idle_listeners(stop_event: asyncio.Event, session_factory: Callable[[], Session] = SessionLocal):
+    """เริ่ม/หยุดตัวรอแจ้งเตือนให้ตรงกับบัญชีที่เปิด idle_enabled ทุก IDLE_RELOAD_INTERVAL วินาที
+    ทุกบัญชีใช้ event loop เดียวกัน"""
+    tasks: Dict[int, asyncio.Task] = {}
+
+    def load_ids() -> List[int]:
+        db = session_factory()
+        try:
+            return load_idle_setting_ids(db)
+        finally:
+            db.close()
+
+    try:
+        while not stop_event.is_set():
+            try:
+                wanted = set(await asyncio.to_thread(load_ids))
+            except Exception as e:
+                logger.error(f"ไม่สามารถโหลดบัญชีที่เปิด IDLE: {str(e)}")
+                wanted = set(tasks)
+
+            for imap_setting_id in list(tasks):
+                if imap_setting_id not in wanted or tasks[imap_setting_id].done():
+                    tasks.pop(imap_setting_id).cancel()
+            for imap_setting_id in wanted - set(tasks):
+                listener = IdleListener(imap_setting_id, session_factory)
+                tasks[imap_setting_id] = asyncio.create_task(listener.run())
+
+            try:
+                await asyncio.wait_for(stop_event.wait(), settings.IDLE_RELOAD_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
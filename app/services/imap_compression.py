@@ -0,0 +1,151 @@
+﻿import asyncio
+import imaplib
+import zlib
+from typing import Tuple
+
+# ขนาดที่อ่านจาก socket ต่อครั้งเมื่อเปิดการบีบอัด
+_READ_CHUNK_SIZE = 65536
+
+
+class DeflateCodec:
+    """บีบอัด/คลายข้อมูลแบบ DEFLATE ดิบ (ไม่มี header ของ zlib) ตาม RFC 4978
+    ข้อมูลที่ส่งแต่ละครั้งจะ flush แบบ Z_SYNC_FLUSH ให้อีกฝั่งคลายได้ทันทีโดยไม่ต้องรอข้อมูลถัดไป"""
+
+    def __init__(self, level: int = 6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+class _DeflateTransport:
+    """ส่วนเสริมของ imaplib.IMAP4 ที่รองรับ COMPRESS=DEFLATE และนับจำนวนไบต์ที่รับส่ง
+    (ไบต์จริงบนเครือข่าย และไบต์ของข้อมูลก่อนบีบอัด ถ้าไม่ได้บีบอัดทั้งสองค่าจะเท่ากัน)"""
+
+    codec = None
+    bytes_received = 0
+    wire_bytes_received = 0
+    bytes_sent = 0
+    wire_bytes_sent = 0
+
+    def compress_deflate(self, level: int = 6) -> bool:
+        """ขอเปิดการบีบอัดกับเซิร์ฟเวอร์ หลังจากนี้ข้อมูลทั้งหมดในการเชื่อมต่อจะถูกบีบอัด"""
+        if self.codec is not None:
+            return True
+        status, _ = self.xatom("COMPRESS", "DEFLATE")
+        if status != "OK":
+            return False
+        self.codec = DeflateCodec(level)
+        self._inflated = bytearray()
+        return True
+
+    def read(self, size):
+        if self.codec is None:
+            data = super().read(size)
+            self._count_received(len(data), len(data))
+            return data
+        while len(self._inflated) < size and self._fill():
+            pass
+        return self._take(min(size, len(self._inflated)))
+
+    def readline(self):
+        if self.codec is None:
+            line = super().readline()
+            self._count_received(len(line), len(line))
+            return line
+        while True:
+            end = self._inflated.find(b"\n")
+            if end >= 0:
+                return self._take(end + 1)
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            if not self._fill():
+                return self._take(len(self._inflated))
+
+    def send(self, data):
+        wire = data if self.codec is None else self.codec.compress(data)
+        self.bytes_sent += len(data)
+        self.wire_bytes_sent += len(wire)
+        super().send(wire)
+
+    def _fill(self) -> bool:
+        """อ่านข้อมูลที่บีบอัดจาก socket มาคลายต่อท้ายบัฟเฟอร์ คืนค่า False เมื่อการเชื่อมต่อปิด"""
+        chunk = self.file.read1(_READ_CHUNK_SIZE)
+        if not chunk:
+            return False
+        inflated = self.codec.decompress(chunk)
+        self._inflated += inflated
+        self._count_received(len(inflated), len(chunk))
+        return True
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        return data
+
+    def _count_received(self, size: int, wire_size: int):
+        self.bytes_received += size
+        self.wire_bytes_received += wire_size
+
+
+class DeflateIMAP4(_DeflateTransport, imaplib.IMAP4):
+    """imaplib.IMAP4 ที่รองรับ COMPRESS=DEFLATE"""
+
+
+class DeflateIMAP4_SSL(_DeflateTransport, imaplib.IMAP4_SSL):
+    """imaplib.IMAP4_SSL ที่รองรับ COMPRESS=DEFLATE"""
+
+
+class _DeflateStreamWriter:
+    """ตัวเขียนที่บีบอัดข้อมูลก่อนส่งต่อให้ asyncio.StreamWriter เดิม (มีเมธอดเท่าที่ AsyncIMAPClient ใช้)"""
+
+    def __init__(self, writer: asyncio.StreamWriter, codec: DeflateCodec, pump: asyncio.Task):
+        self._writer = writer
+        self._codec = codec
+        self._pump = pump
+
+    def write(self, data: bytes):
+        self._writer.write(self._codec.compress(data))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close(self):
+        self._pump.cancel()
+        self._writer.close()
+
+    async def wait_closed(self):
+        await self._writer.wait_closed()
+
+
+async def _inflate_stream(raw_reader: asyncio.StreamReader, reader: asyncio.StreamReader, codec: DeflateCodec):
+    """อ่านข้อมูลที่บีบอัดจาก socket แล้วคลายใส่ reader ใหม่จนกว่าการเชื่อมต่อจะปิด"""
+    try:
+        while True:
+            chunk = await raw_reader.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            reader.feed_data(codec.decompress(chunk))
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        reader.set_exception(e)
+        return
+    reader.feed_eof()
+
+
+def wrap_deflate_streams(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    limit: int,
+    level: int = 6
+) -> Tuple[asyncio.StreamReader, _DeflateStreamWriter]:
+    """ห่อ stream ของการเชื่อมต่อหลังเซิร์ฟเวอร์ตอบรับ COMPRESS DEFLATE คืนค่า (reader, writer) ที่ใช้แทนของเดิม"""
+    codec = DeflateCodec(level)
+    inflated = asyncio.StreamReader(limit=limit)
+    pump = asyncio.create_task(_inflate_stream(reader, inflated, codec))
+    return inflated, _DeflateStreamWriter(writer, codec, pump)
@@ -0,0 +1,159 @@
+﻿import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from ..config import settings
+from ..models.imap_setting import ImapSetting
+from .imap_service import IMAPClient
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+
+def _pool_key(imap_setting: ImapSetting) -> Tuple:
+    """ค่าที่ใช้แยกการเชื่อมต่อใน pool ถ้าเปลี่ยนเซิร์ฟเวอร์หรือรหัสผ่านจะไม่ใช้การเชื่อมต่อเดิม"""
+    return (
+        imap_setting.id,
+        imap_setting.server,
+        imap_setting.port,
+        imap_setting.username,
+        imap_setting.password_encrypted,
+        imap_setting.use_ssl
+    )
+
+
+class IMAPSessionPool:
+    """pool ของการเชื่อมต่อ IMAP ที่ล็อกอินแล้ว แยกตาม ImapSetting.id (ใช้ร่วมกันภายใน process เดียว)
+    ช่วยให้งานที่ทำต่อเนื่องกันกับบัญชีเดิมไม่ต้อง TLS handshake และ LOGIN ใหม่ทุกครั้ง"""
+
+    def __init__(
+        self,
+        idle_timeout: float,
+        max_lifetime: float,
+        max_idle_per_setting: int,
+        max_idle: int
+    ):
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle_per_setting = max_idle_per_setting
+        self.max_idle = max_idle
+        # การเชื่อมต่อที่ว่างอยู่ แยกตาม key เรียงจากที่ใช้ล่าสุดน้อยที่สุด: [(client, เวลาที่คืน)]
+        self._idle: "OrderedDict[Tuple, List[Tuple[IMAPClient, float]]]" = OrderedDict()
+        self._idle_count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, imap_setting: ImapSetting) -> Optional[IMAPClient]:
+        """ยืมการเชื่อมต่อที่ยังใช้งานได้จาก pool หรือเชื่อมต่อใหม่ถ้าไม่มี คืนค่า None ถ้าเชื่อมต่อไม่ได้"""
+        key = _pool_key(imap_setting)
+        while True:
+            with self._lock:
+                sessions = self._idle.get(key)
+                if not sessions:
+                    break
+                client, released_at = sessions.pop()
+                self._idle_count -= 1
+                if not sessions:
+                    del self._idle[key]
+
+            # ตรวจอายุและสถานะของการเชื่อมต่อก่อนนำกลับมาใช้
+            if self._expired(client, released_at) or not client.noop():
+                client.disconnect()
+                continue
+            client.imap_setting = imap_setting
+            client.folder = None
+            return client
+
+        client = IMAPClient(imap_setting)
+        if not client.connect():
+            return None
+        client.pool_key = key
+        return client
+
+    def release(self, client: IMAPClient, reusable: bool = True):
+        """คืนการเชื่อมต่อเข้า pool (ถ้า reusable เป็น False หรือ pool เต็ม จะปิดการเชื่อมต่อ)"""
+        if client is None:
+            return
+        if not reusable or client.pool_key is None or client.connection is None or self._expired(client, time.monotonic()):
+            client.disconnect()
+            return
+
+        to_close = []
+        with self._lock:
+            to_close.extend(self._prune())
+            sessions = self._idle.setdefault(client.pool_key, [])
+            self._idle.move_to_end(client.pool_key)
+            if len(sessions) >= self.max_idle_per_setting:
+                to_close.append(client)
+            else:
+                sessions.append((client, time.monotonic()))
+                self._idle_count += 1
+                # pool เต็ม ปิดการเชื่อมต่อของบัญชีที่ไม่ได้ใช้นานที่สุด
+                while self._idle_count > self.max_idle:
+                    oldest_key = next(iter(self._idle))
+                    oldest = self._idle[oldest_key]
+                    to_close.append(oldest.pop(0)[0])
+                    self._idle_count -= 1
+                    if not oldest:
+                        del self._idle[oldest_key]
+
+        for idle_client in to_close:
+            idle_client.disconnect()
+
+    @contextmanager
+    def session(self, imap_setting: ImapSetting) -> Iterator[Optional[IMAPClient]]:
+        """ยืมการเชื่อมต่อระหว่างบล็อก with ถ้าเกิดข้อผิดพลาดจะไม่คืนการเชื่อมต่อนั้นเข้า pool"""
+        client = self.acquire(imap_setting)
+        try:
+            yield client
+        except Exception:
+            self.release(client, reusable=False)
+            raise
+        else:
+            self.release(client)
+
+    def close_all(self):
+        """ปิดการเชื่อมต่อที่ว่างอยู่ทั้งหมด"""
+        with self._lock:
+            sessions = [client for idle in self._idle.values() for client, _ in idle]
+            self._idle.clear()
+            self._idle_count = 0
+        for client in sessions:
+            client.disconnect()
+
+    def _expired(self, client: IMAPClient, released_at: float) -> bool:
+        """การเชื่อมต่อว่างนานเกินไป หรือเปิดมานานเกินอายุสูงสุด"""
+        now = time.monotonic()
+        return (
+            now - released_at > self.idle_timeout
+            or client.connected_at is None
+            or now - client.connected_at > self.max_lifetime
+        )
+
+    def _prune(self) -> List[IMAPClient]:
+        """นำการเชื่อมต่อที่หมดอายุออกจาก pool คืนค่ารายการที่ต้องปิด (ต้องถือ lock อยู่แล้ว)"""
+        expired = []
+        for key in list(self._idle):
+            sessions = self._idle[key]
+            alive = []
+            for client, released_at in sessions:
+                if self._expired(client, released_at):
+                    expired.append(client)
+                else:
+                    alive.append((client, released_at))
+            self._idle_count -= len(sessions) - len(alive)
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+        return expired
+
+
+imap_pool = IMAPSessionPool(
+    idle_timeout=settings.IMAP_POOL_IDLE_TIMEOUT,
+    max_lifetime=settings.IMAP_POOL_MAX_LIFETIME,
+    max_idle_per_setting=settings.IMAP_POOL_MAX_IDLE_PER_SETTING,
+    max_idle=settings.IMAP_POOL_MAX_IDLE
+)
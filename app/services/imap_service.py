@@ -1,40 +1,722 @@
 ﻿import imaplib
+import itertools
 import email
+import base64
+import quopri
 import re
+import time
 import logging
 from email.header import decode_header
 from email.utils import parsedate_to_datetime
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Tuple
 
+from ..config import settings
 from ..models.imap_setting import ImapSetting
-from ..services.encryption_service import decrypt_password
+from ..services.encryption_service import decrypt_password_cached
+from ..services.attachment_store import attachment_store
+from ..services.receipt_extractor import ReceiptExtractor, receipt_identity
+from .vendor_rules import vendor_templates
+from .imap_compression import DeflateIMAP4, DeflateIMAP4_SSL
+from .email_text import build_email_text
 
 # ตั้งค่า logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# รูปแบบ token ในคำตอบของ FETCH: วงเล็บ, สตริงในเครื่องหมายคำพูด และ atom (รวม BODY[...]<n>)
+_FETCH_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?))')
+_LITERAL_SUFFIX_RE = re.compile(rb'\{\d+\}$')
+
+
+def compress_uid_set(uids) -> str:
+    """รวม UID ที่ต่อเนื่องกันเป็นช่วง เช่น [101, 102, 103, 155] เป็น 101:103,155"""
+    ranges = []
+    for uid in sorted(set(int(uid) for uid in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def _tokenize_fetch_data(data: list) -> list:
+    """แปลงข้อมูลดิบจาก imaplib เป็นรายการ token (literal จะเป็น bytes)"""
+    tokens = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            prefix, literal = item
+            tokens.extend(_tokenize_line(_LITERAL_SUFFIX_RE.sub(b"", prefix)))
+            tokens.append(literal)
+        else:
+            tokens.extend(_tokenize_line(item))
+    return tokens
+
+
+def _tokenize_line(line: bytes) -> list:
+    """แยก token จากข้อความหนึ่งบรรทัดของคำตอบ IMAP"""
+    tokens = []
+    for match in _FETCH_TOKEN_RE.finditer(line):
+        open_paren, close_paren, quoted, atom = match.groups()
+        if open_paren:
+            tokens.append("(")
+        elif close_paren:
+            tokens.append(")")
+        elif quoted is not None:
+            tokens.append(("quoted", re.sub(rb'\\(.)', rb'\1', quoted).decode("utf-8", errors="replace")))
+        elif atom:
+            tokens.append(atom.decode("utf-8", errors="replace"))
+    return tokens
+
+
+def _build_list(tokens: list, pos: int):
+    """สร้างรายการซ้อนจาก token ที่เริ่มหลังวงเล็บเปิด คืนค่า (รายการ, ตำแหน่งถัดไป)"""
+    items = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token == "(":
+            sub_items, pos = _build_list(tokens, pos + 1)
+            items.append(sub_items)
+            continue
+        if token == ")":
+            return items, pos + 1
+        if isinstance(token, tuple):
+            items.append(token[1])
+        elif token == "NIL":
+            items.append(None)
+        else:
+            items.append(token)
+        pos += 1
+    return items, pos
+
+
+def parse_fetch_response(data: list) -> List[Dict[str, Any]]:
+    """แยกคำตอบของ UID FETCH ออกเป็น dict ต่ออีเมล เช่น {"UID": 101, "RFC822": b"..."}"""
+    tokens = _tokenize_fetch_data(data)
+    messages = []
+    pos = 0
+    while pos < len(tokens):
+        # แต่ละรายการเริ่มด้วย "<ลำดับ> (" ตามด้วยคู่ชื่อ/ค่า
+        if pos + 1 < len(tokens) and tokens[pos + 1] == "(":
+            items, pos = _build_list(tokens, pos + 2)
+            message = {}
+            for index in range(0, len(items) - 1, 2):
+                key = items[index]
+                if not isinstance(key, str):
+                    continue
+                key = key.upper().replace("BODY.PEEK[", "BODY[")
+                value = items[index + 1]
+                if key in ("UID", "RFC822.SIZE") and isinstance(value, str) and value.isdigit():
+                    value = int(value)
+                message[key] = value
+            if "UID" in message:
+                messages.append(message)
+        else:
+            pos += 1
+    return messages
+
+
+# header ที่ดึงในขั้นแรกเพื่อคัดกรองอีเมล
+HEADER_FIELDS = "FROM SUBJECT DATE MESSAGE-ID"
+HEADER_FETCH_ITEMS = f"(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+
+
+def _or_criteria(terms: List[str]) -> str:
+    """รวมเงื่อนไขด้วย OR ของ IMAP (รับได้ครั้งละสองเงื่อนไข จึงต้องซ้อนกัน)"""
+    if len(terms) == 1:
+        return terms[0]
+    middle = len(terms) // 2
+    left, right = _or_criteria(terms[:middle]), _or_criteria(terms[middle:])
+    return f"OR {_group_criteria(left)} {_group_criteria(right)}"
+
+
+def _group_criteria(criteria: str) -> str:
+    """ครอบเงื่อนไขด้วยวงเล็บถ้ายังไม่ได้ครอบ"""
+    return criteria if criteria.startswith("(") else f"({criteria})"
+
+
+def build_source_criteria(source: Dict[str, Any]) -> str:
+    """สร้างเงื่อนไข SEARCH ของ IMAP จากแหล่งที่มาของใบเสร็จ"""
+    parts = []
+    if source["from"]:
+        parts.append(_or_criteria([f'FROM "{domain}"' for domain in source["from"]]))
+    if source["subject"]:
+        parts.append(_or_criteria([f'SUBJECT "{keyword}"' for keyword in source["subject"]]))
+    return f"({' '.join(parts)})"
+
+
+def _as_text(value) -> str:
+    """แปลงค่าจาก BODYSTRUCTURE (str, bytes หรือ NIL) เป็นข้อความ"""
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def _structure_params(params) -> Dict[str, str]:
+    """แปลงรายการพารามิเตอร์ ("CHARSET" "UTF-8" ...) เป็น dict"""
+    if not isinstance(params, list):
+        return {}
+    return {_as_text(params[i]).lower(): _as_text(params[i + 1]) for i in range(0, len(params) - 1, 2)}
+
+
+def parse_body_structure(structure: list, prefix: str = "") -> List[Dict[str, Any]]:
+    """แยก BODYSTRUCTURE ออกเป็นรายการส่วนย่อย (section, ชนิด, charset, encoding, ชื่อไฟล์)"""
+    if not isinstance(structure, list) or not structure:
+        return []
+    
+    # multipart: ส่วนย่อยเป็นรายการที่อยู่ต้นรายการจนถึงชนิดย่อย (RFC 3501)
+    # รายการหลังชนิดย่อยเป็นข้อมูลเพิ่มเติม เช่น พารามิเตอร์ หรือ disposition ไม่ใช่ส่วนย่อย
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(itertools.takewhile(lambda item: isinstance(item, list), structure)):
+            parts.extend(parse_body_structure(child, f"{prefix}{index + 1}."))
+        return parts
+    
+    if len(structure) < 7:
+        return []
+    
+    maintype = _as_text(structure[0]).lower()
+    subtype = _as_text(structure[1]).lower()
+    params = _structure_params(structure[2])
+    
+    # ตำแหน่งของ disposition ขึ้นกับชนิดของส่วนนั้น (text มีจำนวนบรรทัด
+    # message/rfc822 มี envelope, body และจำนวนบรรทัดต่อท้ายฟิลด์พื้นฐาน ก่อนถึง md5)
+    if maintype == "text":
+        disposition_index = 9
+    elif maintype == "message" and subtype == "rfc822":
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_type = ""
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _as_text(disposition[0]).lower()
+        disposition_params = _structure_params(disposition[1] if len(disposition) > 1 else None)
+    
+    size = _as_text(structure[6])
+    return [{
+        "section": prefix.rstrip(".") or "1",
+        "content_type": f"{maintype}/{subtype}",
+        "charset": params.get("charset") or "utf-8",
+        "encoding": _as_text(structure[5]).lower(),
+        "size": int(size) if size.isdigit() else 0,
+        "disposition": disposition_type,
+        "filename": disposition_params.get("filename") or params.get("name") or ""
+    }]
+
+
+def decode_part_payload(data: bytes, encoding: str) -> bytes:
+    """ถอดรหัส Content-Transfer-Encoding ของส่วนย่อย"""
+    if encoding == "base64":
+        return base64.b64decode(data)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_payload_stream(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """ถอดรหัส Content-Transfer-Encoding ทีละส่วน โดยเก็บเศษที่ยังถอดรหัสไม่ได้ไว้รวมกับส่วนถัดไป"""
+    remainder = b""
+    for chunk in chunks:
+        if encoding == "base64":
+            data = remainder + re.sub(rb"\s+", b"", chunk)
+            usable = len(data) - len(data) % 4
+            remainder = data[usable:]
+            if usable:
+                yield base64.b64decode(data[:usable])
+        elif encoding == "quoted-printable":
+            data = remainder + chunk
+            # ถอดรหัสเฉพาะบรรทัดที่สมบูรณ์ เพราะ soft line break อาจถูกตัดกลางคัน
+            cut = data.rfind(b"\n") + 1
+            remainder = data[cut:]
+            if cut:
+                yield quopri.decodestring(data[:cut])
+        else:
+            yield chunk
+    
+    if remainder:
+        yield decode_part_payload(remainder, encoding)
+
+
+def _covers(general_terms: List[str], specific_terms: List[str]) -> bool:
+    """ตรวจสอบว่าเงื่อนไขชุดแรกครอบคลุมชุดที่สองทั้งหมด (SEARCH ของ IMAP เป็นการค้นหาแบบ substring)"""
+    if not general_terms:
+        return True
+    if not specific_terms:
+        return False
+    return all(any(general.lower() in specific.lower() for general in general_terms) for specific in specific_terms)
+
+
+def compile_search_criteria(sources: List[Dict[str, Any]]) -> str:
+    """รวมแหล่งที่มาทั้งหมดเป็นเงื่อนไข OR เดียว โดยตัดแหล่งที่ถูกแหล่งอื่นครอบคลุมอยู่แล้วออก"""
+    minimal_sources = []
+    for index, source in enumerate(sources):
+        covered = any(
+            _covers(other["from"], source["from"]) and _covers(other["subject"], source["subject"])
+            # ถ้าครอบคลุมกันและกัน ให้เก็บแหล่งแรกไว้
+            and not (index < other_index and _covers(source["from"], other["from"]) and _covers(source["subject"], other["subject"]))
+            for other_index, other in enumerate(sources)
+            if other_index != index
+        )
+        if not covered:
+            minimal_sources.append(source)
+    
+    return _or_criteria([build_source_criteria(source) for source in minimal_sources])
+
+
+def receipt_search_criteria() -> str:
+    """เงื่อนไข SEARCH ของทุกแหล่งใบเสร็จจากเทมเพลตของผู้ให้บริการ (สร้างครั้งเดียวต่อชุดเทมเพลต)"""
+    catalog = vendor_templates.catalog()
+    if catalog.search_criteria is None:
+        catalog.search_criteria = compile_search_criteria(catalog.sources)
+    return catalog.search_criteria
+
+
+def expand_uid_set(uid_set: str) -> List[int]:
+    """แปลงช่วง UID เช่น 101:103,155 เป็นรายการ UID"""
+    uids = []
+    for part in uid_set.split(","):
+        if ":" in part:
+            start, end = sorted(int(value) for value in part.split(":"))
+            uids.extend(range(start, end + 1))
+        elif part:
+            uids.append(int(part))
+    return uids
+
+
+def parse_esearch_response(data: list) -> List[int]:
+    """แยก UID จากคำตอบ ESEARCH เช่น (TAG "A1") UID ALL 101:140,155"""
+    for item in data or []:
+        if not item:
+            continue
+        match = re.search(rb"\bALL\s+([\d:,]+)", item if isinstance(item, bytes) else item.encode())
+        if match:
+            return expand_uid_set(match.group(1).decode())
+    return []
+
+
+def quote_mailbox(name: str) -> str:
+    """ใส่เครื่องหมายคำพูดให้ชื่อโฟลเดอร์ (imaplib ส่งชื่อตามที่ได้รับ ชื่อที่มีช่องว่าง เช่น [Gmail]/All Mail จะผิดรูปแบบ)"""
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def parse_vanished_response(data: list) -> List[int]:
+    """แยก UID จากคำตอบ VANISHED เช่น (EARLIER) 101:103,155 (RFC 7162)"""
+    uids = []
+    for item in data or []:
+        if not item:
+            continue
+        item = item.decode() if isinstance(item, bytes) else item
+        uids.extend(expand_uid_set(item.replace("(EARLIER)", "").strip()))
+    return uids
+
+
+def build_search_query(days: int = 30, search_criteria: str = None, since_uid: int = 0) -> str:
+    """สร้างเงื่อนไข UID SEARCH ที่รวมช่วงเวลา (หรือช่วง UID) กับเงื่อนไขของทุกแหล่งใบเสร็จ"""
+    # คำนวณวันที่ย้อนหลัง (ถ้ากำหนด days > 0)
+    # ถ้าเป็นการซิงค์แบบ incremental ให้ใช้ช่วง UID แทนวันที่
+    date_criteria = None
+    if since_uid > 0:
+        date_criteria = f"UID {since_uid + 1}:*"
+        logger.info(f"ค้นหาอีเมลที่มี UID มากกว่า {since_uid}")
+    elif days > 0:
+        from datetime import datetime, timedelta
+        since_date = (datetime.now() - timedelta(days=days)).strftime("%d-%b-%Y")
+        date_criteria = f'SINCE "{since_date}"'
+        logger.info(f"ค้นหาอีเมลตั้งแต่วันที่: {since_date}")
+    
+    # รวมทุกแหล่งเป็นเงื่อนไข OR เดียว แล้วค้นหาครั้งเดียวต่อโฟลเดอร์
+    source_criteria = search_criteria or receipt_search_criteria()
+    if date_criteria:
+        return f"({date_criteria} {source_criteria})"
+    return source_criteria
+
+
+def select_search_results(all_message_ids: list, since_uid: int = 0, limit: int = 50) -> List[int]:
+    """กรอง เรียงลำดับ และจำกัดจำนวน UID ที่ได้จากการค้นหา"""
+    # ตรวจสอบว่ามีข้อมูลหรือไม่
+    if not all_message_ids:
+        logger.warning("ไม่พบอีเมลที่ตรงกับเงื่อนไขทั้งหมด")
+        return []
+    
+    # ช่วง "n:*" จะคืน UID สุดท้ายเสมอแม้จะน้อยกว่า n จึงต้องกรองออก
+    all_message_ids = [id for id in all_message_ids if int(id) > since_uid]
+    
+    # เรียงลำดับและตัดซ้ำ (เรียงจากใหม่ไปเก่า)
+    # สำหรับ incremental ให้เรียงจากเก่าไปใหม่ เพื่อให้ UID ล่าสุดขยับต่อเนื่องเมื่อถูกจำกัดจำนวน
+    unique_ids = sorted(set(all_message_ids), key=int, reverse=since_uid == 0)
+    
+    # จำกัดจำนวนตามที่กำหนด
+    if limit > 0 and len(unique_ids) > limit:
+        unique_ids = unique_ids[:limit]
+        logger.info(f"จำกัดการประมวลผลเพียง {limit} ฉบับ")
+    
+    logger.info(f"รวมพบอีเมลทั้งหมด {len(unique_ids)} รายการหลังจากตัดซ้ำและจำกัดจำนวน")
+    return [int(id) for id in unique_ids]
+
+
+def classify_receipt_headers(header_data: Dict[str, Any]) -> Optional[str]:
+    """ตรวจสอบจากผู้ส่งและหัวข้อว่าน่าจะเป็นใบเสร็จหรือไม่ คืนค่าชื่อแหล่งที่ตรงกัน"""
+    from_email = (header_data.get("from") or "").lower()
+    subject = (header_data.get("subject") or "").lower()
+    catalog = vendor_templates.catalog()
+    
+    # ผู้ส่งที่มีอีเมลการตลาดปนต้องมีคำบ่งบอกในหัวข้อ
+    # (ใช้กับแหล่งที่ระบุเฉพาะผู้ส่ง แหล่งที่ระบุคำในหัวข้อไว้แล้วไม่ต้องตรวจซ้ำ)
+    hints_ok = all(
+        any(hint.lower() in subject for hint in hints)
+        for domain, hints in catalog.subject_hints.items() if domain in from_email
+    )
+    
+    for source in catalog.sources:
+        if source["from"] and not any(domain in from_email for domain in source["from"]):
+            continue
+        if source["subject"]:
+            if not any(keyword.lower() in subject for keyword in source["subject"]):
+                continue
+        elif not hints_ok:
+            continue
+        return source["name"]
+    
+    return None
+
+
+def decode_mime_header(header: str) -> str:
+    """ถอดรหัสหัวข้ออีเมล"""
+    try:
+        decoded_headers = decode_header(header)
+        header_parts = []
+        for decoded_text, charset in decoded_headers:
+            if isinstance(decoded_text, bytes):
+                charset = charset or 'utf-8'
+                decoded_text = decoded_text.decode(charset, errors='replace')
+            header_parts.append(decoded_text)
+        return ''.join(header_parts)
+
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการถอดรหัสหัวข้อ: {str(e)}")
+        return header
+
+
+def parse_email_date(date_str: str) -> Optional[datetime]:
+    """แปลงสตริงวันที่เป็น datetime"""
+    try:
+        if not date_str:
+            return None
+        return parsedate_to_datetime(date_str)
+
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการแปลงวันที่ {date_str}: {str(e)}")
+        return None
+
+
+def is_text_part(part: Dict[str, Any]) -> bool:
+    """ส่วนเนื้อหาที่ใช้แยกข้อมูลใบเสร็จ (ไม่รวมไฟล์แนบ)"""
+    return part["content_type"] in ["text/plain", "text/html"] and part["disposition"] != "attachment"
+
+
+def is_attachment_part(part: Dict[str, Any]) -> bool:
+    """ไฟล์แนบที่อาจเป็นใบเสร็จ (รูปภาพหรือ PDF)"""
+    filename = part["filename"]
+    if not filename:
+        return False
+    return (part["content_type"].startswith("image/") or
+            part["content_type"] == "application/pdf" or
+            filename.lower().endswith(('.pdf', '.jpg', '.jpeg', '.png')))
+
+
+def attachment_parts(header_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """ข้อมูลไฟล์แนบจาก BODYSTRUCTURE สำหรับดึงเนื้อหาภายหลัง"""
+    return [
+        {
+            "filename": decode_mime_header(part["filename"]),
+            "content_type": part["content_type"],
+            "section": part["section"],
+            "encoding": part["encoding"],
+            "size": part["size"]
+        }
+        for part in header_data["parts"] if is_attachment_part(part)
+    ]
+
+
+def parse_header_data(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """แยก header ขนาด และ BODYSTRUCTURE จากผลของ FETCH หนึ่งฉบับ"""
+    header_bytes = next((value for key, value in message.items() if key.startswith("BODY[HEADER")), None)
+    if not isinstance(header_bytes, bytes):
+        return None
+    msg = email.message_from_bytes(header_bytes)
+    return {
+        "message_id": message["UID"],
+        "subject": decode_mime_header(msg["Subject"]) if msg["Subject"] else "",
+        "from": decode_mime_header(msg["From"]) if msg["From"] else "",
+        "date": parse_email_date(msg["Date"] or ""),
+        "message_id_header": (msg["Message-ID"] or "").strip(),
+        "header_raw": header_bytes,
+        "size": message.get("RFC822.SIZE", 0),
+        "parts": parse_body_structure(message.get("BODYSTRUCTURE"))
+    }
+
+
+def plan_text_fetches(header_datas: List[Dict[str, Any]], chunk_size: int = None) -> Iterator[tuple]:
+    """แบ่งอีเมลเป็นชุดสำหรับ UID FETCH คืนค่า ({UID: header_data}, รายการที่จะดึง)"""
+    chunk_size = chunk_size or settings.IMAP_FETCH_BATCH_SIZE
+    
+    # จัดกลุ่มอีเมลที่ต้องดึง section เดียวกัน เพื่อให้ดึงได้ในคำสั่งเดียว
+    groups = {}
+    fallback = {}
+    for header_data in header_datas:
+        text_parts = [part for part in header_data["parts"] if is_text_part(part)]
+        if not text_parts:
+            fallback[header_data["message_id"]] = header_data
+            continue
+        sections = tuple(part["section"] for part in text_parts)
+        groups.setdefault(sections, []).append(header_data)
+    
+    for sections, group in groups.items():
+        items = " ".join(f"BODY.PEEK[{section}]" for section in sections)
+        for start in range(0, len(group), chunk_size):
+            chunk = {header_data["message_id"]: header_data for header_data in group[start:start + chunk_size]}
+            yield chunk, f"(UID {items})"
+    
+    # อีเมลที่อ่าน BODYSTRUCTURE ไม่ได้ ให้ดึงแบบเต็ม
+    fallback_ids = sorted(fallback)
+    for start in range(0, len(fallback_ids), chunk_size):
+        yield {uid: fallback[uid] for uid in fallback_ids[start:start + chunk_size]}, "(UID RFC822)"
+
+
+def _message_text_parts(msg) -> List[Tuple[str, str]]:
+    """ดึงเนื้อหาข้อความ คืนค่า [(content_type, เนื้อหา)] ตามลำดับในอีเมล"""
+    text_parts = []
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_maintype() == 'multipart':
+                continue
+                
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition"))
+
+            if "attachment" in content_disposition:
+                continue
+
+            if content_type in ["text/plain", "text/html"]:
+                try:
+                    payload = part.get_payload(decode=True)
+                    charset = part.get_content_charset() or 'utf-8'
+                    text_parts.append((content_type, payload.decode(charset, errors='replace')))
+                except Exception as e:
+                    logger.error(f"เกิดข้อผิดพลาดในการอ่านเนื้อหาอีเมล: {str(e)}")
+    else:
+        content_type = msg.get_content_type()
+        if content_type in ["text/plain", "text/html"]:
+            try:
+                payload = msg.get_payload(decode=True)
+                charset = msg.get_content_charset() or 'utf-8'
+                text_parts.append((content_type, payload.decode(charset, errors='replace')))
+            except Exception as e:
+                logger.error(f"เกิดข้อผิดพลาดในการอ่านเนื้อหาอีเมล: {str(e)}")
+
+    return text_parts
+
+
+def _message_attachments(msg) -> List[Dict[str, Any]]:
+    """ดึงไฟล์แนบ"""
+    attachments = []
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+
+        filename = part.get_filename()
+        if not filename:
+            continue
+
+        filename = decode_mime_header(filename)
+        content_type = part.get_content_type()
+
+        if (content_type.startswith('image/') or 
+            content_type == 'application/pdf' or 
+            filename.lower().endswith(('.pdf', '.jpg', '.jpeg', '.png'))):
+
+            attachments.append({
+                "filename": filename,
+                "content_type": content_type,
+                "content": part.get_payload(decode=True)
+            })
+
+    return attachments
+
+
+def parse_email(message_id: int, raw_email: bytes) -> Optional[Dict[str, Any]]:
+    """แยกข้อมูลอีเมลจากข้อมูลดิบ RFC822"""
+    try:
+        msg = email.message_from_bytes(raw_email)
+        
+        # แยกข้อมูลพื้นฐาน
+        subject = decode_mime_header(msg["Subject"]) if msg["Subject"] else ""
+        from_email = decode_mime_header(msg["From"]) if msg["From"] else ""
+        date_str = msg["Date"] if msg["Date"] else ""
+        date = parse_email_date(date_str)
+        
+        # ดึงเนื้อหาและไฟล์แนบ
+        text_parts = _message_text_parts(msg)
+        attachments = _message_attachments(msg)
+
+        return {
+            "message_id": message_id,
+            "subject": subject,
+            "from": from_email,
+            "date": date,
+            "message_id_header": (msg["Message-ID"] or "").strip(),
+            "body": "".join(content for _, content in text_parts),
+            "text": build_email_text(text_parts),
+            "attachments": attachments
+        }
+
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {message_id}: {str(e)}")
+        return None
+
+
+def _email_data_from_parts(header_data: Dict[str, Any], message: Dict[str, Any]) -> Dict[str, Any]:
+    """รวม header และส่วนเนื้อหาที่ดึงมาเป็นข้อมูลอีเมลรูปแบบเดียวกับ get_email"""
+    text_parts = []
+    for part in header_data["parts"]:
+        content = message.get(f"BODY[{part['section']}]")
+        if not is_text_part(part) or not isinstance(content, bytes):
+            continue
+        try:
+            payload = decode_part_payload(content, part["encoding"])
+            text_parts.append((part["content_type"], payload.decode(part["charset"], errors="replace")))
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการอ่านเนื้อหาอีเมล: {str(e)}")
+    
+    return {
+        "message_id": header_data["message_id"],
+        "subject": header_data["subject"],
+        "from": header_data["from"],
+        "date": header_data["date"],
+        "message_id_header": header_data["message_id_header"],
+        "body": "".join(content for _, content in text_parts),
+        "text": build_email_text(text_parts),
+        "attachments": attachment_parts(header_data)
+    }
+
+
+def build_email_data(header_data: Dict[str, Any], message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """สร้างข้อมูลอีเมลจากผลของ fetch_raw_text_parts (ไม่ต้องใช้การเชื่อมต่อ)"""
+    if isinstance(message.get("RFC822"), bytes):
+        email_data = parse_email(message["UID"], message["RFC822"])
+        if email_data and message.get("CACHED") and header_data.get("parts"):
+            # อีเมลจากแคชไม่มีเนื้อหาไฟล์แนบ ให้ดึงไฟล์แนบจากเซิร์ฟเวอร์ตาม BODYSTRUCTURE
+            email_data["attachments"] = attachment_parts(header_data)
+        return email_data
+    return _email_data_from_parts(header_data, message)
+
+
+def build_rfc822(header_data: Dict[str, Any], message: Dict[str, Any]) -> bytes:
+    """สร้างอีเมลรูปแบบ RFC822 จาก header และส่วนข้อความที่ดึงมา สำหรับเก็บในแคช
+    (ไฟล์แนบเก็บเพียงชื่อไฟล์และชนิดไฟล์ ส่วนเนื้อหาอยู่ในที่เก็บไฟล์แนบ)"""
+    if isinstance(message.get("RFC822"), bytes):
+        return message["RFC822"]
+    
+    boundary = f"=_cached_{header_data['message_id']}"
+    lines = [
+        header_data["header_raw"].rstrip(b"\r\n"),
+        b"MIME-Version: 1.0",
+        f'Content-Type: multipart/mixed; boundary="{boundary}"'.encode("ascii"),
+        b""
+    ]
+    for part in header_data["parts"]:
+        content = message.get(f"BODY[{part['section']}]")
+        if is_text_part(part) and isinstance(content, bytes):
+            part_headers = [
+                f'Content-Type: {part["content_type"]}; charset="{part["charset"]}"',
+                f"Content-Transfer-Encoding: {part['encoding'] or '7bit'}"
+            ]
+        elif is_attachment_part(part):
+            filename = _as_text(part["filename"]).replace('"', "")
+            part_headers = [
+                f"Content-Type: {part['content_type']}",
+                f'Content-Disposition: attachment; filename="{filename}"'
+            ]
+            content = b""
+        else:
+            continue
+        lines.append(f"--{boundary}".encode("ascii"))
+        lines.extend(header.encode("utf-8") for header in part_headers)
+        lines.extend([b"", content])
+    lines.append(f"--{boundary}--".encode("ascii"))
+    return b"\r\n".join(lines) + b"\r\n"
+
+
+def store_attachment(message_id: int, attachment: Dict[str, Any], imap_client: "IMAPClient" = None) -> Optional[Dict[str, Any]]:
+    """บันทึกไฟล์แนบลงที่เก็บไฟล์แบบสตรีม คืนค่าตำแหน่งไฟล์ ชื่อไฟล์ และชนิดไฟล์
+    (ไฟล์แนบที่ยังไม่มีเนื้อหาจะดึงผ่าน imap_client ที่เลือกโฟลเดอร์ไว้แล้ว)"""
+    try:
+        if "content" in attachment:
+            # อีเมลที่ดึงแบบเต็มมีเนื้อหาไฟล์แนบอยู่แล้ว
+            chunks = [attachment["content"] or b""]
+        else:
+            chunks = imap_client.iter_attachment_chunks(message_id, attachment)
+        stored = attachment_store.put_stream(chunks)
+        return {
+            "receipt_file_path": stored["path"],
+            "receipt_file_name": attachment["filename"],
+            "receipt_file_type": attachment["content_type"]
+        }
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในการบันทึกไฟล์แนบ {message_id}: {str(e)}")
+        return None
+
 
 class IMAPClient:
     def __init__(self, imap_setting: ImapSetting):
         self.imap_setting = imap_setting
         self.connection = None
+        self.uid_validity = None
+        self.folder = None
+        self.highest_modseq = None
+        self.vanished = None
+        self.qresync_enabled = False
+        self.compression_enabled = False
+        # ข้อมูลสำหรับ pool การเชื่อมต่อ (เวลาที่ล็อกอิน และค่าที่ใช้เชื่อมต่อ)
+        self.connected_at = None
+        self.pool_key = None
 
     def connect(self) -> bool:
         """เชื่อมต่อกับเซิร์ฟเวอร์ IMAP"""
         try:
             # ถอดรหัสรหัสผ่าน
-            decrypted_password = decrypt_password(self.imap_setting.password_encrypted)
+            decrypted_password = decrypt_password_cached(self.imap_setting.password_encrypted)
             
             # เชื่อมต่อกับเซิร์ฟเวอร์
             if self.imap_setting.use_ssl:
-                self.connection = imaplib.IMAP4_SSL(self.imap_setting.server, self.imap_setting.port)
+                self.connection = DeflateIMAP4_SSL(self.imap_setting.server, self.imap_setting.port, timeout=settings.IMAP_TIMEOUT)
             else:
-                self.connection = imaplib.IMAP4(self.imap_setting.server, self.imap_setting.port)
+                self.connection = DeflateIMAP4(self.imap_setting.server, self.imap_setting.port, timeout=settings.IMAP_TIMEOUT)
             
             # ล็อกอิน
             self.connection.login(self.imap_setting.username, decrypted_password)
+            self.connected_at = time.monotonic()
             logger.info(f"เชื่อมต่อกับ IMAP สำเร็จ: {self.imap_setting.email}")
+            
+            # เซิร์ฟเวอร์บางรายแจ้งความสามารถเพิ่มเติมหลังล็อกอิน
+            status, data = self.connection.capability()
+            if status == "OK" and data and data[0]:
+                self.connection.capabilities = tuple(data[0].decode().upper().split())
+            
+            # ENABLE ใช้ได้ก่อน SELECT เท่านั้น (RFC 5161) จึงเปิด QRESYNC ตั้งแต่ล็อกอิน
+            if self.has_capability("QRESYNC") and self.has_capability("ENABLE"):
+                status, _ = self.connection.enable("QRESYNC")
+                self.qresync_enabled = status == "OK"
+            
+            # บีบอัดข้อมูลที่รับส่ง (RFC 4978) อีเมลใบเสร็จส่วนใหญ่เป็น HTML จึงลดปริมาณข้อมูลได้มาก
+            if settings.IMAP_COMPRESS and self.has_capability("COMPRESS=DEFLATE"):
+                self.compression_enabled = self.connection.compress_deflate(settings.IMAP_COMPRESS_LEVEL)
             return True
 
         except Exception as e:
@@ -52,483 +734,190 @@ class IMAPClient:
             except:
                 pass
 
-    def search_emails(self, days: int = 30, limit: int = 50, search_criteria: str = None) -> List[int]:
-        """วันและจำนวนเมลจะค้นหา"""
+    def has_capability(self, capability: str) -> bool:
+        """ตรวจสอบว่าเซิร์ฟเวอร์รองรับความสามารถที่ระบุหรือไม่"""
+        return bool(self.connection) and capability.upper() in self.connection.capabilities
+
+    def transfer_counters(self) -> Dict[str, int]:
+        """จำนวนไบต์ที่รับส่งตั้งแต่เชื่อมต่อ (bytes คือข้อมูลก่อนบีบอัด wire_bytes คือที่ส่งผ่านเครือข่ายจริง)"""
+        connection = self.connection
+        return {
+            "bytes": getattr(connection, "bytes_received", 0) + getattr(connection, "bytes_sent", 0),
+            "wire_bytes": getattr(connection, "wire_bytes_received", 0) + getattr(connection, "wire_bytes_sent", 0)
+        }
+
+    def noop(self) -> bool:
+        """ส่ง NOOP เพื่อตรวจว่าการเชื่อมต่อยังใช้งานได้"""
+        try:
+            status, _ = self.connection.noop()
+            return status == "OK"
+        except Exception:
+            return False
+
+    def select_folder(self, qresync: tuple = None, folder: str = None) -> Optional[int]:
+        """เลือกโฟลเดอร์และคืนค่า UIDVALIDITY ของโฟลเดอร์ (ถ้าไม่ระบุ folder จะใช้โฟลเดอร์ที่เลือกไว้ หรือโฟลเดอร์หลัก)
+        ถ้าระบุ qresync = (uid_validity, modseq, uid ที่ต้องการตรวจ) และเซิร์ฟเวอร์รองรับ QRESYNC
+        จะได้รายการ UID ที่ถูกลบไปตั้งแต่ modseq นั้นมาพร้อมกันใน self.vanished"""
+        self.folder = folder or self.folder or self.imap_setting.folder
+        self.uid_validity = None
+        self.vanished = None
+        if qresync and self.qresync_enabled:
+            status, data = self._select_qresync(*qresync)
+        else:
+            status, data = self.connection.select(quote_mailbox(self.folder))
+        if status != "OK":
+            logger.error(f"ไม่สามารถเลือกโฟลเดอร์ {self.folder}: {data}")
+            return None
+        
+        _, uid_validity = self.connection.response("UIDVALIDITY")
+        if uid_validity and uid_validity[0]:
+            self.uid_validity = int(uid_validity[0])
+        
+        # เซิร์ฟเวอร์ที่รองรับ CONDSTORE จะแจ้ง HIGHESTMODSEQ (หรือ NOMODSEQ ถ้าโฟลเดอร์ไม่รองรับ)
+        _, highest_modseq = self.connection.response("HIGHESTMODSEQ")
+        self.highest_modseq = int(highest_modseq[0]) if highest_modseq and highest_modseq[0] else None
+        
+        return self.uid_validity
+
+    def _select_qresync(self, uid_validity: int, modseq: int, known_uids: List[int] = None) -> tuple:
+        """SELECT พร้อมพารามิเตอร์ QRESYNC (RFC 7162) เพื่อขอ UID ที่ถูกลบตั้งแต่ modseq ที่ระบุ"""
+        params = f"{uid_validity} {modseq}"
+        if known_uids:
+            # จำกัดให้เซิร์ฟเวอร์แจ้งเฉพาะ UID ที่เรามีใบเสร็จอยู่
+            params += f" {compress_uid_set(known_uids)}"
+        
+        # imaplib ไม่รองรับพารามิเตอร์ของ SELECT จึงส่งคำสั่งเองแล้วตั้งสถานะแบบเดียวกับ select()
+        self.connection.untagged_responses = {}
+        status, data = self.connection.xatom("SELECT", quote_mailbox(self.folder), f"(QRESYNC ({params}))")
+        if status == "OK":
+            self.connection.state = "SELECTED"
+            _, vanished = self.connection.response("VANISHED")
+            self.vanished = parse_vanished_response(vanished)
+            # คำตอบ FETCH ของอีเมลที่ flag เปลี่ยนไม่ได้ใช้
+            self.connection.response("FETCH")
+        return status, data
+
+    def search_existing_uids(self, uids: List[int]) -> List[int]:
+        """คืนค่า UID ในรายการที่ยังอยู่ในโฟลเดอร์ (ใช้เมื่อเซิร์ฟเวอร์รองรับ CONDSTORE แต่ไม่มี QRESYNC)"""
+        if not uids:
+            return []
+        return [int(uid) for uid in self._uid_search(f"UID {compress_uid_set(uids)}")]
+
+    def search_emails(self, days: int = 30, limit: int = 50, search_criteria: str = None, since_uid: int = 0,
+                      select: bool = True) -> List[int]:
+        """ค้นหา UID ของอีเมล ถ้าระบุ since_uid จะค้นหาเฉพาะอีเมลที่ใหม่กว่า UID นั้น
+        ถ้า select=False จะค้นหาในโฟลเดอร์ที่เลือกไว้แล้วโดยไม่ส่ง SELECT ซ้ำ"""
         try:
             # เลือกโฟลเดอร์
-            self.connection.select(self.imap_setting.folder)
-            
-            # คำนวณวันที่ย้อนหลัง (ถ้ากำหนด days > 0)
-            date_criteria = None
-            if days > 0:
-                from datetime import datetime, timedelta
-                since_date = (datetime.now() - timedelta(days=days)).strftime("%d-%b-%Y")
-                date_criteria = f'SINCE "{since_date}"'
-                logger.info(f"ค้นหาอีเมลตั้งแต่วันที่: {since_date}")
+            if select:
+                self.select_folder()
             
-            # สร้างตัวแปรสำหรับเก็บ message IDs
-            all_message_ids = []
+            combined_criteria = build_search_query(days, search_criteria, since_uid)
+            logger.info(f"ค้นหาอีเมลด้วยเงื่อนไข: {combined_criteria}")
+            all_message_ids = self._uid_search(combined_criteria)
             
-            # ค้นหาแยกตามผู้ให้บริการและรวมผล
-            sources = [
-                # [ชื่อแหล่ง, เงื่อนไขการค้นหา]
-                ["Apple", '(FROM "apple.com" SUBJECT "invoice")'],
-                ["Steam", '(FROM "steampowered.com")'],
-                ["Steam Order", '(FROM "steampowered.com" SUBJECT "order")'],
-                ["Steam Purchase", '(FROM "steampowered.com" SUBJECT "purchase")'],
-                ["Steam Receipt", '(FROM "steampowered.com" SUBJECT "receipt")'],
-                ["Steam Support", '(SUBJECT "Steam Support")'],
-                ["Kasikornbank", '(FROM "kasikornbank.com")'],
-                ["Spotify", '(FROM "spotify.com")'],
-                ["Spotify Receipt", '(FROM "spotify.com" SUBJECT "receipt")'],
-                ["Spotify Premium", '(FROM "spotify.com" SUBJECT "Premium")'],
-                ["Netflix", '(FROM "netflix.com")'],
-                ["YouTube", '(FROM "youtube.com" OR FROM "google.com" SUBJECT "receipt")']
-            ]
-            
-            for source_name, source_criteria in sources:
-                # รวมเงื่อนไขวันที่ (ถ้ามี)
-                if date_criteria:
-                    combined_criteria = f'({source_criteria} {date_criteria})'
-                else:
-                    combined_criteria = source_criteria
-                
-                logger.info(f"ค้นหาอีเมลจาก {source_name} ด้วยเงื่อนไข: {combined_criteria}")
-                status, data = self.connection.search(None, combined_criteria)
-                
-                if status == "OK" and data[0]:
-                    ids = data[0].split()
-                    all_message_ids.extend(ids)
-                    logger.info(f"พบอีเมลจาก {source_name} {len(ids)} รายการ")
-            
-            # ตรวจสอบว่ามีข้อมูลหรือไม่
-            if not all_message_ids:
-                logger.warning("ไม่พบอีเมลที่ตรงกับเงื่อนไขทั้งหมด")
-                return []
-            
-            # เรียงลำดับและตัดซ้ำ (เรียงจากใหม่ไปเก่า)
-            unique_ids = sorted(set(all_message_ids), key=int, reverse=True)
-            
-            # จำกัดจำนวนตามที่กำหนด
-            if limit > 0 and len(unique_ids) > limit:
-                unique_ids = unique_ids[:limit]
-                logger.info(f"จำกัดการประมวลผลเพียง {limit} ฉบับล่าสุด")
-            
-            logger.info(f"รวมพบอีเมลทั้งหมด {len(unique_ids)} รายการหลังจากตัดซ้ำและจำกัดจำนวน")
-            return [int(id) for id in unique_ids]
+            return select_search_results(all_message_ids, since_uid, limit)
         
         except Exception as e:
             logger.error(f"เกิดข้อผิดพลาดในการค้นหาอีเมล: {str(e)}")
             import traceback
             logger.error(f"รายละเอียดข้อผิดพลาด: {traceback.format_exc()}")
             return []
-    
-    
 
-    def get_email(self, message_id: int) -> Optional[Dict[str, Any]]:
-        """ดึงข้อมูลอีเมล"""
-        try:
-            status, data = self.connection.fetch(str(message_id), "(RFC822)")
-            if status != "OK":
-                logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {message_id}: {status}")
-                return None
-
-            msg = email.message_from_bytes(data[0][1])
-            
-            # แยกข้อมูลพื้นฐาน
-            subject = self._decode_header(msg["Subject"]) if msg["Subject"] else ""
-            from_email = self._decode_header(msg["From"]) if msg["From"] else ""
-            date_str = msg["Date"] if msg["Date"] else ""
-            date = self._parse_date(date_str)
-            
-            # ดึงเนื้อหาและไฟล์แนบ
-            body = self._get_email_body(msg)
-            attachments = self._get_attachments(msg)
-
-            return {
-                "message_id": message_id,
-                "subject": subject,
-                "from": from_email,
-                "date": date,
-                "body": body,
-                "attachments": attachments
-            }
-
-        except Exception as e:
-            logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {message_id}: {str(e)}")
-            return None
-
-    def _decode_header(self, header: str) -> str:
-        """ถอดรหัสหัวข้ออีเมล"""
-        try:
-            decoded_headers = decode_header(header)
-            header_parts = []
-            for decoded_text, charset in decoded_headers:
-                if isinstance(decoded_text, bytes):
-                    charset = charset or 'utf-8'
-                    decoded_text = decoded_text.decode(charset, errors='replace')
-                header_parts.append(decoded_text)
-            return ''.join(header_parts)
-
-        except Exception as e:
-            logger.error(f"เกิดข้อผิดพลาดในการถอดรหัสหัวข้อ: {str(e)}")
-            return header
+    def _uid_search(self, criteria: str) -> list:
+        """ส่ง UID SEARCH (ใช้ ESEARCH ถ้ารองรับ) และคืนค่า UID ที่พบ"""
+        if self.has_capability("ESEARCH"):
+            # ESEARCH คืนผลเป็นช่วง UID ที่กระชับกว่ารายการเต็ม
+            status, _ = self.connection.uid("SEARCH", "RETURN", "(ALL)", criteria)
+            _, data = self.connection.response("ESEARCH")
+            return parse_esearch_response(data) if status == "OK" else []
+        
+        status, data = self.connection.uid("SEARCH", None, criteria)
+        return data[0].split() if status == "OK" and data[0] else []
 
-    def _parse_date(self, date_str: str) -> Optional[datetime]:
-        """แปลงสตริงวันที่เป็น datetime"""
+    def fetch_headers(self, message_ids: List[int], chunk_size: int = None) -> Iterator[Dict[str, Any]]:
+        """ดึงเฉพาะ header ที่ใช้คัดกรองและขนาดของอีเมล โดยไม่ดาวน์โหลดเนื้อหา"""
+        chunk_size = chunk_size or settings.IMAP_FETCH_BATCH_SIZE
+        uids = sorted(set(int(uid) for uid in message_ids))
+        
+        for start in range(0, len(uids), chunk_size):
+            for message in self._fetch_items(uids[start:start + chunk_size], HEADER_FETCH_ITEMS):
+                header_data = parse_header_data(message)
+                if header_data:
+                    yield header_data
+
+    def fetch_text_parts(self, header_datas: List[Dict[str, Any]], chunk_size: int = None) -> Iterator[Dict[str, Any]]:
+        """ดึงเฉพาะส่วน text/plain และ text/html ตาม BODYSTRUCTURE ส่วนไฟล์แนบจะเก็บเพียงข้อมูลไว้ดึงภายหลัง"""
+        for header_data, message in self.fetch_raw_text_parts(header_datas, chunk_size):
+            email_data = build_email_data(header_data, message)
+            if email_data:
+                yield email_data
+
+    def fetch_raw_text_parts(self, header_datas: List[Dict[str, Any]], chunk_size: int = None) -> Iterator[tuple]:
+        """ดึงส่วนข้อความแบบยังไม่ถอดรหัส คืนค่า (header_data, ข้อมูลจาก FETCH) เพื่อให้แยกวิเคราะห์ที่อื่นได้"""
+        for chunk, items in plan_text_fetches(header_datas, chunk_size):
+            for message in self._fetch_items(chunk.keys(), items):
+                header_data = chunk.get(message["UID"])
+                if header_data:
+                    yield header_data, message
+
+    def _fetch_items(self, message_ids, items: str) -> List[Dict[str, Any]]:
+        """ส่ง UID FETCH หนึ่งครั้งและแยกคำตอบ ถ้าเกิดข้อผิดพลาดจะคืนรายการว่าง"""
+        uid_set = compress_uid_set(message_ids)
         try:
-            if not date_str:
-                return None
-            return parsedate_to_datetime(date_str)
-
+            status, data = self.connection.uid("FETCH", uid_set, items)
+            if status != "OK":
+                logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {uid_set}: {status}")
+                return []
+            return parse_fetch_response(data)
         except Exception as e:
-            logger.error(f"เกิดข้อผิดพลาดในการแปลงวันที่ {date_str}: {str(e)}")
-            return None
-
-    def _get_email_body(self, msg) -> str:
-        """ดึงเนื้อหาข้อความ"""
-        body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                if part.get_content_maintype() == 'multipart':
-                    continue
-                    
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-
-                if "attachment" in content_disposition:
-                    continue
-
-                if content_type in ["text/plain", "text/html"]:
-                    try:
-                        payload = part.get_payload(decode=True)
-                        charset = part.get_content_charset() or 'utf-8'
-                        body += payload.decode(charset, errors='replace')
-                    except Exception as e:
-                        logger.error(f"เกิดข้อผิดพลาดในการอ่านเนื้อหาอีเมล: {str(e)}")
-        else:
-            content_type = msg.get_content_type()
-            if content_type in ["text/plain", "text/html"]:
-                try:
-                    payload = msg.get_payload(decode=True)
-                    charset = msg.get_content_charset() or 'utf-8'
-                    body = payload.decode(charset, errors='replace')
-                except Exception as e:
-                    logger.error(f"เกิดข้อผิดพลาดในการอ่านเนื้อหาอีเมล: {str(e)}")
-
-        return body
-
-    
-    def _get_attachments(self, msg) -> List[Dict[str, Any]]:
-        """ดึงไฟล์แนบ"""
-        attachments = []
-        for part in msg.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-
-            filename = part.get_filename()
-            if not filename:
-                continue
-
-            filename = self._decode_header(filename)
-            content_type = part.get_content_type()
-
-            if (content_type.startswith('image/') or 
-                content_type == 'application/pdf' or 
-                filename.lower().endswith(('.pdf', '.jpg', '.jpeg', '.png'))):
-
-                attachments.append({
-                    "filename": filename,
-                    "content_type": content_type,
-                    "content": part.get_payload(decode=True)
-                })
-
-        return attachments
-
-
-def is_from_domain(email: str, domains: list) -> bool:
-        """ตรวจสอบว่าอีเมลมาจากโดเมนที่ระบุหรือไม่"""
-        email_lower = email.lower()
-        return any(domain in email_lower for domain in domains)    
-
-
-def extract_receipt_info(email_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    """แยกข้อมูลใบเสร็จจากอีเมล"""
-    if not email_data:
-        return None
-    
-    # ข้อมูลพื้นฐาน
-    result = {
-        "email_id": f"imap_{email_data['message_id']}",
-        "email_subject": email_data["subject"],
-        "email_from": email_data["from"],
-        "email_date": email_data["date"],
-        "receipt_date": email_data["date"],
-        "vendor_name": extract_vendor_name(email_data["from"]),
-        "amount": 0.0,
-        "currency": "THB",  # ค่าเริ่มต้น
-        "receipt_file_path": None
-    }
+            logger.error(f"เกิดข้อผิดพลาดในการดึงอีเมล {uid_set}: {str(e)}")
+            return []
 
-    # บันทึกข้อมูลอีเมลเบื้องต้น
-    logger.info(f"กำลังแยกข้อมูลจากอีเมล: {result['email_from']} - {result['email_subject']}")
-    
-    # ตรวจสอบว่าเป็นอีเมลจากผู้ให้บริการใด
-    from_email = email_data["from"].lower()
-    body = email_data["body"]
-    
-    if "apple.com" in from_email:
-        # ใบเสร็จ Apple
-        logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Apple")
-        result["vendor_name"] = "Apple"
-        result["amount"] = extract_amount(body)
-        
-        # ค้นหาวันที่ใบแจ้งหนี้
-        invoice_date_match = re.search(r'INVOICE DATE\s*(\d{1,2}\s+\w+\s+\d{4})', body)
-        if invoice_date_match:
-            date_str = invoice_date_match.group(1)
-            try:
-                receipt_date = datetime.strptime(date_str, '%d %b %Y')
-                result["receipt_date"] = receipt_date
-            except:
-                pass
-    
-    elif "kplus" in from_email or "kasikornbank" in from_email:
-        # ใบเสร็จ K Plus
-        logger.info("ตรวจพบว่าเป็นใบเสร็จจาก K Plus")
-        result["vendor_name"] = "K Plus (Kasikorn Bank)"
-        
-        # ค้นหาจำนวนเงิน
-        amount_match = re.search(r'จำนวนเงิน\s*\(บาท\):\s*([\d,]+\.\d{2})', body)
-        if amount_match:
-            try:
-                amount_str = amount_match.group(1).replace(',', '')
-                result["amount"] = float(amount_str)
-            except ValueError:
-                pass
-        
-        # ค้นหาวันที่ทำรายการ
-        date_match = re.search(r'วันที่ทำรายการ:\s*(\d{2}/\d{2}/\d{4})', body)
-        if date_match:
-            date_str = date_match.group(1)
-            try:
-                receipt_date = datetime.strptime(date_str, '%d/%m/%Y')
-                result["receipt_date"] = receipt_date
-            except:
-                pass
-    
-    elif "steam" in from_email or "steampowered" in from_email:
-        # ใบเสร็จ Steam
-        logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Steam")
-        result["vendor_name"] = "Steam"
-        
-        # ค้นหาจำนวนเงิน (หลายรูปแบบ)
-        # รูปแบบที่ 1: รูปแบบภาษาอังกฤษ
-        baht_match = re.search(r'(?:Total|รวม):\s*฿\s*([\d,]+\.\d{2})', body, re.IGNORECASE)
-        if baht_match:
-            try:
-                amount_str = baht_match.group(1).replace(',', '')
-                result["amount"] = float(amount_str)
-            except ValueError:
-                pass
-        
-        # รูปแบบที่ 2: รูปแบบทั่วไป
-        if result["amount"] == 0:
-            general_match = re.search(r'฿\s*([\d,]+\.\d{2})', body)
-            if general_match:
-                try:
-                    amount_str = general_match.group(1).replace(',', '')
-                    result["amount"] = float(amount_str)
-                except ValueError:
-                    pass
-        
-        # ค้นหาวันที่
-        date_match = re.search(r'Date issued:\s*(.+?)\s*(?:\r|\n|<br>)', body)
-        if date_match:
-            date_str = date_match.group(1).strip()
-            # ลองแปลงวันที่ในรูปแบบต่างๆ
-            try:
-                if '@' in date_str:  # รูปแบบ "23 Jan, 2021 @ 7:40pm"
-                    date_only = date_str.split('@')[0].strip()
-                    receipt_date = datetime.strptime(date_only, '%d %b, %Y')
-                    result["receipt_date"] = receipt_date
-            except:
-                pass
-    
-    elif is_from_domain(from_email, ["spotify.com", "spotify.co.th", "spotify-email.com"]):
-        # ใบเสร็จ Spotify
-        logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Spotify")
-        result["vendor_name"] = "Spotify"
-        
-        # บันทึกตัวอย่างเนื้อหาเพื่อการดีบัก
-        logger.info(f"ตัวอย่างเนื้อหาอีเมล Spotify: {body[:500]}")
-        
-        # ค้นหาจำนวนเงินในหลายรูปแบบ
-        amount = 0.0
-        
-        # รูปแบบที่ 1: รูปแบบทั้งหมด
-        amount_match = re.search(r'ทั้งหมด\s*฿\s*([\d,]+\.\d{2})', body)
-        if amount_match:
-            try:
-                amount_str = amount_match.group(1).replace(',', '')
-                amount = float(amount_str)
-                logger.info(f"พบจำนวนเงินรูปแบบที่ 1: {amount}")
-            except ValueError:
-                pass
-        
-        # รูปแบบที่ 2: รูปแบบ Premium
-        if amount == 0:
-            premium_match = re.search(r'Premium\s*฿\s*([\d,]+\.\d{2})', body)
-            if premium_match:
-                try:
-                    amount_str = premium_match.group(1).replace(',', '')
-                    amount = float(amount_str)
-                    logger.info(f"พบจำนวนเงินรูปแบบที่ 2: {amount}")
-                except ValueError:
-                    pass
-        
-        # รูปแบบที่ 3: ค้นหาแบบทั่วไป
-        if amount == 0:
-            general_match = re.search(r'฿\s*([\d,]+\.\d{2})', body)
-            if general_match:
-                try:
-                    amount_str = general_match.group(1).replace(',', '')
-                    amount = float(amount_str)
-                    logger.info(f"พบจำนวนเงินรูปแบบที่ 3: {amount}")
-                except ValueError:
-                    pass
+    def iter_attachment_chunks(self, message_id: int, attachment: Dict[str, Any], chunk_size: int = None) -> Iterator[bytes]:
+        """ดึงไฟล์แนบทีละส่วนด้วย partial fetch (BODY.PEEK[n]<offset.length>) แล้วถอดรหัสทีละส่วน"""
+        chunk_size = chunk_size or settings.ATTACHMENT_CHUNK_SIZE
         
-        # กำหนดค่าจำนวนเงินที่ค้นพบ
-        result["amount"] = amount
+        def raw_chunks():
+            offset = 0
+            while True:
+                status, data = self.connection.uid(
+                    "FETCH", str(message_id), f"(UID BODY.PEEK[{attachment['section']}]<{offset}.{chunk_size}>)"
+                )
+                if status != "OK":
+                    raise imaplib.IMAP4.error(f"ไม่สามารถดึงไฟล์แนบ {message_id}: {status}")
+                content = next(
+                    (value for message in parse_fetch_response(data) for key, value in message.items()
+                     if key.startswith(f"BODY[{attachment['section']}]")),
+                    None
+                )
+                if not isinstance(content, bytes) or not content:
+                    return
+                yield content
+                if len(content) < chunk_size:
+                    return
+                offset += len(content)
         
-        # ค้นหารหัสคำสั่งซื้อ
-        order_id_match = re.search(r'รหัสคำสั่งซื้อ\s*:\s*(\d+)', body)
-        if order_id_match:
-            result["receipt_number"] = order_id_match.group(1)
-            logger.info(f"พบรหัสคำสั่งซื้อ: {result['receipt_number']}")
-    
-    elif "netflix.com" in from_email:
-        # ใบเสร็จ Netflix
-        logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Netflix")
-        result["vendor_name"] = "Netflix"
-        
-        # ค้นหาจำนวนเงิน
-        amount_match = re.search(r'ยอดรวม\s*฿\s*([\d,]+\.\d{2})', body)
-        if not amount_match:
-            amount_match = re.search(r'(?:Total|รวม):\s*฿\s*([\d,]+\.\d{2})', body, re.IGNORECASE)
-        if not amount_match:
-            amount_match = re.search(r'฿\s*([\d,]+\.\d{2})', body)
-        
-        if amount_match:
-            try:
-                amount_str = amount_match.group(1).replace(',', '')
-                result["amount"] = float(amount_str)
-            except ValueError:
-                pass
-        
-        # พยายามค้นหาวันที่ในหลายรูปแบบ
-        # รูปแบบภาษาไทย
-        date_match = re.search(r'วันที่\s*:\s*(\d{1,2})\s+(ม\.ค\.|ก\.พ\.|มี\.ค\.|เม\.ย\.|พ\.ค\.|มิ\.ย\.|ก\.ค\.|ส\.ค\.|ก\.ย\.|ต\.ค\.|พ\.ย\.|ธ\.ค\.)\s+(\d{4})', body)
-        if date_match:
-            try:
-                thai_month_abbr = {
-                    'ม.ค.': 1, 'ก.พ.': 2, 'มี.ค.': 3, 'เม.ย.': 4,
-                    'พ.ค.': 5, 'มิ.ย.': 6, 'ก.ค.': 7, 'ส.ค.': 8,
-                    'ก.ย.': 9, 'ต.ค.': 10, 'พ.ย.': 11, 'ธ.ค.': 12
-                }
-                
-                day = int(date_match.group(1))
-                month_abbr = date_match.group(2)
-                year = int(date_match.group(3))
-                
-                month_num = thai_month_abbr.get(month_abbr, 1)
-                result["receipt_date"] = datetime(year, month_num, day)
-            except:
-                pass
-    
-    else:
-        # กรณีทั่วไป
-        logger.info(f"ไม่พบรูปแบบเฉพาะ ใช้การตรวจจับทั่วไป จาก: {result['vendor_name']}")
-        result["amount"] = extract_amount(body)
+        return decode_payload_stream(raw_chunks(), attachment["encoding"])
 
-    # ตรวจสอบไฟล์แนบ
-    if email_data["attachments"]:
-        result["receipt_file_path"] = email_data["attachments"][0]["filename"]
+    def get_email(self, message_id: int) -> Optional[Dict[str, Any]]:
+        """ดึงข้อมูลอีเมลตาม UID"""
+        return next(self.fetch_emails([message_id]), None)
 
-    return result
+    def fetch_emails(self, message_ids: List[int], chunk_size: int = None) -> Iterator[Dict[str, Any]]:
+        """ดึงอีเมลหลายฉบับด้วย UID FETCH ครั้งละชุด แล้วส่งคืนทีละฉบับตามที่ได้รับ"""
+        chunk_size = chunk_size or settings.IMAP_FETCH_BATCH_SIZE
+        uids = sorted(set(int(uid) for uid in message_ids))
+        
+        for start in range(0, len(uids), chunk_size):
+            for message in self._fetch_items(uids[start:start + chunk_size], "(UID RFC822)"):
+                if not isinstance(message.get("RFC822"), bytes):
+                    continue
+                email_data = parse_email(message["UID"], message["RFC822"])
+                if email_data:
+                    yield email_data
 
 
-def extract_vendor_name(from_email: str) -> str:
-    """แยกชื่อผู้ขายจากอีเมลผู้ส่ง"""
-    if not from_email:
-        return ""
-    
-    # กำหนด mapping ของโดเมนกับชื่อผู้ให้บริการ
-    domain_to_vendor = {
-        "apple.com": "Apple",
-        "steampowered.com": "Steam",
-        "spotify.com": "Spotify",
-        "kasikornbank.com": "Kasikorn Bank",
-        "kplus": "K Plus",
-        "netflix.com": "Netflix",
-        "youtube.com": "YouTube",
-        "google.com": "Google",
-        "true.com": "True",
-        "ais.co.th": "AIS",
-        "dtac.com": "DTAC"
-    }
-    
-    # ตรวจสอบโดเมน
-    for domain, vendor in domain_to_vendor.items():
-        if domain in from_email.lower():
-            return vendor
-
-    # ถ้าไม่พบในรายการ ให้ใช้วิธีดึงจากอีเมลโดยตรง
-    match = re.match(r'"?([^"<]+)"?\s*<', from_email)
-    if match:
-        return match.group(1).strip()
-
-    match = re.search(r'([^@<\s]+)@', from_email)
-    if match:
-        vendor_part = match.group(1).strip()
-        # ปรับแต่งชื่อให้อ่านง่าย
-        vendor_part = vendor_part.replace('.', ' ').title()
-        return vendor_part
-
-    return from_email.strip()
-
-def extract_amount(body: str) -> float:
-    """แยกจำนวนเงินจากเนื้อหาอีเมลแบบทั่วไป"""
-    if not body:
-        return 0.0
-    
-    # รูปแบบสกุลเงินบาทในรูปแบบต่างๆ
-    patterns = [
-        # รูปแบบที่มีคำว่า total, ยอดรวม, จำนวนเงิน, etc.
-        r'(?:total|amount|ยอดรวม|จำนวนเงิน|ราคา|รวม)(?:\s*:)?\s*฿\s*([\d,]+\.\d{2})',
-        r'(?:total|amount|ยอดรวม|จำนวนเงิน|ราคา|รวม)(?:\s*:)?\s*([\d,]+\.\d{2})\s*(?:บาท|thb)',
-        
-        # รูปแบบสัญลักษณ์สกุลเงินบาท
-        r'฿\s*([\d,]+\.\d{2})',
-        r'([\d,]+\.\d{2})\s*(?:บาท|thb)',
-        
-        # รูปแบบคำว่า THB หรือ บาท
-        r'(?:THB|บาท)\s*([\d,]+\.\d{2})',
-        
-        # รูปแบบทั่วไปที่มีจุดทศนิยม 2 ตำแหน่ง (ใช้เป็นตัวเลือกสุดท้าย)
-        r'([\d,]+\.\d{2})'
-    ]
-    
-    # ลองค้นหาทุกรูปแบบ
-    for pattern in patterns:
-        match = re.search(pattern, body, re.IGNORECASE)
-        if match:
-            try:
-                # ลบเครื่องหมายคอมม่า
-                amount_str = match.group(1).replace(',', '')
-                return float(amount_str)
-            except ValueError:
-                continue
-    
-    # ถ้าไม่พบรูปแบบที่ระบุ ให้คืนค่า 0
-    return 0.0
\ No newline at end of file
+def extract_receipt_info(email_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """แยกข้อมูลใบเสร็จจากอีเมล (ใช้กฎของผู้ให้บริการชุดเดียวกับ ReceiptExtractor)"""
+    return ReceiptExtractor.extract_receipt_info(email_data)
@@ -0,0 +1,145 @@
+﻿import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from typing import Optional
+
+from ..config import settings
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# นามสกุลของไฟล์อีเมลในแคช (ไฟล์อื่น เช่น .tmp ที่ process อื่นกำลังเขียน จะไม่ถูกนับหรือลบ)
+_CACHE_SUFFIX = ".eml.z"
+
+
+class MessageCache:
+    """แคชอีเมลดิบ (RFC822) แบบบีบอัดบนดิสก์ ระบุด้วย (IMAP setting, โฟลเดอร์, UIDVALIDITY, UID)
+    เพื่อให้แยกข้อมูลใบเสร็จซ้ำได้โดยไม่ต้องดึงจากเซิร์ฟเวอร์ IMAP อีก"""
+
+    def __init__(self, root_dir: str, max_bytes: int, evict_interval: float):
+        self.root_dir = os.path.abspath(root_dir)
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        # ขนาดแคชโดยประมาณ นับจากการสำรวจครั้งล่าสุดบวกไฟล์ที่ process นี้เขียนเพิ่ม
+        # (process อื่นเขียนด้วย จึงสำรวจขนาดจริงใหม่ทุก evict_interval วินาที)
+        self._estimated_bytes: Optional[int] = None
+        self._last_scan: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def path(self, imap_setting_id: int, uid_validity: int, uid: int, folder: str = None) -> str:
+        """ตำแหน่งไฟล์ของอีเมลในแคช (โฟลเดอร์หลักใช้ folder เป็น None
+        โฟลเดอร์เพิ่มเติมแยกไดเรกทอรีตาม hash ของชื่อ เพราะชื่อโฟลเดอร์อาจมี / หรืออักษรพิเศษ)"""
+        setting_dir = os.path.join(self.root_dir, str(int(imap_setting_id)))
+        if folder:
+            setting_dir = os.path.join(setting_dir, "f-" + hashlib.sha1(folder.encode("utf-8")).hexdigest()[:16])
+        return os.path.join(setting_dir, str(int(uid_validity)), f"{int(uid)}{_CACHE_SUFFIX}")
+
+    def put(self, imap_setting_id: int, uid_validity: int, uid: int, raw_email: bytes, folder: str = None) -> bool:
+        """บีบอัดและบันทึกอีเมลลงแคช (เขียนไฟล์ชั่วคราวแล้วย้าย เพื่อไม่ให้อ่านได้ไฟล์ที่เขียนไม่ครบ)"""
+        if uid_validity is None:
+            return False
+
+        final_path = self.path(imap_setting_id, uid_validity, uid, folder)
+        try:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path), suffix=".tmp")
+            try:
+                compressed = zlib.compress(raw_email, 6)
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(compressed)
+                try:
+                    replaced_size = os.path.getsize(final_path)
+                except FileNotFoundError:
+                    replaced_size = 0
+                os.replace(tmp_path, final_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            with self._lock:
+                if self._estimated_bytes is not None:
+                    self._estimated_bytes += len(compressed) - replaced_size
+            return True
+
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการบันทึกอีเมล {uid} ลงแคช: {str(e)}")
+            return False
+
+    def get(self, imap_setting_id: int, uid_validity: int, uid: int, folder: str = None) -> Optional[bytes]:
+        """อ่านอีเมลจากแคช ถ้าไม่มีหรือไฟล์เสียหายจะคืนค่า None"""
+        if uid_validity is None:
+            return None
+
+        path = self.path(imap_setting_id, uid_validity, uid, folder)
+        try:
+            with open(path, "rb") as cached_file:
+                raw_email = zlib.decompress(cached_file.read())
+            # อัปเดตเวลาใช้งานล่าสุด เพื่อให้ถูกลบทีหลังเมื่อแคชเต็ม
+            os.utime(path)
+            return raw_email
+
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในการอ่านอีเมล {uid} จากแคช: {str(e)}")
+            return None
+
+    def maybe_evict(self) -> int:
+        """ลบไฟล์เมื่อขนาดโดยประมาณเกิน max_bytes หรือครบ evict_interval นับจากการสำรวจครั้งล่าสุด
+        (ไม่ต้องสำรวจแคชทั้งหมดทุกครั้งที่ซิงค์เสร็จ) คืนค่าจำนวนไฟล์ที่ลบ"""
+        with self._lock:
+            due = (
+                self._last_scan is None
+                or time.monotonic() - self._last_scan >= self.evict_interval
+                or self._estimated_bytes > self.max_bytes
+            )
+        if not due:
+            return 0
+        return self.evict()
+
+    def evict(self) -> int:
+        """ลบไฟล์ที่ไม่ได้ใช้นานที่สุดจนขนาดแคชรวมไม่เกิน max_bytes คืนค่าจำนวนไฟล์ที่ลบ"""
+        entries = []
+        total_size = 0
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for file_name in file_names:
+                if not file_name.endswith(_CACHE_SUFFIX):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+
+        with self._lock:
+            self._estimated_bytes = total_size
+            self._last_scan = time.monotonic()
+
+        if removed:
+            logger.info(f"ลบอีเมลออกจากแคช {removed} รายการ (ขนาดคงเหลือ {total_size} ไบต์)")
+        return removed
+
+
+message_cache = MessageCache(
+    settings.MESSAGE_CACHE_DIR,
+    settings.MESSAGE_CACHE_MAX_BYTES,
+    settings.MESSAGE_CACHE_EVICT_INTERVAL
+)
@@ -1,12 +1,148 @@
 ﻿import re
+import hashlib
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, NamedTuple, Iterator
 import logging
 from email.utils import parsedate_to_datetime
 
+from .vendor_rules import vendor_templates
+from .email_text import email_text
+
 # ตั้งค่า logging
 logger = logging.getLogger(__name__)
 
+# รูปแบบชื่อผู้ส่ง "Name <email>" และส่วนก่อน @ ของอีเมล
+_DISPLAY_NAME_RE = re.compile(r'"?([^"<]+)"?\s*<')
+_LOCAL_PART_RE = re.compile(r'([^@<\s]+)@')
+
+# สัญลักษณ์/รหัสสกุลเงิน ตามด้วยตัวเลขจำนวนเงิน (ถ้ามี) ไล่เนื้อหาครั้งเดียวโดยเริ่มจากสัญลักษณ์
+# เพราะจำนวนเงินทุกรูปแบบต้องมีสัญลักษณ์กำกับอยู่ก่อนหรือหลังตัวเลข
+_AMOUNT_SCANNER = re.compile(
+    r'(?P<symbol>฿|\$|THB|บาท|USD)(?:\s*(?P<amount>[\d,]+\.\d{2}))?',
+    re.IGNORECASE
+)
+# คำนำหน้าที่อยู่ติดกับสัญลักษณ์ เช่น "Total: ฿" และตัวเลขที่อยู่ก่อนรหัสสกุลเงิน เช่น "35.00 บาท"
+# ตรวจกับข้อความก่อนสัญลักษณ์ที่กลับด้านแล้ว จึงเป็นการตรวจแบบยึดตำแหน่งเริ่มต้น (ไม่ต้องไล่ทุกตำแหน่ง)
+_AMOUNT_KEYWORDS = ["total", "amount", "ยอดรวม", "จำนวนเงิน", "ราคา"]
+_KEYWORD_BEFORE_RE = re.compile(
+    r'\s*(?::\s*)?(?P<keyword>' + "|".join(keyword[::-1] for keyword in _AMOUNT_KEYWORDS) + ')',
+    re.IGNORECASE
+)
+_AMOUNT_BEFORE_RE = re.compile(r'\s*(?P<amount>\d{2}\.[\d,]+)')
+# ระยะข้อความก่อนสัญลักษณ์ที่ใช้ตรวจคำนำหน้าหรือตัวเลข
+_AMOUNT_CONTEXT_CHARS = 64
+
+# ลำดับความสำคัญ (เลขน้อยสำคัญกว่า) และสกุลเงินของแต่ละรูปแบบ เรียงบาทก่อนดอลลาร์
+_KEYWORD_SYMBOL_PRIORITY = {"฿": (0, "THB"), "$": (4, "USD")}
+_SYMBOL_PRIORITY = {"฿": (1, "THB"), "THB": (2, "THB"), "บาท": (2, "THB"), "$": (5, "USD"), "USD": (6, "USD")}
+_SUFFIX_PRIORITY = {"THB": (3, "THB"), "บาท": (3, "THB"), "USD": (7, "USD")}
+# คำนำหน้าที่ใช้กับยอดดอลลาร์ได้
+_USD_KEYWORDS = {"total", "amount"}
+
+
+class AmountCandidate(NamedTuple):
+    """จำนวนเงินที่พบในเนื้อหา พร้อมสกุลเงิน ลำดับความสำคัญของรูปแบบ ตำแหน่ง และคำนำหน้า (ถ้ามี)"""
+    amount: float
+    currency: str
+    priority: int
+    position: int
+    keyword: Optional[str]
+
+
+def _text_before(body: str, position: int) -> str:
+    """ข้อความก่อนตำแหน่งที่ระบุ (ไม่เกิน _AMOUNT_CONTEXT_CHARS ตัวอักษร) แบบกลับด้าน"""
+    return body[max(0, position - _AMOUNT_CONTEXT_CHARS):position][::-1]
+
+
+def _parse_amount(text: str) -> Optional[float]:
+    """แปลงตัวเลขจำนวนเงิน (ตัดเครื่องหมายคอมม่า) คืนค่า None ถ้าไม่ใช่ตัวเลข"""
+    try:
+        return float(text.replace(',', ''))
+    except ValueError:
+        return None
+
+
+def iter_amounts(body: str) -> Iterator[AmountCandidate]:
+    """ไล่เนื้อหาครั้งเดียวจากสัญลักษณ์สกุลเงิน และคืนจำนวนเงินทุกรายการที่พบตามลำดับในเนื้อหา
+    ตัวเลขที่ตามหลังสัญลักษณ์ และตัวเลขที่อยู่หน้ารหัสสกุลเงิน (THB, บาท, USD) นับเป็นคนละรายการ"""
+    if not body:
+        return
+    for match in _AMOUNT_SCANNER.finditer(body):
+        symbol = match.group("symbol").upper()
+        start = match.start()
+        before = None
+
+        # ตัวเลขหลังสัญลักษณ์ เช่น "฿35.00" หรือ "Total: ฿35.00"
+        if match.group("amount"):
+            amount = _parse_amount(match.group("amount"))
+            if amount is not None:
+                priority, currency = _SYMBOL_PRIORITY[symbol]
+                position, keyword = start, None
+                if symbol in _KEYWORD_SYMBOL_PRIORITY:
+                    before = _text_before(body, start)
+                    keyword_match = _KEYWORD_BEFORE_RE.match(before)
+                    keyword = keyword_match and keyword_match.group("keyword")[::-1]
+                    if keyword and (symbol != "$" or keyword.lower() in _USD_KEYWORDS):
+                        priority, currency = _KEYWORD_SYMBOL_PRIORITY[symbol]
+                        position = start - keyword_match.end()
+                    else:
+                        keyword = None
+                yield AmountCandidate(amount, currency, priority, position, keyword)
+
+        # ตัวเลขหน้ารหัสสกุลเงิน เช่น "35.00 บาท"
+        if symbol in _SUFFIX_PRIORITY:
+            amount_match = _AMOUNT_BEFORE_RE.match(before if before is not None else _text_before(body, start))
+            if amount_match:
+                amount = _parse_amount(amount_match.group("amount")[::-1])
+                if amount is not None:
+                    priority, currency = _SUFFIX_PRIORITY[symbol]
+                    yield AmountCandidate(amount, currency, priority, start - amount_match.end(), None)
+
+
+def scan_amounts(body: str) -> List[AmountCandidate]:
+    """จำนวนเงินทุกรายการที่พบในเนื้อหา"""
+    return list(iter_amounts(body))
+
+
+def best_amount(body: str) -> Optional[AmountCandidate]:
+    """จำนวนเงินที่น่าจะเป็นยอดรวมที่สุด: รูปแบบที่สำคัญที่สุดก่อน แล้วจึงตำแหน่งแรกในเนื้อหา"""
+    best = None
+    for candidate in iter_amounts(body):
+        if best is None or (candidate.priority, candidate.position) < (best.priority, best.position):
+            best = candidate
+            # รูปแบบที่สำคัญที่สุดซึ่งพบเป็นรายการแรก ไม่มีรายการอื่นดีกว่าแล้ว
+            if best.priority == 0:
+                break
+    return best
+
+
+def receipt_identity(email_data: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """สร้างรหัสประจำใบเสร็จจาก Message-ID และค่า hash ของผู้ส่ง หัวข้อ และวันที่
+    (ไม่ขึ้นกับหมายเลขอีเมลบนเซิร์ฟเวอร์ จึงใช้ตรวจซ้ำข้ามโฟลเดอร์และข้ามบัญชีได้)"""
+    date = email_data.get("date")
+    content = "\n".join([
+        (email_data.get("from") or "").strip().lower(),
+        (email_data.get("subject") or "").strip(),
+        date.isoformat() if date else ""
+    ])
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    message_id = (email_data.get("message_id_header") or "").strip()
+    normalized_message_id = message_id.strip("<>").strip().lower()
+    if normalized_message_id:
+        # ผู้ส่งบางรายใช้ Message-ID ซ้ำ จึงรวมค่า hash ของเนื้อหาไว้ด้วย
+        key = f"{normalized_message_id}\n{content_hash}"
+        email_id = "mid:" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+    else:
+        email_id = "hash:" + content_hash
+
+    return {
+        "email_id": email_id,
+        "message_id": message_id[:255] or None,
+        "content_hash": content_hash
+    }
+
+
 class ReceiptExtractor:
     """คลาสสำหรับแยกข้อมูลใบเสร็จจากอีเมลต่างๆ"""
     
@@ -17,8 +153,11 @@ class ReceiptExtractor:
             return None
         
         # ข้อมูลพื้นฐาน (จะถูกแทนที่โดยข้อมูลจากผู้ให้บริการเฉพาะ)
+        identity = receipt_identity(email_data)
         result = {
-            "email_id": f"imap_{email_data['message_id']}",
+            "email_id": identity["email_id"],
+            "message_id": identity["message_id"],
+            "content_hash": identity["content_hash"],
             "email_subject": email_data["subject"],
             "email_from": email_data["from"],
             "email_date": email_data["date"],
@@ -29,189 +168,19 @@ class ReceiptExtractor:
             "receipt_file_path": None  # จะเติมภายหลังเมื่อบันทึกไฟล์
         }
         
-        # ตรวจสอบว่าเป็นอีเมลจากผู้ให้บริการใด
-        if "apple.com" in email_data["from"].lower():
-            logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Apple")
-            return ReceiptExtractor.extract_apple_receipt(email_data, result)
-        elif "kplus" in email_data["from"].lower() or "kasikornbank" in email_data["from"].lower():
-            logger.info("ตรวจพบว่าเป็นใบเสร็จจาก K Plus")
-            return ReceiptExtractor.extract_kplus_receipt(email_data, result)
-        elif "steam" in email_data["from"].lower() or "steampowered" in email_data["from"].lower():
-            logger.info("ตรวจพบว่าเป็นใบเสร็จจาก Steam")
-            return ReceiptExtractor.extract_steam_receipt(email_data, result)
-        else:
-            # พยายามตรวจจับรูปแบบทั่วไป
-            logger.info(f"ไม่พบรูปแบบเฉพาะ ใช้การตรวจจับทั่วไป จาก: {result['vendor_name']}")
-            result["amount"] = ReceiptExtractor.extract_amount_general(email_data["body"])
-            return result if result["amount"] > 0 else None
-    
-    @staticmethod
-    def extract_apple_receipt(email_data: Dict[str, Any], base_result: Dict[str, Any]) -> Dict[str, Any]:
-        """แยกข้อมูลใบเสร็จจาก Apple"""
-        result = base_result.copy()
-        result["vendor_name"] = "Apple"
-        
-        body = email_data["body"]
-        
-        # พยายามหาวันที่ใบแจ้งหนี้ (INVOICE DATE)
-        invoice_date_match = re.search(r'INVOICE DATE\s*(\d{1,2}\s+\w+\s+\d{4})', body)
-        if invoice_date_match:
-            date_str = invoice_date_match.group(1)
-            try:
-                # แปลงวันที่ในรูปแบบ '12 Feb 2025' เป็น datetime
-                receipt_date = datetime.strptime(date_str, '%d %b %Y')
-                result["receipt_date"] = receipt_date
-            except Exception as e:
-                logger.warning(f"ไม่สามารถแปลงวันที่ Apple: {date_str}, ข้อผิดพลาด: {str(e)}")
-        
-        # ลองค้นหาจำนวนเงินในรูปแบบของ Apple (เช่น ฿35.00)
-        amount_patterns = [
-            r'฿(\d+\.\d{2})',  # ฿35.00
-            r'TOTAL\s*฿\s*(\d+\.\d{2})',  # TOTAL ฿35.00
-            r'Total:\s*฿\s*(\d+\.\d{2})',  # Total: ฿35.00
-            r'ค่าใช้จ่ายรวม\s*฿\s*(\d+\.\d{2})',  # ค่าใช้จ่ายรวม ฿35.00
-            r'รวม\s*฿\s*(\d+\.\d{2})',  # รวม ฿35.00
-        ]
-        
-        for pattern in amount_patterns:
-            match = re.search(pattern, body, re.IGNORECASE)
-            if match:
-                try:
-                    result["amount"] = float(match.group(1))
-                    break
-                except ValueError:
-                    continue
-        
-        # ถ้ามี attachments ให้ใช้ไฟล์แรก
-        if email_data["attachments"]:
-            result["receipt_file_path"] = email_data["attachments"][0]["filename"]
-        
-        return result
-    
-    @staticmethod
-    def extract_kplus_receipt(email_data: Dict[str, Any], base_result: Dict[str, Any]) -> Dict[str, Any]:
-        """แยกข้อมูลใบเสร็จจาก K Plus"""
-        result = base_result.copy()
-        result["vendor_name"] = "K Plus (Kasikorn Bank)"
-        
-        body = email_data["body"]
-        
-        # พยายามหาวันที่ทำรายการ
-        date_match = re.search(r'วันที่ทำรายการ:\s*(\d{2}/\d{2}/\d{4})', body)
-        if not date_match:
-            date_match = re.search(r'วันที่ทำรายการ.*?(\d{2}/\d{2}/\d{4})', body)
-        
-        if date_match:
-            date_str = date_match.group(1)
-            try:
-                # แปลงวันที่ในรูปแบบ 'DD/MM/YYYY' เป็น datetime
-                receipt_date = datetime.strptime(date_str, '%d/%m/%Y')
-                result["receipt_date"] = receipt_date
-            except Exception as e:
-                logger.warning(f"ไม่สามารถแปลงวันที่ K Plus: {date_str}, ข้อผิดพลาด: {str(e)}")
-        
-        # ลองค้นหาเลขที่รายการ
-        transaction_id_match = re.search(r'เลขที่รายการ:?\s*(\w+)', body)
-        if transaction_id_match:
-            result["transaction_id"] = transaction_id_match.group(1)
-        
-        # ลองค้นหาจำนวนเงิน
-        amount_match = re.search(r'จำนวนเงิน\s*\(บาท\):\s*([\d,]+\.\d{2})', body)
-        if not amount_match:
-            amount_match = re.search(r'จำนวนเงิน\s*\(บาท\).*?([\d,]+\.\d{2})', body)
-        
-        if amount_match:
-            try:
-                amount_str = amount_match.group(1).replace(',', '')
-                result["amount"] = float(amount_str)
-            except ValueError as e:
-                logger.warning(f"ไม่สามารถแปลงจำนวนเงิน K Plus: {amount_match.group(1)}, ข้อผิดพลาด: {str(e)}")
-        
-        # หาผู้รับเงิน/ร้านค้า
-        payee_match = re.search(r'เพื่อเข้าบัญชีบริษัท:\s*(.+?)(?:\r|\n)', body)
-        if payee_match:
-            result["payee"] = payee_match.group(1).strip()
-        
-        return result
-    
-    @staticmethod
-    def extract_steam_receipt(email_data: Dict[str, Any], base_result: Dict[str, Any]) -> Dict[str, Any]:
-        """แยกข้อมูลใบเสร็จจาก Steam"""
-        result = base_result.copy()
-        result["vendor_name"] = "Steam"
-        result["currency"] = "THB"  # ปรับเป็นบาท (THB) ตามใบเสร็จที่เห็น
-        
-        body = email_data["body"]
-        
-        # แยกชื่อเกม/สินค้า
-        game_match = re.search(r'ขอขอบคุณสำหรับการสั่งซื้อล่าสุดของคุณสำหรับ\s*(.*?)(?:\n|$)', body)
-        if game_match:
-            result["product_name"] = game_match.group(1).strip()
-        
-        # พยายามหาวันที่ดำเนินการ (รูปแบบไทย)
-        date_match = re.search(r'วันที่ดำเนินการ:\s*(\d{1,2}\s+\w+\.\s+\d{4}\s+@\s+[\d:]+[ap]m\s+\+\d+)', body)
-        if date_match:
-            date_str = date_match.group(1).strip()
-            logger.info(f"พบวันที่จาก Steam: {date_str}")
-            
-            try:
-                # แปลงเดือนภาษาไทยเป็นอังกฤษ
-                thai_month_map = {
-                    'ม.ค.': 'Jan', 'ก.พ.': 'Feb', 'มี.ค.': 'Mar', 'เม.ย.': 'Apr', 
-                    'พ.ค.': 'May', 'มิ.ย.': 'Jun', 'ก.ค.': 'Jul', 'ส.ค.': 'Aug', 
-                    'ก.ย.': 'Sep', 'ต.ค.': 'Oct', 'พ.ย.': 'Nov', 'ธ.ค.': 'Dec'
-                }
-                
-                # แยกส่วนของวันที่
-                date_parts = date_str.split('@')
-                date_only = date_parts[0].strip()
-                
-                # แยกวัน เดือน ปี
-                for thai_month, eng_month in thai_month_map.items():
-                    if thai_month in date_only:
-                        date_only = date_only.replace(thai_month, eng_month)
-                        break
-                
-                # พยายามแปลงวันที่หลังจากเปลี่ยนเดือนเป็นภาษาอังกฤษ
-                try:
-                    from dateutil import parser
-                    receipt_date = parser.parse(date_only)
-                    result["receipt_date"] = receipt_date
-                except:
-                    # หากใช้ dateutil ไม่ได้ ให้ลองใช้ datetime
-                    date_parts = date_only.split()
-                    if len(date_parts) == 3:  # ['23', 'Jan', '2025']
-                        day = int(date_parts[0])
-                        month = date_parts[1]
-                        year = int(date_parts[2])
-                        receipt_date = datetime.strptime(f"{day} {month} {year}", "%d %b %Y")
-                        result["receipt_date"] = receipt_date
-                    
-            except Exception as e:
-                logger.warning(f"ไม่สามารถแปลงวันที่ Steam: {date_str}, ข้อผิดพลาด: {str(e)}")
-        
-        # ค้นหาจำนวนเงินทั้งหมด
-        # รูปแบบ 1: ฿34.00
-        amount_match = re.search(r'รวมทั้งหมด:\s*฿\s*([\d,]+\.\d{2})', body)
-        if not amount_match:
-            # รูปแบบ 2: รวมทั้งหมด: ฿34.00
-            amount_match = re.search(r'รวมทั้งหมด:\s*฿([\d,]+\.\d{2})', body)
-        if not amount_match:
-            # รูปแบบ 3: เสร็จสมบูรณ์แล้ว และ ฿34.00
-            amount_match = re.search(r'เสร็จสมบูรณ์แล้ว และ ฿([\d,]+\.\d{2})', body)
-        
-        if amount_match:
-            try:
-                amount_str = amount_match.group(1).replace(',', '')
-                result["amount"] = float(amount_str)
-            except ValueError as e:
-                logger.warning(f"ไม่สามารถแปลงจำนวนเงิน Steam: {amount_match.group(1)}, ข้อผิดพลาด: {str(e)}")
-        
-        # ค้นหาหมายเลขใบกำกับสินค้า
-        invoice_match = re.search(r'ใบกำกับสินค้า:\s*(\d+)', body)
-        if invoice_match:
-            result["invoice_number"] = invoice_match.group(1).strip()
-        
+        # ตรวจสอบว่าเป็นอีเมลจากผู้ให้บริการใด (ค้นหาจากโดเมนผู้ส่งในเทมเพลตของผู้ให้บริการ)
+        rule = vendor_templates.catalog().registry.match(email_data["from"])
+        if rule is not None:
+            logger.debug(f"ตรวจพบว่าเป็นใบเสร็จจาก {rule.name}")
+            return rule.extract(email_data, result)
+
+        # พยายามตรวจจับรูปแบบทั่วไป
+        logger.info(f"ไม่พบรูปแบบเฉพาะ ใช้การตรวจจับทั่วไป จาก: {result['vendor_name']}")
+        candidate = best_amount(email_text(email_data))
+        if candidate is None or candidate.amount <= 0:
+            return None
+        result["amount"] = candidate.amount
+        result["currency"] = candidate.currency
         return result
     
     @staticmethod
@@ -221,12 +190,12 @@ class ReceiptExtractor:
             return ""
         
         # ลองค้นหารูปแบบ "Name <email>"
-        match = re.match(r'"?([^"<]+)"?\s*<', from_email)
+        match = _DISPLAY_NAME_RE.match(from_email)
         if match:
             return match.group(1).strip()
         
         # ถ้าไม่พบรูปแบบดังกล่าว ให้ใช้ส่วนก่อน @ ในอีเมล
-        match = re.search(r'([^@<\s]+)@', from_email)
+        match = _LOCAL_PART_RE.search(from_email)
         if match:
             vendor_part = match.group(1).strip()
             # ปรับแต่งชื่อให้อ่านง่าย
@@ -242,33 +211,9 @@ class ReceiptExtractor:
         if not body:
             return 0.0
         
-        # รูปแบบทั่วไป
-        # บาท (THB)
-        baht_patterns = [
-            r'(?:total|amount|ยอดรวม|จำนวนเงิน|ราคา)(?:\s*:)?\s*฿\s*([\d,]+\.\d{2})',
-            r'฿\s*([\d,]+\.\d{2})',
-            r'(?:THB|บาท)\s*([\d,]+\.\d{2})',
-            r'([\d,]+\.\d{2})\s*(?:THB|บาท)',
-        ]
-        
-        # ดอลลาร์ (USD)
-        usd_patterns = [
-            r'(?:total|amount)(?:\s*:)?\s*\$\s*([\d,]+\.\d{2})',
-            r'\$\s*([\d,]+\.\d{2})',
-            r'(?:USD)\s*([\d,]+\.\d{2})',
-            r'([\d,]+\.\d{2})\s*(?:USD)',
-        ]
-        
-        # ลองค้นหาทุกรูปแบบ
-        for pattern in baht_patterns + usd_patterns:
-            match = re.search(pattern, body, re.IGNORECASE)
-            if match:
-                try:
-                    # ลบเครื่องหมายคอมม่า
-                    amount_str = match.group(1).replace(',', '')
-                    return float(amount_str)
-                except ValueError:
-                    continue
+        candidate = best_amount(body)
+        if candidate is not None:
+            return candidate.amount
         
         # ถ้าไม่พบรูปแบบที่ระบุ ให้คืนค่า 0
         return 0.0
\ No newline at end of file
@@ -0,0 +1,90 @@
+﻿from datetime import datetime
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from ..models.receipt import Receipt
+
+# ใบเสร็จที่บันทึกก่อนมีรหัสจาก Message-ID ใช้รหัส imap_<หมายเลขอีเมลบนเซิร์ฟเวอร์>
+LEGACY_EMAIL_ID_PATTERN = "imap\\_%"
+
+
+def find_existing_email_ids(db: Session, user_id: int, email_ids: List[str]) -> Set[str]:
+    """ค้นหา email_id ที่มีใบเสร็จอยู่แล้วด้วยคำสั่ง IN ครั้งเดียว"""
+    if not email_ids:
+        return set()
+    
+    rows = db.query(Receipt.email_id).filter(
+        Receipt.user_id == user_id,
+        Receipt.email_id.in_(set(email_ids))
+    ).all()
+    return {email_id for (email_id,) in rows}
+
+
+def legacy_receipt_key(email_from: Optional[str], subject: Optional[str], date: Optional[datetime]) -> Tuple:
+    """คีย์สำหรับจับคู่อีเมลกับใบเสร็จแบบเดิมด้วยผู้ส่ง หัวข้อ และวันที่
+    (ฐานข้อมูลเก็บวันที่โดยไม่มีเขตเวลา จึงเทียบเฉพาะเวลาตามที่ระบุในอีเมล)"""
+    return (email_from, subject, date.replace(tzinfo=None) if date else None)
+
+
+def find_legacy_receipts(db: Session, user_id: int, emails: List[Dict[str, Any]]) -> Dict[Tuple, int]:
+    """ค้นหาใบเสร็จที่ยังใช้รหัสแบบเดิม (imap_<หมายเลข>) ซึ่งตรงกับผู้ส่ง หัวข้อ และวันที่ของอีเมลที่ระบุ
+    คืนค่า dict จาก legacy_receipt_key เป็น id ของใบเสร็จ (ถ้ามีหลายรายการใช้รายการแรก)"""
+    keys = {legacy_receipt_key(email_data["from"], email_data["subject"], email_data["date"]) for email_data in emails}
+    senders = {email_from for email_from, _, _ in keys if email_from}
+    if not senders:
+        return {}
+    
+    rows = db.query(Receipt.id, Receipt.email_from, Receipt.email_subject, Receipt.email_date).filter(
+        Receipt.user_id == user_id,
+        Receipt.email_id.like(LEGACY_EMAIL_ID_PATTERN, escape="\\"),
+        Receipt.email_from.in_(senders)
+    ).order_by(Receipt.id).all()
+    
+    legacy = {}
+    for receipt_id, email_from, subject, date in rows:
+        key = legacy_receipt_key(email_from, subject, date)
+        if key in keys:
+            legacy.setdefault(key, receipt_id)
+    return legacy
+
+
+def adopt_legacy_receipts(db: Session, user_id: int, rows: List[Dict[str, Any]]) -> int:
+    """เปลี่ยนรหัสของใบเสร็จแบบเดิมเป็นรหัสใหม่ (แต่ละแถวต้องมี id และคอลัมน์ที่จะแก้ไข)
+    ข้ามรายการที่รหัสใหม่มีใบเสร็จอยู่แล้ว คืนค่าจำนวนใบเสร็จที่แก้ไข"""
+    if not rows:
+        return 0
+    
+    taken = find_existing_email_ids(db, user_id, [row["email_id"] for row in rows])
+    updates = []
+    for row in rows:
+        if row["email_id"] not in taken:
+            taken.add(row["email_id"])
+            updates.append(row)
+    
+    if updates:
+        db.execute(update(Receipt), updates)
+    return len(updates)
+
+
+def insert_receipts_ignore_duplicates(db: Session, rows: List[Dict[str, Any]]) -> int:
+    """บันทึกใบเสร็จหลายรายการด้วย INSERT แบบหลายแถวคำสั่งเดียว โดยข้ามรายการที่ซ้ำ (user_id, email_id)
+    คืนค่าจำนวนใบเสร็จที่บันทึกได้จริง"""
+    if not rows:
+        return 0
+    
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        statement = insert(Receipt).prefix_with("IGNORE")
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+        statement = postgresql_insert(Receipt).on_conflict_do_nothing(index_elements=["user_id", "email_id"])
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        statement = sqlite_insert(Receipt).on_conflict_do_nothing(index_elements=["user_id", "email_id"])
+    else:
+        statement = insert(Receipt)
+    
+    result = db.execute(statement.values(rows))
+    return result.rowcount
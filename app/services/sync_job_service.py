@@ -0,0 +1,277 @@
+﻿import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import or_, and_, func
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models.imap_setting import ImapSetting
+from ..models.sync_job import SyncJob
+from .sync_service import SyncPipeline
+from .backfill import backfill_receipts
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# สถานะของงานที่ยังไม่เสร็จ
+ACTIVE_STATUSES = ("pending", "running")
+
+# ลำดับความสำคัญของงาน (ค่ามากทำก่อน)
+MANUAL_PRIORITY = 10
+SCHEDULED_PRIORITY = 0
+
+
+def _wider_limit(current: Optional[int], requested: int) -> int:
+    """รวมขอบเขตของสองคำขอ (จำนวนวันหรือจำนวนอีเมล) โดยใช้ค่าที่กว้างกว่า 0 หมายถึงไม่จำกัด"""
+    if current is None:
+        return requested
+    if current <= 0 or requested <= 0:
+        return 0
+    return max(current, requested)
+
+
+def enqueue_sync_job(
+    db: Session,
+    imap_setting: ImapSetting,
+    days_back: int = 30,
+    max_emails: int = 50,
+    full_resync: bool = False,
+    priority: int = MANUAL_PRIORITY
+) -> SyncJob:
+    """สร้างงานซิงค์ใหม่ ถ้าบัญชีนี้มีงานที่รออยู่แล้วจะรวมคำขอเข้ากับงานเดิม (full_resync และขอบเขตที่กว้างกว่า)
+    ถ้ามีงานที่กำลังทำอยู่ จะขอให้ซิงค์อีกรอบตามค่าที่ขอเมื่องานนั้นเสร็จ
+    (อีเมลที่มาหลังงานนั้นค้นหาแล้วจะไม่ต้องรอรอบอัตโนมัติถัดไป)"""
+    # ล็อกแถวการตั้งค่า IMAP จนจบ transaction เพื่อไม่ให้คำขอที่เข้ามาพร้อมกันสร้างงานซ้ำ
+    db.query(ImapSetting.id).filter(ImapSetting.id == imap_setting.id).with_for_update().first()
+    
+    active_jobs = db.query(SyncJob).filter(
+        SyncJob.imap_setting_id == imap_setting.id,
+        SyncJob.status.in_(ACTIVE_STATUSES)
+    ).order_by(SyncJob.id).all()
+    
+    pending_job = next((job for job in active_jobs if job.status == "pending"), None)
+    if pending_job:
+        pending_job.days_back = _wider_limit(pending_job.days_back, days_back)
+        pending_job.max_emails = _wider_limit(pending_job.max_emails, max_emails)
+        if full_resync and not pending_job.full_resync:
+            # งานที่รอลองใหม่จะทำต่อจาก checkpoint จึงต้องล้างออกให้เริ่มซิงค์ใหม่ทั้งหมด
+            pending_job.full_resync = True
+            pending_job.checkpoint_uid = None
+        pending_job.priority = max(pending_job.priority, priority)
+        db.commit()
+        return pending_job
+    
+    if active_jobs:
+        running_job = active_jobs[0]
+        if running_job.rerun_requested:
+            days_back = _wider_limit(running_job.rerun_days_back, days_back)
+            max_emails = _wider_limit(running_job.rerun_max_emails, max_emails)
+            full_resync = running_job.rerun_full_resync or full_resync
+        running_job.rerun_requested = True
+        running_job.rerun_days_back = days_back
+        running_job.rerun_max_emails = max_emails
+        running_job.rerun_full_resync = full_resync
+        running_job.priority = max(running_job.priority, priority)
+        db.commit()
+        return running_job
+    
+    job = SyncJob(
+        user_id=imap_setting.user_id,
+        imap_setting_id=imap_setting.id,
+        days_back=days_back,
+        max_emails=max_emails,
+        full_resync=full_resync,
+        priority=priority
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def enqueue_backfill_job(db: Session, user_id: int, dry_run: bool = False) -> SyncJob:
+    """สร้างงานแยกข้อมูลใบเสร็จใหม่ของผู้ใช้ ถ้ามีงานแบบเดียวกันที่ยังไม่เริ่มอยู่แล้วจะคืนงานเดิม"""
+    existing_job = db.query(SyncJob).filter(
+        SyncJob.user_id == user_id,
+        SyncJob.kind == "backfill",
+        SyncJob.dry_run.is_(dry_run),
+        SyncJob.status == "pending"
+    ).order_by(SyncJob.id).first()
+    if existing_job:
+        return existing_job
+    
+    job = SyncJob(user_id=user_id, kind="backfill", dry_run=dry_run, priority=MANUAL_PRIORITY)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def claim_next_job(db: Session, worker_id: str) -> Optional[SyncJob]:
+    """จองงานถัดไปด้วยการล็อกแถว (SKIP LOCKED) เพื่อไม่ให้ worker หลายตัวได้งานเดียวกัน
+    งานที่ค้างสถานะ running นานเกินกำหนด (worker หยุดทำงาน) จะถูกนำกลับมาทำใหม่
+    และจะข้ามงานของเซิร์ฟเวอร์ IMAP ที่มีงานซิงค์อยู่ครบ IMAP_MAX_SYNCS_PER_HOST แล้ว"""
+    while True:
+        now = datetime.now()
+        stale_before = now - timedelta(seconds=settings.SYNC_JOB_LOCK_TIMEOUT)
+        host = func.lower(ImapSetting.server)
+        
+        # เซิร์ฟเวอร์ที่มีงานซิงค์ทำงานอยู่ครบจำนวนแล้ว
+        # (worker ที่จองงานพร้อมกันอาจทำให้เกินได้ไม่เกินจำนวน worker)
+        busy_hosts = [
+            server for server, running in db.query(host, func.count(SyncJob.id)).join(
+                SyncJob, SyncJob.imap_setting_id == ImapSetting.id
+            ).filter(
+                SyncJob.status == "running",
+                SyncJob.locked_at >= stale_before
+            ).group_by(host).all()
+            if running >= settings.IMAP_MAX_SYNCS_PER_HOST
+        ]
+        
+        # งาน backfill ไม่มีการตั้งค่า IMAP จึงใช้ outer join และไม่นับจำนวนงานต่อเซิร์ฟเวอร์
+        query = db.query(SyncJob).outerjoin(ImapSetting, SyncJob.imap_setting_id == ImapSetting.id).filter(
+            or_(
+                and_(SyncJob.status == "pending", or_(SyncJob.run_after.is_(None), SyncJob.run_after <= now)),
+                and_(SyncJob.status == "running", SyncJob.locked_at < stale_before)
+            )
+        )
+        if busy_hosts:
+            query = query.filter(or_(SyncJob.imap_setting_id.is_(None), host.notin_(busy_hosts)))
+        job = query.order_by(SyncJob.priority.desc(), SyncJob.id).with_for_update(skip_locked=True, of=SyncJob).first()
+        
+        if not job:
+            db.commit()
+            return None
+        
+        if job.status == "running" and job.attempts >= settings.SYNC_JOB_MAX_ATTEMPTS:
+            _finish_job(job, "failed", f"worker {job.locked_by} หยุดทำงานระหว่างซิงค์")
+            db.commit()
+            continue
+        
+        job.status = "running"
+        job.attempts += 1
+        job.locked_by = worker_id
+        job.locked_at = now
+        job.started_at = job.started_at or now
+        db.commit()
+        return job
+
+
+def run_job(db: Session, job: SyncJob):
+    """ทำงานตามชนิดของงาน"""
+    if job.kind == "backfill":
+        run_backfill_job(db, job)
+    else:
+        run_sync_job(db, job)
+
+
+def run_backfill_job(db: Session, job: SyncJob):
+    """แยกข้อมูลใบเสร็จของผู้ใช้ใหม่จากอีเมลในแคช พร้อมบันทึกความคืบหน้าหลังจบแต่ละชุด"""
+    def on_progress(summary):
+        job.total = summary["total"]
+        job.processed = summary["scanned"]
+        job.locked_at = datetime.now()
+        db.commit()
+    
+    try:
+        logger.info(f"เริ่มงาน backfill ID: {job.id} (ครั้งที่ {job.attempts})")
+        summary = backfill_receipts(db, user_id=job.user_id, dry_run=job.dry_run, progress_callback=on_progress)
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในงาน backfill ID: {job.id}: {str(e)}")
+        db.rollback()
+        _finish_job(job, "failed", str(e))
+        db.commit()
+        return
+    
+    job.total = summary["total"]
+    job.processed = summary["scanned"]
+    # ตัวอย่างการเปลี่ยนแปลงมีค่าวันที่ จึงแปลงเป็นข้อความก่อนเก็บแบบ JSON
+    job.result = json.loads(json.dumps(summary, default=str))
+    _finish_job(job, "completed")
+    db.commit()
+    logger.info(f"งาน backfill ID: {job.id} เสร็จสิ้น อัปเดตใบเสร็จ {summary['updated']} รายการ")
+
+
+def run_sync_job(db: Session, job: SyncJob):
+    """ซิงค์อีเมลตามงาน พร้อมบันทึกความคืบหน้า ถ้าล้มเหลวจะคืนงานเข้าคิวจนครบจำนวนครั้งที่กำหนด"""
+    imap_setting = db.query(ImapSetting).filter(
+        ImapSetting.id == job.imap_setting_id,
+        ImapSetting.user_id == job.user_id
+    ).first()
+    
+    if not imap_setting:
+        _finish_job(job, "failed", "ไม่พบการตั้งค่า IMAP")
+        db.commit()
+        return
+    
+    receipts_before = job.receipts_created
+    
+    def on_progress(progress):
+        job.total = progress["total"]
+        job.processed = progress["processed"]
+        job.receipts_created = receipts_before + progress["receipts_created"]
+        job.checkpoint_uid = progress["checkpoint_uid"]
+        # ใช้เป็น heartbeat ว่า worker ยังทำงานอยู่
+        job.locked_at = datetime.now()
+    
+    # การลองใหม่จะทำต่อจาก UID ที่บันทึกไว้ แทนการเริ่มซิงค์ใหม่ทั้งหมด
+    full_resync = job.full_resync and job.checkpoint_uid is None
+    
+    try:
+        logger.info(f"เริ่มงานซิงค์ ID: {job.id} (ครั้งที่ {job.attempts})")
+        result = SyncPipeline(db, imap_setting, job.days_back, job.max_emails, full_resync, progress_callback=on_progress).run()
+    
+    except Exception as e:
+        logger.error(f"เกิดข้อผิดพลาดในงานซิงค์ ID: {job.id}: {str(e)}")
+        db.rollback()
+        if job.attempts < settings.SYNC_JOB_MAX_ATTEMPTS:
+            # เว้นระยะก่อนลองใหม่ให้นานขึ้นตามจำนวนครั้งที่ล้มเหลว
+            job.status = "pending"
+            job.run_after = datetime.now() + timedelta(seconds=settings.SYNC_JOB_RETRY_DELAY * job.attempts)
+            job.error = str(e)
+            job.locked_by = None
+            job.locked_at = None
+        else:
+            _finish_job(job, "failed", str(e))
+            schedule_next_sync(imap_setting, new_emails=0)
+        db.commit()
+        return
+    
+    # อัปเดตเวลาซิงค์ล่าสุดเมื่อซิงค์สำเร็จเท่านั้น
+    imap_setting.last_sync = datetime.now()
+    schedule_next_sync(imap_setting, new_emails=result["found"])
+    _finish_job(job, "completed")
+    if job.rerun_requested:
+        # มีคำขอซิงค์เข้ามาระหว่างทำงาน ซิงค์อีกรอบตามค่าที่ขอ เพื่อรับอีเมลที่มาหลังการค้นหาของงานนี้
+        db.add(SyncJob(
+            user_id=job.user_id,
+            imap_setting_id=job.imap_setting_id,
+            days_back=job.rerun_days_back if job.rerun_days_back is not None else job.days_back,
+            max_emails=job.rerun_max_emails if job.rerun_max_emails is not None else job.max_emails,
+            full_resync=job.rerun_full_resync,
+            priority=job.priority
+        ))
+    db.commit()
+    logger.info(f"งานซิงค์ ID: {job.id} เสร็จสิ้น สร้างใบเสร็จ {job.receipts_created} รายการ")
+
+
+def schedule_next_sync(imap_setting: ImapSetting, new_emails: int):
+    """กำหนดเวลาซิงค์อัตโนมัติครั้งถัดไป: บัญชีที่มีอีเมลใหม่จะถูกซิงค์ถี่ขึ้นเท่าตัว
+    ส่วนบัญชีที่ไม่มีอีเมลใหม่จะเว้นระยะนานขึ้นเท่าตัว (อยู่ในช่วง SYNC_MIN_INTERVAL ถึง SYNC_MAX_INTERVAL)"""
+    interval = imap_setting.sync_interval or settings.SYNC_MIN_INTERVAL
+    interval = interval // 2 if new_emails > 0 else interval * 2
+    interval = max(settings.SYNC_MIN_INTERVAL, min(settings.SYNC_MAX_INTERVAL, interval))
+    
+    imap_setting.sync_interval = interval
+    imap_setting.next_sync_at = datetime.now() + timedelta(seconds=interval)
+
+
+def _finish_job(job: SyncJob, status: str, error: Optional[str] = None):
+    """ปิดงานและปลดล็อก"""
+    job.status = status
+    job.error = error
+    job.locked_by = None
+    job.locked_at = None
+    job.finished_at = datetime.now()
@@ -0,0 +1,48 @@
+﻿import logging
+from datetime import datetime
+
+from sqlalchemy import insert, or_, exists
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models.imap_setting import ImapSetting
+from ..models.sync_job import SyncJob
+from .sync_job_service import ACTIVE_STATUSES, SCHEDULED_PRIORITY
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+
+def schedule_due_syncs(db: Session) -> int:
+    """เพิ่มงานซิงค์ของบัญชีที่ถึงเวลาซิงค์อัตโนมัติเข้าคิว เรียงจากบัญชีที่เลยกำหนดนานที่สุด
+    คืนค่าจำนวนงานที่เพิ่ม"""
+    now = datetime.now()
+    has_active_job = exists().where(
+        SyncJob.imap_setting_id == ImapSetting.id,
+        SyncJob.status.in_(ACTIVE_STATUSES)
+    )
+    
+    # ล็อกแถวที่เลือกไว้ เพื่อไม่ให้ตัวตั้งเวลาหลายตัวเพิ่มงานของบัญชีเดียวกันซ้ำ
+    due_settings = db.query(ImapSetting.id, ImapSetting.user_id).filter(
+        ImapSetting.auto_sync.is_(True),
+        or_(ImapSetting.next_sync_at.is_(None), ImapSetting.next_sync_at <= now),
+        ~has_active_job
+    ).order_by(
+        ImapSetting.next_sync_at.is_(None).desc(),
+        ImapSetting.next_sync_at,
+        ImapSetting.id
+    ).limit(settings.SYNC_SCHEDULE_BATCH_SIZE).with_for_update(skip_locked=True).all()
+    
+    if due_settings:
+        db.execute(insert(SyncJob), [
+            {
+                "user_id": user_id,
+                "imap_setting_id": imap_setting_id,
+                "max_emails": settings.SYNC_SCHEDULE_MAX_EMAILS,
+                "priority": SCHEDULED_PRIORITY
+            }
+            for imap_setting_id, user_id in due_settings
+        ])
+        logger.info(f"เพิ่มงานซิงค์อัตโนมัติ {len(due_settings)} รายการ")
+    db.commit()
+    return len(due_settings)
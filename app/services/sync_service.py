@@ -0,0 +1,708 @@
+﻿import logging
+import multiprocessing
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional, List, Callable
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session, sessionmaker
+
+from ..config import settings
+from ..models.imap_setting import ImapSetting
+from ..models.receipt import Receipt
+from .imap_service import IMAPClient, build_email_data, build_rfc822, classify_receipt_headers, store_attachment
+from .receipt_extractor import ReceiptExtractor, receipt_identity
+from .category_service import auto_categorize_vendor
+from .receipt_service import (
+    adopt_legacy_receipts,
+    find_existing_email_ids,
+    find_legacy_receipts,
+    insert_receipts_ignore_duplicates,
+    legacy_receipt_key
+)
+from .message_cache import message_cache
+from .imap_pool import imap_pool
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# ตัวบอกว่าขั้นตอนก่อนหน้าทำงานเสร็จแล้ว
+_END_OF_STREAM = None
+
+# จำนวน UID สูงสุดในเงื่อนไข IN ของคำสั่ง UPDATE หนึ่งครั้ง
+_UPDATE_CHUNK_SIZE = 1000
+
+
+def plan_uid_shards(message_ids: List[int], shard_size: int) -> List[List[int]]:
+    """แบ่ง UID ที่เรียงแล้วเป็นช่วงต่อเนื่องช่วงละไม่เกิน shard_size รายการ"""
+    shard_size = max(1, shard_size)
+    return [message_ids[start:start + shard_size] for start in range(0, len(message_ids), shard_size)]
+
+
+class StageStats:
+    """สถิติการทำงานของแต่ละขั้นตอนใน pipeline"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, items: int = 1):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        rate = self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_second": round(rate, 1)
+        }
+
+
+def parse_and_extract(header_data: Dict[str, Any], message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """แยกวิเคราะห์ MIME และข้อมูลใบเสร็จของอีเมลหนึ่งฉบับ (ทำงานใน process pool ได้)"""
+    started = time.perf_counter()
+    email_data = build_email_data(header_data, message)
+    if not email_data:
+        return None
+
+    return {
+        "message_id": email_data["message_id"],
+        "receipt_data": ReceiptExtractor.extract_receipt_info(email_data),
+        "attachments": email_data["attachments"],
+        "seconds": time.perf_counter() - started
+    }
+
+
+def extract_cached_receipt(imap_setting_id: int, uid_validity: int, uid: int, folder: str = None) -> Optional[Dict[str, Any]]:
+    """แยกข้อมูลใบเสร็จจากอีเมลในแคช โดยไม่ต้องเชื่อมต่อ IMAP (คืนค่า None ถ้าไม่มีในแคช)"""
+    raw_email = message_cache.get(imap_setting_id, uid_validity, uid, folder)
+    if raw_email is None:
+        return None
+    return extract_raw_receipt(uid, raw_email)
+
+
+def extract_raw_receipt(uid: int, raw_email: bytes) -> Optional[Dict[str, Any]]:
+    """แยกข้อมูลใบเสร็จจากอีเมลดิบ RFC822"""
+    email_data = build_email_data({}, {"UID": uid, "RFC822": raw_email})
+    if not email_data:
+        return None
+    return ReceiptExtractor.extract_receipt_info(email_data)
+
+
+class FolderSync:
+    """สถานะของโฟลเดอร์หนึ่งระหว่างการซิงค์
+    state คือแถวที่เก็บ UIDVALIDITY/UID ล่าสุด/HIGHESTMODSEQ ของโฟลเดอร์ (ImapSetting สำหรับโฟลเดอร์หลัก
+    หรือ ImapFolderState สำหรับโฟลเดอร์เพิ่มเติม) ส่วน imap_folder คือค่าที่บันทึกใน Receipt.imap_folder และแคช"""
+
+    def __init__(self, name: str, state, imap_folder: Optional[str] = None):
+        self.name = name
+        self.state = state
+        self.imap_folder = imap_folder
+        self.uid_validity = None
+        self.since_uid = 0
+        self.message_ids: List[int] = []
+        # UID ที่ทำงานเสร็จทุกขั้นแล้ว (ถูกคัดออก ไม่ใช่ใบเสร็จ หรือบันทึกแล้ว)
+        self.processed_ids = set()
+
+    def checkpoint_uid(self) -> int:
+        """UID ล่าสุดที่ทำเสร็จต่อเนื่อง (อีเมลที่ยังไม่เสร็จจะถูกทำใหม่ในรอบถัดไป)"""
+        last_uid = self.since_uid
+        for message_id in self.message_ids:
+            if message_id not in self.processed_ids:
+                break
+            last_uid = message_id
+        return last_uid
+
+
+class SyncPipeline:
+    """ซิงค์อีเมลแบบ pipeline: ดึงจาก IMAP, แยกข้อมูล และบันทึกลงฐานข้อมูลทำงานพร้อมกัน
+    โดยเชื่อมแต่ละขั้นด้วยคิวที่จำกัดขนาด เพื่อไม่ให้ขั้นที่เร็วกว่าใช้หน่วยความจำสะสม
+    ถ้าบัญชีมีหลายโฟลเดอร์ ทุกโฟลเดอร์จะถูกดึงพร้อมกันผ่านการเชื่อมต่อจาก pool"""
+
+    def __init__(
+        self,
+        db_session: Session,
+        imap_setting: ImapSetting,
+        days_back: int = 30,
+        limit: int = 50,
+        full_resync: bool = False,
+        progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None
+    ):
+        self.db_session = db_session
+        self.imap_setting = imap_setting
+        self.user_id = imap_setting.user_id
+        self.days_back = days_back
+        self.limit = limit
+        self.full_resync = full_resync
+        self.progress_callback = progress_callback
+
+        self.fetch_queue = queue.Queue(maxsize=settings.SYNC_QUEUE_SIZE)
+        self.write_queue = queue.Queue(maxsize=settings.SYNC_QUEUE_SIZE)
+        self.stop_event = threading.Event()
+        self.errors = []
+
+        self.stats = {name: StageStats(name) for name in ("fetch", "extract", "write")}
+        # โฟลเดอร์หลักเก็บสถานะใน ImapSetting โฟลเดอร์เพิ่มเติมเก็บใน ImapFolderState
+        self.folders = [FolderSync(imap_setting.folder, imap_setting)] + [
+            FolderSync(folder_state.folder, folder_state, folder_state.folder)
+            for folder_state in imap_setting.folder_states
+        ]
+        self.last_checkpoint_at = 0.0
+        self.candidate_count = 0
+        self.receipt_count = 0
+        self.category_cache: Dict[str, Optional[int]] = {}
+        self.cache_hits = 0
+        self.source_deleted_count = 0
+        self.fetch_workers = 1
+        # รหัสใบเสร็จที่มีโฟลเดอร์ใดโฟลเดอร์หนึ่งรับไปดึงแล้ว (อีเมลเดียวกันในหลายโฟลเดอร์ดึงครั้งเดียว)
+        self.claimed_email_ids = set()
+        # ใบเสร็จแบบเดิม (imap_<หมายเลข>) ที่พบอีเมลต้นฉบับแล้ว รอเปลี่ยนเป็นรหัสใหม่ในขั้นบันทึก
+        self.legacy_adoptions: List[Dict[str, Any]] = []
+        self.adopted_receipt_ids = set()
+        self.adopted_count = 0
+        self._counter_lock = threading.Lock()
+        self.attachment_client = None
+        # ปริมาณข้อมูลที่รับส่งกับ IMAP ในการซิงค์นี้ (การเชื่อมต่อจาก pool นับเฉพาะส่วนที่ใช้ในรอบนี้)
+        self.transfer = {"bytes": 0, "wire_bytes": 0}
+        self._transfer_baselines: Dict[int, Dict[str, int]] = {}
+
+    def run(self) -> Dict[str, Any]:
+        """เริ่มซิงค์และคืนค่าสรุปผล"""
+        started = time.perf_counter()
+        imap_client = self._acquire()
+        if imap_client is None:
+            raise ConnectionError(f"ไม่สามารถเชื่อมต่อกับ IMAP ID: {self.imap_setting.id}")
+
+        succeeded = False
+        try:
+            # ค้นหาอีเมลใหม่ของทุกโฟลเดอร์ด้วยการเชื่อมต่อหลัก (คำสั่งละหนึ่งรอบต่อโฟลเดอร์)
+            shards = queue.Queue()
+            for folder in self.folders:
+                self._search_folder(imap_client, folder)
+                for shard in plan_uid_shards(folder.message_ids, settings.SYNC_SHARD_SIZE):
+                    shards.put((folder, shard))
+            found = sum(len(folder.message_ids) for folder in self.folders)
+            self._checkpoint()
+
+            # แบ่งอีเมลเป็นช่วง UID ให้ขั้นดึงข้อมูลหลายการเชื่อมต่อช่วยกันดึง (การซิงค์ทั่วไปโฟลเดอร์เดียวมีช่วงเดียว)
+            self.fetch_workers = max(1, min(settings.IMAP_MAX_CONNECTIONS_PER_SYNC, shards.qsize()))
+            if self.fetch_workers > 1:
+                logger.info(f"แบ่งอีเมล {found} รายการจาก {len(self.folders)} โฟลเดอร์เป็น {shards.qsize()} ช่วง UID ใช้ {self.fetch_workers} การเชื่อมต่อ")
+
+            # ขั้นดึงข้อมูลและขั้นแยกข้อมูลทำงานใน thread แยก ส่วนขั้นบันทึกใช้ thread ปัจจุบัน (session เดียว)
+            # การเชื่อมต่อหลักใช้กับ thread แรก thread อื่นเปิดการเชื่อมต่อของตัวเอง
+            stage_threads = [
+                threading.Thread(
+                    target=self._fetch_stage,
+                    args=(imap_client if worker == 0 else None, shards),
+                    name=f"sync-fetch-{worker}"
+                )
+                for worker in range(self.fetch_workers)
+            ]
+            stage_threads.append(threading.Thread(target=self._extract_stage, name="sync-extract"))
+            for thread in stage_threads:
+                thread.start()
+            try:
+                self._write_stage()
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                if self.errors:
+                    self.stop_event.set()
+                for thread in stage_threads:
+                    thread.join()
+
+            if self.errors:
+                raise self.errors[0]
+
+            # บันทึกสถานะ UID สำหรับการซิงค์รอบถัดไป
+            last_uid = self._checkpoint()
+
+            # จำกัดขนาดแคชอีเมลหลังซิงค์เสร็จ (สำรวจทั้งแคชเฉพาะเมื่อเกินขนาดหรือครบรอบเวลา)
+            message_cache.maybe_evict()
+            succeeded = True
+
+        finally:
+            # คืนการเชื่อมต่อเข้า pool เมื่อซิงค์สำเร็จ ถ้าล้มเหลวจะปิดการเชื่อมต่อ
+            self._release(imap_client, reusable=succeeded)
+            self._release(self.attachment_client, reusable=succeeded)
+
+        result = {
+            "found": found,
+            "candidates": self.candidate_count,
+            "cache_hits": self.cache_hits,
+            "source_deleted": self.source_deleted_count,
+            "legacy_adopted": self.adopted_count,
+            "receipts_created": self.receipt_count,
+            "last_uid": last_uid,
+            "folders": {
+                folder.name: {"found": len(folder.message_ids), "last_uid": folder.checkpoint_uid()}
+                for folder in self.folders
+            },
+            "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "stages": {name: stage.as_dict() for name, stage in self.stats.items()},
+            "transfer": self._transfer_stats()
+        }
+        for name, stage in result["stages"].items():
+            logger.info(f"ขั้นตอน {name}: {stage['items']} รายการ ใช้เวลา {stage['busy_seconds']} วินาที ({stage['items_per_second']} รายการ/วินาที)")
+        transfer = result["transfer"]
+        logger.info(f"รับส่งข้อมูล IMAP {transfer['bytes']} ไบต์ ผ่านเครือข่ายจริง {transfer['wire_bytes']} ไบต์ (อัตราการบีบอัด {transfer['compression_ratio']}x)")
+        logger.info(f"สร้างใบเสร็จใหม่ทั้งหมด {self.receipt_count} รายการ (UID ล่าสุด: {last_uid})")
+        return result
+
+    def _search_folder(self, imap_client: IMAPClient, folder: FolderSync):
+        """เลือกโฟลเดอร์ ตรวจอีเมลต้นฉบับที่ถูกลบ แล้วค้นหาอีเมลใหม่ตั้งแต่ UID ล่าสุดของโฟลเดอร์"""
+        state = folder.state
+
+        # ถ้าเคยบันทึก HIGHESTMODSEQ ไว้ ขอรายการ UID ที่ถูกลบไปตั้งแต่รอบก่อนมาพร้อมกับ SELECT (QRESYNC)
+        known_uids = self._known_source_uids(folder)
+        qresync = None
+        if known_uids and state.highest_modseq:
+            qresync = (state.uid_validity, state.highest_modseq, known_uids)
+
+        # ใช้ UID ล่าสุดที่บันทึกไว้ ถ้า UIDVALIDITY ของโฟลเดอร์ยังไม่เปลี่ยน
+        uid_validity = imap_client.select_folder(qresync=qresync, folder=folder.name)
+        folder.uid_validity = uid_validity
+        if uid_validity is None:
+            # เลือกโฟลเดอร์ไม่ได้ (เช่น โฟลเดอร์ถูกลบหรือเปลี่ยนชื่อ) ข้ามโฟลเดอร์นี้
+            return
+        if uid_validity == state.uid_validity:
+            self._flag_deleted_sources(imap_client, folder, known_uids)
+        state.highest_modseq = imap_client.highest_modseq
+
+        if not self.full_resync and state.uid_validity == uid_validity:
+            folder.since_uid = state.last_uid or 0
+        elif state.uid_validity is not None and state.uid_validity != uid_validity:
+            logger.warning(f"UIDVALIDITY ของโฟลเดอร์ {folder.name} (IMAP ID: {self.imap_setting.id}) เปลี่ยนไป เริ่มซิงค์ใหม่ทั้งหมด")
+
+        # โฟลเดอร์ถูกเลือกไว้แล้วข้างต้น (อาจเป็น SELECT แบบ QRESYNC) จึงไม่ต้องเลือกซ้ำก่อนค้นหา
+        message_ids = imap_client.search_emails(
+            days=self.days_back, limit=self.limit, since_uid=folder.since_uid, select=False
+        )
+        logger.info(f"พบอีเมลในโฟลเดอร์ {folder.name} ทั้งหมด {len(message_ids)} รายการ")
+        folder.message_ids = sorted(message_ids)
+
+    def _known_source_uids(self, folder: FolderSync) -> List[int]:
+        """UID ของอีเมลต้นฉบับของใบเสร็จที่ยังไม่ถูกลบ ใน UIDVALIDITY ที่บันทึกไว้ของโฟลเดอร์"""
+        if folder.state.uid_validity is None:
+            return []
+        rows = self.db_session.query(Receipt.imap_uid).filter(
+            Receipt.imap_setting_id == self.imap_setting.id,
+            self._folder_filter(folder),
+            Receipt.imap_uidvalidity == folder.state.uid_validity,
+            Receipt.imap_uid.isnot(None),
+            Receipt.source_deleted.is_(False)
+        ).all()
+        return sorted(uid for uid, in rows)
+
+    def _flag_deleted_sources(self, imap_client: IMAPClient, folder: FolderSync, known_uids: List[int]):
+        """ทำเครื่องหมายใบเสร็จที่อีเมลต้นฉบับถูกลบหรือย้ายออกจากโฟลเดอร์
+        QRESYNC แจ้ง UID ที่หายไปมาพร้อม SELECT ถ้ามีเพียง CONDSTORE จะค้นหาเฉพาะเมื่อ HIGHESTMODSEQ เปลี่ยน"""
+        if not known_uids:
+            return
+        if imap_client.vanished is not None:
+            deleted = set(imap_client.vanished) & set(known_uids)
+        elif (
+            imap_client.highest_modseq is not None
+            and folder.state.highest_modseq is not None
+            and imap_client.highest_modseq != folder.state.highest_modseq
+        ):
+            deleted = set(known_uids) - set(imap_client.search_existing_uids(known_uids))
+        else:
+            # ไม่มีการเปลี่ยนแปลงในโฟลเดอร์ หรือเซิร์ฟเวอร์ไม่รองรับ CONDSTORE
+            return
+        if not deleted:
+            return
+
+        deleted = sorted(deleted)
+        for start in range(0, len(deleted), _UPDATE_CHUNK_SIZE):
+            self.db_session.execute(
+                update(Receipt).where(
+                    Receipt.imap_setting_id == self.imap_setting.id,
+                    self._folder_filter(folder),
+                    Receipt.imap_uidvalidity == folder.state.uid_validity,
+                    Receipt.imap_uid.in_(deleted[start:start + _UPDATE_CHUNK_SIZE])
+                ).values(source_deleted=True)
+            )
+        self.source_deleted_count += len(deleted)
+        logger.info(f"อีเมลต้นฉบับของใบเสร็จ {len(deleted)} รายการถูกลบจากโฟลเดอร์ {folder.name} (IMAP ID: {self.imap_setting.id})")
+
+    @staticmethod
+    def _folder_filter(folder: FolderSync):
+        """เงื่อนไขเลือกใบเสร็จของโฟลเดอร์ (โฟลเดอร์หลักเก็บ imap_folder เป็น NULL)"""
+        if folder.imap_folder is None:
+            return Receipt.imap_folder.is_(None)
+        return Receipt.imap_folder == folder.imap_folder
+
+    def _put(self, target_queue: queue.Queue, item) -> bool:
+        """ใส่ข้อมูลลงคิว โดยรอเมื่อคิวเต็ม (backpressure) และเลิกรอเมื่อ pipeline ถูกหยุด"""
+        while not self.stop_event.is_set():
+            try:
+                target_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _acquire(self) -> Optional[IMAPClient]:
+        """ยืมการเชื่อมต่อจาก pool และจำจำนวนไบต์ที่รับส่งไปแล้วของการเชื่อมต่อนั้น"""
+        client = imap_pool.acquire(self.imap_setting)
+        if client is not None:
+            with self._counter_lock:
+                self._transfer_baselines[id(client)] = client.transfer_counters()
+        return client
+
+    def _release(self, client: Optional[IMAPClient], reusable: bool):
+        """รวมจำนวนไบต์ที่รับส่งระหว่างการซิงค์นี้ แล้วคืนการเชื่อมต่อเข้า pool"""
+        if client is None:
+            return
+        counters = client.transfer_counters()
+        with self._counter_lock:
+            baseline = self._transfer_baselines.pop(id(client), {})
+            for key, value in counters.items():
+                self.transfer[key] += value - baseline.get(key, 0)
+        imap_pool.release(client, reusable=reusable)
+
+    def _transfer_stats(self) -> Dict[str, Any]:
+        wire_bytes = self.transfer["wire_bytes"]
+        ratio = self.transfer["bytes"] / wire_bytes if wire_bytes > 0 else 1.0
+        return {**self.transfer, "compression_ratio": round(ratio, 2)}
+
+    def _fetch_stage(self, imap_client: Optional[IMAPClient], shards: queue.Queue):
+        """ขั้นที่ 1: ดึงอีเมลทีละช่วง UID (ของโฟลเดอร์ใดก็ได้) จากคิวจนหมด
+        ถ้าไม่ได้รับการเชื่อมต่อมาจะเปิดการเชื่อมต่อของตัวเอง (เปิดไม่ได้ก็ปล่อยให้ thread อื่นทำแทน)"""
+        own_client = None
+        try:
+            if imap_client is None:
+                own_client = imap_client = self._acquire()
+                if imap_client is None:
+                    logger.warning(f"เปิดการเชื่อมต่อเพิ่มกับ IMAP ID: {self.imap_setting.id} ไม่ได้ ใช้การเชื่อมต่อที่มีอยู่แทน")
+                    return
+
+            while not self.stop_event.is_set():
+                try:
+                    folder, shard = shards.get_nowait()
+                except queue.Empty:
+                    break
+                self._select_for(imap_client, folder)
+                self._fetch_shard(imap_client, folder, shard)
+
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในขั้นตอนดึงอีเมล: {str(e)}")
+            self.errors.append(e)
+            self.stop_event.set()
+
+        finally:
+            self._release(own_client, reusable=not self.errors)
+            self._put(self.fetch_queue, _END_OF_STREAM)
+
+    def _select_for(self, imap_client: IMAPClient, folder: FolderSync):
+        """เลือกโฟลเดอร์บนการเชื่อมต่อนี้ถ้ายังไม่ได้เลือก และตรวจว่า UIDVALIDITY ตรงกับตอนค้นหา"""
+        if imap_client.folder == folder.name and imap_client.uid_validity == folder.uid_validity:
+            return
+        if imap_client.select_folder(folder=folder.name) != folder.uid_validity:
+            raise ConnectionError(f"UIDVALIDITY ของโฟลเดอร์ {folder.name} (IMAP ID: {self.imap_setting.id}) เปลี่ยนระหว่างซิงค์")
+
+    def _fetch_shard(self, imap_client: IMAPClient, folder: FolderSync, message_ids: List[int]):
+        """ดึง header ของช่วง UID มาคัดกรอง แล้วดึงเฉพาะส่วนข้อความของอีเมลที่ผ่าน"""
+        stats = self.stats["fetch"]
+        candidates = []
+        skipped = 0
+        skipped_bytes = 0
+        source_counts = Counter()
+
+        started = time.perf_counter()
+        for header_data in imap_client.fetch_headers(message_ids):
+            source_name = classify_receipt_headers(header_data)
+            if source_name:
+                candidates.append(header_data)
+                source_counts[source_name] += 1
+            else:
+                folder.processed_ids.add(header_data["message_id"])
+                skipped += 1
+                skipped_bytes += header_data["size"]
+        stats.add(time.perf_counter() - started, items=0)
+
+        for source_name, count in source_counts.items():
+            logger.info(f"พบอีเมลจาก {source_name} {count} รายการ")
+        logger.info(f"คัดกรองจาก header ของโฟลเดอร์ {folder.name} เหลือ {len(candidates)} รายการ ข้าม {skipped} รายการ ({skipped_bytes} ไบต์)")
+
+        # ข้ามอีเมลที่มีใบเสร็จอยู่แล้ว (เช่น จากโฟลเดอร์หรือบัญชีอื่น) ก่อนดาวน์โหลดเนื้อหา
+        candidates = self._skip_known_receipts(folder, candidates)
+        with self._counter_lock:
+            self.candidate_count += len(candidates)
+
+        # อีเมลที่อยู่ในแคชแล้วไม่ต้องดึงเนื้อหาจากเซิร์ฟเวอร์อีก
+        remaining = []
+        for header_data in candidates:
+            if self.stop_event.is_set():
+                return
+            raw_email = message_cache.get(self.imap_setting.id, folder.uid_validity, header_data["message_id"], folder.imap_folder)
+            if raw_email is None:
+                remaining.append(header_data)
+                continue
+            with self._counter_lock:
+                self.cache_hits += 1
+            message = {"UID": header_data["message_id"], "RFC822": raw_email, "CACHED": True}
+            if not self._put(self.fetch_queue, (folder, header_data, message)):
+                return
+
+        # วัดเฉพาะเวลาที่รอข้อมูลจากเซิร์ฟเวอร์ ไม่รวมเวลาที่รอคิวว่าง
+        fetched = iter(imap_client.fetch_raw_text_parts(remaining))
+        while not self.stop_event.is_set():
+            started = time.perf_counter()
+            item = next(fetched, _END_OF_STREAM)
+            stats.add(time.perf_counter() - started, items=0 if item is _END_OF_STREAM else 1)
+            if item is _END_OF_STREAM:
+                break
+            header_data, message = item
+            message_cache.put(
+                self.imap_setting.id,
+                folder.uid_validity,
+                header_data["message_id"],
+                build_rfc822(header_data, message),
+                folder.imap_folder
+            )
+            if not self._put(self.fetch_queue, (folder, header_data, message)):
+                break
+
+    def _skip_known_receipts(self, folder: FolderSync, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ตัดอีเมลที่มีรหัสใบเสร็จอยู่ในฐานข้อมูลแล้ว หรือกำลังถูกดึงจากโฟลเดอร์อื่น ออกจากรายการที่จะดาวน์โหลด
+        อีเมลที่ตรงกับใบเสร็จแบบเดิม (imap_<หมายเลข>) จะไม่ถูกดึงซ้ำ แต่ใบเสร็จนั้นจะถูกเปลี่ยนเป็นรหัสใหม่"""
+        if not candidates:
+            return candidates
+
+        # session ของ pipeline ถูกใช้โดยขั้นบันทึก จึงเปิด session แยกสำหรับเธรดนี้
+        db = sessionmaker(bind=self.db_session.get_bind())()
+        try:
+            email_ids = [receipt_identity(header_data)["email_id"] for header_data in candidates]
+            existing = set()
+            chunk_size = settings.SYNC_WRITE_BATCH_SIZE
+            for start in range(0, len(email_ids), chunk_size):
+                existing |= find_existing_email_ids(db, self.user_id, email_ids[start:start + chunk_size])
+
+            unknown = [header_data for header_data, email_id in zip(candidates, email_ids) if email_id not in existing]
+            legacy = {}
+            for start in range(0, len(unknown), chunk_size):
+                legacy.update(find_legacy_receipts(db, self.user_id, unknown[start:start + chunk_size]))
+        finally:
+            db.close()
+
+        remaining = []
+        with self._counter_lock:
+            for header_data, email_id in zip(candidates, email_ids):
+                legacy_id = legacy.get(legacy_receipt_key(header_data["from"], header_data["subject"], header_data["date"]))
+                if email_id in existing or email_id in self.claimed_email_ids:
+                    folder.processed_ids.add(header_data["message_id"])
+                elif legacy_id is not None and legacy_id not in self.adopted_receipt_ids:
+                    identity = receipt_identity(header_data)
+                    self.adopted_receipt_ids.add(legacy_id)
+                    self.claimed_email_ids.add(email_id)
+                    self.legacy_adoptions.append({
+                        "id": legacy_id,
+                        **identity,
+                        "imap_setting_id": self.imap_setting.id,
+                        "imap_folder": folder.imap_folder,
+                        "imap_uidvalidity": folder.uid_validity,
+                        "imap_uid": header_data["message_id"]
+                    })
+                    folder.processed_ids.add(header_data["message_id"])
+                else:
+                    self.claimed_email_ids.add(email_id)
+                    remaining.append(header_data)
+
+        if len(remaining) < len(candidates):
+            logger.info(f"ข้ามอีเมลที่มีใบเสร็จอยู่แล้ว {len(candidates) - len(remaining)} รายการ")
+        return remaining
+
+    def _extract_stage(self):
+        """ขั้นที่ 2: แยกวิเคราะห์ MIME และข้อมูลใบเสร็จ (ใช้ process pool เมื่อมีอีเมลจำนวนมาก)"""
+        stats = self.stats["extract"]
+        executor = None
+        pending = deque()
+        running_fetchers = self.fetch_workers
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    item = self.fetch_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if item is _END_OF_STREAM:
+                    # รอจนทุก thread ของขั้นดึงข้อมูลทำงานเสร็จ
+                    running_fetchers -= 1
+                    if running_fetchers == 0:
+                        break
+                    continue
+
+                if executor is None and settings.SYNC_EXTRACT_WORKERS > 0 and self.candidate_count >= settings.SYNC_PROCESS_POOL_MIN:
+                    executor = ProcessPoolExecutor(
+                        max_workers=settings.SYNC_EXTRACT_WORKERS,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+
+                folder, header_data, message = item
+                if executor:
+                    pending.append((folder, header_data["message_id"], executor.submit(parse_and_extract, header_data, message)))
+                    # จำกัดจำนวนงานที่ค้างอยู่ใน pool
+                    while len(pending) >= settings.SYNC_EXTRACT_WORKERS * 2:
+                        folder, message_id, future = pending.popleft()
+                        self._forward_result(folder, message_id, future.result(), stats)
+                else:
+                    self._forward_result(folder, header_data["message_id"], parse_and_extract(header_data, message), stats)
+
+            while pending and not self.stop_event.is_set():
+                folder, message_id, future = pending.popleft()
+                self._forward_result(folder, message_id, future.result(), stats)
+
+        except Exception as e:
+            logger.error(f"เกิดข้อผิดพลาดในขั้นตอนแยกข้อมูลใบเสร็จ: {str(e)}")
+            self.errors.append(e)
+            self.stop_event.set()
+
+        finally:
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            self._put(self.write_queue, _END_OF_STREAM)
+
+    def _forward_result(self, folder: FolderSync, message_id: int, result: Optional[Dict[str, Any]], stats: StageStats):
+        """ส่งผลการแยกข้อมูลที่เป็นใบเสร็จไปยังขั้นบันทึก"""
+        if not result:
+            folder.processed_ids.add(message_id)
+            return
+        stats.add(result["seconds"])
+        receipt_data = result["receipt_data"]
+        if not receipt_data or receipt_data["amount"] == 0:
+            folder.processed_ids.add(message_id)
+            return
+        result["folder"] = folder
+        self._put(self.write_queue, result)
+
+    def _write_stage(self):
+        """ขั้นที่ 3: บันทึกใบเสร็จลงฐานข้อมูลเป็นชุด"""
+        batch = []
+        while not self.stop_event.is_set():
+            try:
+                item = self.write_queue.get(timeout=0.5)
+            except queue.Empty:
+                # รายงานความคืบหน้าแม้ยังไม่มีใบเสร็จให้บันทึก
+                if time.monotonic() - self.last_checkpoint_at >= settings.SYNC_PROGRESS_INTERVAL:
+                    self._checkpoint()
+                continue
+            if item is _END_OF_STREAM:
+                break
+            batch.append(item)
+            if len(batch) >= settings.SYNC_WRITE_BATCH_SIZE:
+                self._write_batch(batch)
+                batch = []
+
+        if batch and not self.stop_event.is_set():
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """บันทึกใบเสร็จหนึ่งชุดด้วยการตรวจซ้ำและ INSERT อย่างละหนึ่งคำสั่ง แล้ว commit"""
+        started = time.perf_counter()
+
+        # ตรวจสอบใบเสร็จที่มีอยู่แล้วของทั้งชุดในคำสั่งเดียว
+        seen_email_ids = find_existing_email_ids(
+            self.db_session,
+            self.user_id,
+            [item["receipt_data"]["email_id"] for item in batch]
+        )
+
+        rows = []
+        for item in batch:
+            receipt_data = item["receipt_data"]
+            if receipt_data["email_id"] in seen_email_ids:
+                continue
+            seen_email_ids.add(receipt_data["email_id"])
+            folder = item["folder"]
+
+            # ระบุหมวดหมู่อัตโนมัติตามผู้ให้บริการ (จำผลไว้ใช้กับผู้ให้บริการเดิม)
+            vendor_name = receipt_data["vendor_name"]
+            if vendor_name not in self.category_cache:
+                self.category_cache[vendor_name] = auto_categorize_vendor(vendor_name, self.db_session)
+
+            # ดึงไฟล์แนบลงที่เก็บไฟล์เฉพาะใบเสร็จที่จะบันทึกจริง
+            file_info = {}
+            if receipt_data["receipt_file_path"] and item["attachments"]:
+                file_info = self._store_attachment(folder, item["message_id"], item["attachments"][0])
+
+            rows.append({
+                "user_id": self.user_id,
+                "email_id": receipt_data["email_id"],
+                "message_id": receipt_data["message_id"],
+                "content_hash": receipt_data["content_hash"],
+                "imap_setting_id": self.imap_setting.id,
+                "imap_folder": folder.imap_folder,
+                "imap_uidvalidity": folder.uid_validity,
+                "imap_uid": item["message_id"],
+                "email_subject": receipt_data["email_subject"],
+                "email_from": receipt_data["email_from"],
+                "email_date": receipt_data["email_date"],
+                "vendor_name": vendor_name,
+                "receipt_date": receipt_data["receipt_date"],
+                "amount": receipt_data["amount"],
+                "currency": receipt_data["currency"],
+                "receipt_file_path": file_info.get("receipt_file_path"),
+                "receipt_file_name": file_info.get("receipt_file_name", receipt_data["receipt_file_path"]),
+                "receipt_file_type": file_info.get("receipt_file_type"),
+                "category_id": self.category_cache[vendor_name],
+            })
+
+        # รายการที่ถูกบันทึกไปแล้วโดยการซิงค์อื่นระหว่างนี้จะถูกข้ามโดยฐานข้อมูล
+        self.receipt_count += insert_receipts_ignore_duplicates(self.db_session, rows)
+        for item in batch:
+            item["folder"].processed_ids.add(item["message_id"])
+        self._checkpoint()
+        self.stats["write"].add(time.perf_counter() - started, items=len(batch))
+
+    def _checkpoint(self) -> int:
+        """บันทึก UID ล่าสุดที่ทำเสร็จต่อเนื่องของทุกโฟลเดอร์และรายงานความคืบหน้า แล้ว commit (เรียกจาก thread หลักเท่านั้น)
+        คืนค่า UID ล่าสุดที่บันทึกของโฟลเดอร์หลัก"""
+        for folder in self.folders:
+            if folder.uid_validity is None:
+                continue
+            last_uid = folder.checkpoint_uid()
+            if folder.state.uid_validity != folder.uid_validity:
+                folder.state.uid_validity = folder.uid_validity
+                folder.state.last_uid = last_uid
+            else:
+                folder.state.last_uid = max(folder.state.last_uid or 0, last_uid)
+
+        # เปลี่ยนรหัสใบเสร็จแบบเดิมที่พบอีเมลต้นฉบับแล้วใน transaction เดียวกับสถานะ UID
+        with self._counter_lock:
+            adoptions, self.legacy_adoptions = self.legacy_adoptions, []
+        if adoptions:
+            self.adopted_count += adopt_legacy_receipts(self.db_session, self.user_id, adoptions)
+
+        primary_uid = self.folders[0].checkpoint_uid()
+        if self.progress_callback:
+            self.progress_callback({
+                "total": sum(len(folder.message_ids) for folder in self.folders),
+                "processed": sum(len(folder.processed_ids) for folder in self.folders),
+                "receipts_created": self.receipt_count,
+                "checkpoint_uid": primary_uid
+            })
+
+        self.db_session.commit()
+        self.last_checkpoint_at = time.monotonic()
+        return primary_uid
+
+    def _store_attachment(self, folder: FolderSync, message_id: int, attachment: Dict[str, Any]) -> Dict[str, Any]:
+        """ดึงไฟล์แนบผ่านการเชื่อมต่อแยก เพราะการเชื่อมต่อหลักถูกใช้โดยขั้นดึงข้อมูล"""
+        if "content" in attachment:
+            return store_attachment(message_id, attachment) or {}
+
+        if self.attachment_client is None:
+            self.attachment_client = self._acquire()
+            if self.attachment_client is None:
+                return {}
+        self._select_for(self.attachment_client, folder)
+        return store_attachment(message_id, attachment, self.attachment_client) or {}
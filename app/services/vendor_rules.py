@@ -0,0 +1,334 @@
+﻿import os
+import re
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from email.utils import parseaddr
+from typing import Dict, Any, Optional, List, Callable, Tuple
+
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+
+from ..config import settings
+from .email_text import email_text
+
+# ตั้งค่า logging
+logger = logging.getLogger(__name__)
+
+# เดือนแบบย่อภาษาไทยกับชื่อย่อภาษาอังกฤษ (ใช้แปลงก่อน strptime)
+THAI_MONTHS = {
+    'ม.ค.': 'Jan', 'ก.พ.': 'Feb', 'มี.ค.': 'Mar', 'เม.ย.': 'Apr',
+    'พ.ค.': 'May', 'มิ.ย.': 'Jun', 'ก.ค.': 'Jul', 'ส.ค.': 'Aug',
+    'ก.ย.': 'Sep', 'ต.ค.': 'Oct', 'พ.ย.': 'Nov', 'ธ.ค.': 'Dec'
+}
+_THAI_MONTH_RE = re.compile('|'.join(re.escape(month) for month in THAI_MONTHS))
+
+
+def sender_domain(from_header: str) -> str:
+    """โดเมนของอีเมลผู้ส่ง (ตัวพิมพ์เล็ก) เช่น "Steam <noreply@steampowered.com>" เป็น steampowered.com"""
+    if not from_header:
+        return ""
+    address = parseaddr(from_header)[1] or from_header
+    return address.rpartition("@")[2].strip().strip(">").lower()
+
+
+def _compile_pattern(pattern: str) -> re.Pattern:
+    """คอมไพล์ regex ของเทมเพลต (ต้องมีกลุ่มอย่างน้อยหนึ่งกลุ่มสำหรับค่าที่ต้องการ)"""
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"regex ไม่ถูกต้อง {pattern!r}: {e}")
+    if compiled.groups < 1:
+        raise ValueError(f"regex {pattern!r} ต้องมีกลุ่ม (...) สำหรับค่าที่ต้องการ")
+    return compiled
+
+
+class DatePatternTemplate(BaseModel):
+    """รูปแบบวันที่ใบเสร็จ: regex (กลุ่มแรกคือวันที่) และรูปแบบของ strptime ที่ลองตามลำดับ"""
+    model_config = {"extra": "forbid"}
+
+    pattern: str
+    formats: List[str] = Field(min_length=1)
+    thai_months: bool = False
+
+    @field_validator("pattern")
+    @classmethod
+    def _valid_pattern(cls, value: str) -> str:
+        _compile_pattern(value)
+        return value
+
+
+class SearchSourceTemplate(BaseModel):
+    """เงื่อนไขค้นหาบนเซิร์ฟเวอร์: ผู้ส่ง (ตรงกับโดเมนใดก็ได้) และคำในหัวข้อ (ตรงกับคำใดก็ได้)"""
+    model_config = {"extra": "forbid", "populate_by_name": True}
+
+    from_: List[str] = Field(default_factory=list, alias="from")
+    subject: List[str] = Field(default_factory=list)
+
+    @model_validator(mode="after")
+    def _not_empty(self):
+        if not self.from_ and not self.subject:
+            raise ValueError("ต้องระบุ from หรือ subject อย่างน้อยหนึ่งอย่าง")
+        return self
+
+
+class VendorTemplate(BaseModel):
+    """เทมเพลตของผู้ให้บริการหนึ่งราย (หนึ่งไฟล์ใน app/vendor_templates)
+    ถ้าไม่มี domains และ sender_keywords จะใช้เฉพาะค้นหาบนเซิร์ฟเวอร์ ส่วนการแยกข้อมูลใช้การตรวจจับทั่วไป
+    sender_keywords คือคำที่อยู่ส่วนใดก็ได้ของผู้ส่ง (ชื่อหรือที่อยู่) ใช้เมื่อไม่พบกฎจากโดเมน"""
+    model_config = {"extra": "forbid"}
+
+    name: str = Field(min_length=1)
+    domains: List[str] = Field(default_factory=list)
+    sender_keywords: List[str] = Field(default_factory=list)
+    currency: str = Field(default="THB", min_length=3, max_length=3)
+    search: List[SearchSourceTemplate] = Field(default_factory=list)
+    subject_hints: List[str] = Field(default_factory=list)
+    amount_patterns: List[str] = Field(default_factory=list)
+    date_patterns: List[DatePatternTemplate] = Field(default_factory=list)
+    fields: Dict[str, str] = Field(default_factory=dict)
+    attach_receipt_file: bool = False
+
+    @field_validator("domains", "sender_keywords")
+    @classmethod
+    def _lower_domains(cls, value: List[str]) -> List[str]:
+        return [domain.strip().lower() for domain in value if domain.strip()]
+
+    @field_validator("amount_patterns")
+    @classmethod
+    def _valid_amount_patterns(cls, value: List[str]) -> List[str]:
+        for pattern in value:
+            _compile_pattern(pattern)
+        return value
+
+    @field_validator("fields")
+    @classmethod
+    def _valid_fields(cls, value: Dict[str, str]) -> Dict[str, str]:
+        for pattern in value.values():
+            _compile_pattern(pattern)
+        return value
+
+    @model_validator(mode="after")
+    def _default_search(self):
+        # ค่าเริ่มต้น: ค้นหาจากโดเมนผู้ส่งของผู้ให้บริการ
+        if not self.search and self.domains:
+            self.search = [SearchSourceTemplate(from_=self.domains)]
+        return self
+
+
+class VendorRule:
+    """กฎแยกข้อมูลใบเสร็จของผู้ให้บริการหนึ่งราย: ชื่อ โดเมนผู้ส่ง และฟังก์ชันแยกข้อมูล"""
+
+    def __init__(
+        self,
+        name: str,
+        domains: List[str],
+        extractor: Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]],
+        sender_keywords: List[str] = ()
+    ):
+        self.name = name
+        self.domains = [domain.lower() for domain in domains]
+        self.sender_keywords = [keyword.lower() for keyword in sender_keywords]
+        self._extractor = extractor
+
+    def extract(self, email_data: Dict[str, Any], base_result: Dict[str, Any]) -> Dict[str, Any]:
+        """แยกข้อมูลใบเสร็จ โดยเริ่มจากสำเนาของข้อมูลพื้นฐาน"""
+        result = base_result.copy()
+        result["vendor_name"] = self.name
+        return self._extractor(email_data, result)
+
+
+class VendorRegistry:
+    """ทะเบียนกฎของผู้ให้บริการ ค้นหาจากโดเมนผู้ส่งด้วย dict (ไล่จากโดเมนเต็มไปหาโดเมนหลัก)
+    เวลาค้นหาขึ้นกับจำนวนส่วนของโดเมน ไม่ขึ้นกับจำนวนผู้ให้บริการ
+    (คำในผู้ส่งของผู้ให้บริการที่ระบุ sender_keywords ตรวจทีละคำ เฉพาะเมื่อไม่พบจากโดเมน)"""
+
+    def __init__(self):
+        self.rules: List[VendorRule] = []
+        self._by_domain: Dict[str, VendorRule] = {}
+        self._by_keyword: Dict[str, VendorRule] = {}
+
+    def register(self, rule: VendorRule) -> VendorRule:
+        for domain in rule.domains:
+            if domain in self._by_domain:
+                raise ValueError(f"โดเมน {domain} ถูกใช้โดย {self._by_domain[domain].name} แล้ว")
+            self._by_domain[domain] = rule
+        for keyword in rule.sender_keywords:
+            if keyword in self._by_keyword:
+                raise ValueError(f"คำ {keyword} ถูกใช้โดย {self._by_keyword[keyword].name} แล้ว")
+            self._by_keyword[keyword] = rule
+        self.rules.append(rule)
+        return rule
+
+    def match(self, from_header: str) -> Optional[VendorRule]:
+        """กฎของผู้ส่ง (รวมโดเมนย่อย เช่น email.apple.com ใช้กฎของ apple.com) หรือ None"""
+        domain = sender_domain(from_header)
+        while domain:
+            rule = self._by_domain.get(domain)
+            if rule is not None:
+                return rule
+            domain = domain.partition(".")[2]
+
+        sender = (from_header or "").lower()
+        for keyword, rule in self._by_keyword.items():
+            if keyword in sender:
+                return rule
+        return None
+
+
+class TemplateExtractor:
+    """ตัวแยกข้อมูลที่คอมไพล์จากเทมเพลต (regex ทั้งหมดคอมไพล์ครั้งเดียวตอนโหลด)"""
+
+    def __init__(self, template: VendorTemplate):
+        self.currency = template.currency.upper()
+        self.amount_patterns = [_compile_pattern(pattern) for pattern in template.amount_patterns]
+        self.date_patterns: List[Tuple[re.Pattern, List[str], bool]] = [
+            (_compile_pattern(date.pattern), date.formats, date.thai_months) for date in template.date_patterns
+        ]
+        self.fields = {name: _compile_pattern(pattern) for name, pattern in template.fields.items()}
+        self.attach_receipt_file = template.attach_receipt_file
+        self.vendor_name = template.name
+
+    def __call__(self, email_data: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        body = email_text(email_data)
+        result["currency"] = self.currency
+
+        # จำนวนเงินจากรูปแบบแรกที่พบ
+        for pattern in self.amount_patterns:
+            match = pattern.search(body)
+            if match:
+                try:
+                    result["amount"] = float(match.group(1).replace(',', ''))
+                    break
+                except ValueError:
+                    continue
+
+        # วันที่ใบเสร็จจากรูปแบบแรกที่พบ
+        for pattern, formats, thai_months in self.date_patterns:
+            match = pattern.search(body)
+            if not match:
+                continue
+            date_str = match.group(1).strip()
+            if thai_months:
+                date_str = _THAI_MONTH_RE.sub(lambda month: THAI_MONTHS[month.group(0)], date_str)
+            receipt_date = _parse_date(date_str, formats)
+            if receipt_date is not None:
+                result["receipt_date"] = receipt_date
+            else:
+                logger.warning(f"ไม่สามารถแปลงวันที่ {self.vendor_name}: {date_str}")
+            break
+
+        # ข้อมูลเพิ่มเติม เช่น เลขที่รายการ หรือชื่อสินค้า
+        for name, pattern in self.fields.items():
+            match = pattern.search(body)
+            if match:
+                result[name] = match.group(1).strip()
+
+        # ถ้ามี attachments ให้ใช้ไฟล์แรก
+        if self.attach_receipt_file and email_data["attachments"]:
+            result["receipt_file_path"] = email_data["attachments"][0]["filename"]
+
+        return result
+
+
+def _parse_date(date_str: str, formats: List[str]) -> Optional[datetime]:
+    """แปลงวันที่ตามรูปแบบแรกที่ใช้ได้"""
+    for date_format in formats:
+        try:
+            return datetime.strptime(date_str, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+class VendorCatalog:
+    """ผลการคอมไพล์เทมเพลตทั้งหมด: ทะเบียนกฎแยกข้อมูล แหล่งค้นหาบนเซิร์ฟเวอร์ และคำบ่งบอกในหัวข้อ"""
+
+    def __init__(self, templates: List[VendorTemplate]):
+        self.templates = templates
+        self.registry = VendorRegistry()
+        # แหล่งที่มาของใบเสร็จ: ใช้ทั้งสร้างเงื่อนไขค้นหาบนเซิร์ฟเวอร์ และคัดกรองจาก header ก่อนดาวน์โหลดเนื้อหา
+        self.sources: List[Dict[str, Any]] = []
+        # คำในหัวข้อที่บ่งบอกว่าเป็นใบเสร็จ สำหรับผู้ส่งที่มีอีเมลการตลาดปนมามาก
+        self.subject_hints: Dict[str, List[str]] = {}
+        # เงื่อนไข SEARCH ที่รวมแล้ว (imap_service สร้างเมื่อใช้ครั้งแรก)
+        self.search_criteria: Optional[str] = None
+
+        for template in templates:
+            if template.domains or template.sender_keywords:
+                self.registry.register(VendorRule(
+                    template.name, template.domains, TemplateExtractor(template), template.sender_keywords
+                ))
+            for source in template.search:
+                self.sources.append({"name": template.name, "from": source.from_, "subject": source.subject})
+            if template.subject_hints:
+                for domain in template.domains:
+                    self.subject_hints[domain] = template.subject_hints
+
+
+def load_vendor_templates(directory: str) -> List[VendorTemplate]:
+    """โหลดและตรวจสอบเทมเพลตทุกไฟล์ .json ในโฟลเดอร์ (เรียงตามชื่อไฟล์) ถ้าไฟล์ใดไม่ถูกต้องจะ raise ValueError"""
+    templates = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            with open(path, encoding="utf-8") as template_file:
+                templates.append(VendorTemplate.model_validate(json.load(template_file)))
+        except (OSError, json.JSONDecodeError, ValidationError) as e:
+            raise ValueError(f"เทมเพลตผู้ให้บริการ {filename} ไม่ถูกต้อง: {e}")
+    return templates
+
+
+class VendorTemplateStore:
+    """เก็บ VendorCatalog ปัจจุบัน และโหลดใหม่เมื่อไฟล์เทมเพลตเปลี่ยน (ตรวจไม่เกินทุก reload_interval วินาที)
+    ถ้าโหลดใหม่ไม่สำเร็จจะใช้ชุดเดิมต่อไป ทำให้ worker ที่ทำงานอยู่รับเทมเพลตใหม่ได้โดยไม่ต้องรีสตาร์ท"""
+
+    def __init__(self, directory: str, reload_interval: float):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._catalog: Optional[VendorCatalog] = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def catalog(self) -> VendorCatalog:
+        """ชุดเทมเพลตที่คอมไพล์แล้ว (ครั้งแรกถ้าเทมเพลตไม่ถูกต้องจะ raise ValueError)"""
+        if self._catalog is None or time.monotonic() - self._checked_at >= self.reload_interval:
+            with self._lock:
+                if self._catalog is None or time.monotonic() - self._checked_at >= self.reload_interval:
+                    self._reload_if_changed()
+        return self._catalog
+
+    def _signature_of_files(self) -> Tuple:
+        """ชื่อไฟล์ เวลาแก้ไข และขนาดของเทมเพลตทั้งหมด"""
+        signature = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(signature))
+
+    def _reload_if_changed(self):
+        self._checked_at = time.monotonic()
+        try:
+            signature = self._signature_of_files()
+            if signature == self._signature and self._catalog is not None:
+                return
+            catalog = VendorCatalog(load_vendor_templates(self.directory))
+        except (OSError, ValueError) as e:
+            if self._catalog is None:
+                raise ValueError(f"ไม่สามารถโหลดเทมเพลตผู้ให้บริการจาก {self.directory}: {e}")
+            logger.error(f"โหลดเทมเพลตผู้ให้บริการใหม่ไม่สำเร็จ ใช้ชุดเดิมต่อ: {str(e)}")
+            return
+
+        if self._catalog is not None:
+            logger.info(f"โหลดเทมเพลตผู้ให้บริการใหม่ {len(catalog.templates)} รายการ")
+        self._catalog = catalog
+        self._signature = signature
+
+
+vendor_templates = VendorTemplateStore(settings.VENDOR_TEMPLATE_DIR, settings.VENDOR_TEMPLATE_RELOAD_INTERVAL)
@@ -0,0 +1,73 @@
+﻿import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from .config import settings
+from .database import SessionLocal, Base, engine
+from . import models  # noqa: F401 โหลด model ทั้งหมดก่อนใช้งาน
+from .services.sync_job_service import claim_next_job, run_job
+from .services.sync_scheduler import schedule_due_syncs
+from .services.imap_pool import imap_pool
+
+# ตั้งค่า logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def run_worker(once: bool = False, schedule: bool = True):
+    """วนรับงานซิงค์ (และงาน backfill) จากคิวในฐานข้อมูล จนกว่าจะได้รับสัญญาณให้หยุด
+    และเพิ่มงานซิงค์อัตโนมัติของบัญชีที่ถึงกำหนดทุก SYNC_SCHEDULE_INTERVAL วินาที"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = threading.Event()
+    
+    def request_stop(signum, frame):
+        # ทำงานปัจจุบันให้เสร็จก่อนแล้วจึงหยุด
+        logger.info(f"worker {worker_id} ได้รับสัญญาณหยุดทำงาน")
+        stop_event.set()
+    
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    
+    logger.info(f"เริ่ม worker {worker_id}")
+    last_scheduled = None
+    try:
+        while not stop_event.is_set():
+            db = SessionLocal()
+            try:
+                if schedule and (last_scheduled is None or time.monotonic() - last_scheduled >= settings.SYNC_SCHEDULE_INTERVAL):
+                    schedule_due_syncs(db)
+                    last_scheduled = time.monotonic()
+                job = claim_next_job(db, worker_id)
+                if job:
+                    run_job(db, job)
+            finally:
+                db.close()
+            
+            if job:
+                continue
+            if once:
+                break
+            stop_event.wait(settings.SYNC_WORKER_POLL_INTERVAL)
+    finally:
+        # ปิดการเชื่อมต่อ IMAP ที่ค้างอยู่ใน pool
+        imap_pool.close_all()
+
+
+def main():
+    """worker สำหรับซิงค์อีเมล: python -m app.worker"""
+    parser = argparse.ArgumentParser(description="worker สำหรับซิงค์อีเมลจากคิวงาน")
+    parser.add_argument("--once", action="store_true", help="ทำงานที่รออยู่ทั้งหมดแล้วหยุด")
+    parser.add_argument("--no-schedule", action="store_true", help="ไม่เพิ่มงานซิงค์อัตโนมัติ (รับเฉพาะงานในคิว)")
+    args = parser.parse_args()
+    
+    # สร้างตารางในฐานข้อมูล (กรณี worker เริ่มก่อน API)
+    Base.metadata.create_all(bind=engine)
+    run_worker(once=args.once, schedule=not args.no_schedule)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+﻿import argparse
+import gc
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# ให้รันเป็นสคริปต์ได้ (python benchmarks/run.py) โดยไม่ต้องตั้ง PYTHONPATH
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.services import imap_service
+from app.services.imap_service import parse_email
+from app.services.receipt_extractor import ReceiptExtractor
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+CORPUS_DIR = BENCHMARK_DIR / "corpus"
+GROUND_TRUTH_PATH = BENCHMARK_DIR / "ground_truth.json"
+BASELINE_PATH = BENCHMARK_DIR / "baseline.json"
+
+# ช่องข้อมูลที่ตรวจความถูกต้องเทียบกับ ground_truth.json
+FIELDS = ("vendor_name", "amount", "currency", "receipt_date")
+
+
+def load_corpus() -> List[Tuple[str, bytes, Dict[str, Any]]]:
+    """อ่านอีเมลตัวอย่างพร้อมค่าที่ถูกต้อง คืนค่า [(ชื่อไฟล์, RFC822, ค่าที่ถูกต้อง)]"""
+    with open(GROUND_TRUTH_PATH, encoding="utf-8") as f:
+        ground_truth = json.load(f)
+    corpus = []
+    for name, expected in sorted(ground_truth.items()):
+        corpus.append((name, (CORPUS_DIR / name).read_bytes(), expected))
+    return corpus
+
+
+def _field_value(result: Optional[Dict[str, Any]], field: str):
+    """ค่าของช่องข้อมูลในรูปที่เทียบกับ ground truth ได้ (วันที่เทียบเฉพาะวัน)"""
+    if not result:
+        return None
+    value = result.get(field)
+    if field == "receipt_date" and value is not None:
+        return value.strftime("%Y-%m-%d")
+    if field == "amount" and value is not None:
+        return round(float(value), 2)
+    return value
+
+
+def build_targets(corpus) -> Dict[str, Tuple[Callable[[Any], Any], List[Any]]]:
+    """ตัวแยกข้อมูลที่วัดผล คืนค่า {ชื่อ: (ฟังก์ชัน, ข้อมูลเข้าของแต่ละอีเมลตามลำดับ corpus)}
+    - receipt_extractor: ReceiptExtractor.extract_receipt_info กับอีเมลที่แยกส่วนไว้แล้ว (วัดเฉพาะการแยกข้อมูล)
+    - imap_service: แยกส่วนอีเมลจาก RFC822 แล้วเรียก imap_service.extract_receipt_info (เส้นทางเดียวกับการซิงค์)"""
+    parsed = [parse_email(index, raw) for index, (_, raw, _) in enumerate(corpus)]
+
+    def parse_and_extract(item):
+        index, raw = item
+        return imap_service.extract_receipt_info(parse_email(index, raw))
+
+    return {
+        "receipt_extractor": (ReceiptExtractor.extract_receipt_info, parsed),
+        "imap_service": (parse_and_extract, [(index, raw) for index, (_, raw, _) in enumerate(corpus)])
+    }
+
+
+def _timed_round(func: Callable[[Any], Any], inputs: List[Any], repeat: int) -> Tuple[float, List[int]]:
+    """แยกข้อมูลทั้งชุดตัวอย่าง repeat รอบ คืนค่า (เวลารวมเป็นวินาที, latency ของแต่ละอีเมลเป็น ns)"""
+    latencies = []
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            begin = time.perf_counter_ns()
+            func(item)
+            latencies.append(time.perf_counter_ns() - begin)
+    return time.perf_counter() - started, latencies
+
+
+def measure(func: Callable[[Any], Any], inputs: List[Any], repeat: int, rounds: int) -> Dict[str, Any]:
+    """วัดความเร็ว (จำนวนอีเมลต่อวินาที และ latency ต่ออีเมล) และหน่วยความจำสูงสุดระหว่างแยกข้อมูล
+    ใช้ผลของรอบที่เร็วที่สุด เพื่อลดผลจากงานอื่นบนเครื่องเดียวกัน"""
+    # รอบอุ่นเครื่อง: คอมไพล์ regex และโหลดเทมเพลตก่อนเริ่มจับเวลา
+    for item in inputs:
+        func(item)
+
+    elapsed, latencies = min((_timed_round(func, inputs, repeat) for _ in range(rounds)), key=lambda result: result[0])
+
+    # วัดหน่วยความจำแยกรอบ เพราะ tracemalloc ทำให้ช้าลงมาก
+    gc.collect()
+    tracemalloc.start()
+    for item in inputs:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "messages_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(quantiles[49] / 1e6, 4),
+        "p99_ms": round(quantiles[98] / 1e6, 4),
+        "peak_kib": round(peak / 1024, 1)
+    }
+
+
+def score(func: Callable[[Any], Any], inputs: List[Any], corpus) -> Tuple[Dict[str, float], List[str]]:
+    """ความถูกต้องของแต่ละช่องข้อมูล (สัดส่วนที่ตรงกับ ground truth) และรายการที่ไม่ตรง"""
+    correct = {field: 0 for field in FIELDS}
+    mismatches = []
+    for item, (name, _, expected) in zip(inputs, corpus):
+        result = func(item)
+        for field in FIELDS:
+            actual = _field_value(result, field)
+            if actual == expected.get(field):
+                correct[field] += 1
+            else:
+                mismatches.append(f"{name}: {field} ได้ {actual!r} ควรเป็น {expected.get(field)!r}")
+    accuracy = {field: round(count / len(corpus), 4) for field, count in correct.items()}
+    return accuracy, mismatches
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, check_timing: bool) -> List[str]:
+    """เทียบผลกับค่าอ้างอิง คืนค่ารายการที่แย่ลง (ความถูกต้องต้องไม่ลดลงเลย ส่วนเวลาและหน่วยความจำตรวจเมื่อ check_timing
+    และยอมให้ต่างได้ตาม tolerance)"""
+    regressions = []
+    for target, current in report.items():
+        reference = baseline.get("targets", {}).get(target)
+        if reference is None:
+            continue
+        for field, value in current["accuracy"].items():
+            expected = reference["accuracy"].get(field)
+            if expected is not None and value < expected:
+                regressions.append(f"{target}: ความถูกต้องของ {field} ลดลง {expected} -> {value}")
+        if not check_timing:
+            continue
+        if current["messages_per_sec"] < reference["messages_per_sec"] * (1 - tolerance):
+            regressions.append(f"{target}: messages/sec ลดลง {reference['messages_per_sec']} -> {current['messages_per_sec']}")
+        for metric in ("p50_ms", "p99_ms", "peak_kib"):
+            if current[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(f"{target}: {metric} เพิ่มขึ้น {reference[metric]} -> {current[metric]}")
+    return regressions
+
+
+def main():
+    """วัดความเร็วและความถูกต้องของการแยกข้อมูลใบเสร็จ: python benchmarks/run.py [--check-timing] [--update-baseline]
+    ผ่าน/ไม่ผ่านตัดสินจากความถูกต้องเท่านั้น ค่าเวลาขึ้นกับเครื่อง จึงเทียบเมื่อระบุ --check-timing
+    กับค่าอ้างอิงที่บันทึกบนเครื่องเดียวกัน"""
+    parser = argparse.ArgumentParser(description="วัดความเร็วและความถูกต้องของการแยกข้อมูลใบเสร็จเทียบกับค่าอ้างอิง")
+    parser.add_argument("--repeat", type=int, default=20, help="จำนวนครั้งที่แยกข้อมูลทั้งชุดตัวอย่างในหนึ่งรอบจับเวลา")
+    parser.add_argument("--rounds", type=int, default=5, help="จำนวนรอบจับเวลา (ใช้รอบที่เร็วที่สุด)")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="สัดส่วนที่ยอมให้เวลาและหน่วยความจำแย่กว่าค่าอ้างอิง")
+    parser.add_argument("--check-timing", action="store_true", help="ตรวจเวลาและหน่วยความจำด้วย (ใช้กับค่าอ้างอิงที่บันทึกบนเครื่องเดียวกันเท่านั้น)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH, help="ไฟล์ค่าอ้างอิง")
+    parser.add_argument("--update-baseline", action="store_true", help="บันทึกผลครั้งนี้เป็นค่าอ้างอิงใหม่")
+    parser.add_argument("--verbose", action="store_true", help="แสดงรายการที่แยกข้อมูลไม่ตรงกับ ground truth")
+    args = parser.parse_args()
+
+    # log ระดับ INFO ของการแยกข้อมูลทั่วไปมีทุกอีเมล ทำให้ผลการจับเวลาคลาดเคลื่อน
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    corpus = load_corpus()
+    report = {}
+    for target, (func, inputs) in build_targets(corpus).items():
+        accuracy, mismatches = score(func, inputs, corpus)
+        report[target] = dict(measure(func, inputs, args.repeat, args.rounds), accuracy=accuracy)
+        print(
+            f"{target:<18} {report[target]['messages_per_sec']:>10.1f} msg/s  "
+            f"p50 {report[target]['p50_ms']:.3f} ms  p99 {report[target]['p99_ms']:.3f} ms  "
+            f"peak {report[target]['peak_kib']:.1f} KiB  "
+            + "  ".join(f"{field} {value:.0%}" for field, value in accuracy.items())
+        )
+        if args.verbose:
+            for mismatch in mismatches:
+                print(f"    {mismatch}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"messages": len(corpus), "targets": report}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"บันทึกค่าอ้างอิงที่ {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print(f"ไม่พบค่าอ้างอิง {args.baseline} (ใช้ --update-baseline เพื่อสร้าง)")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance, args.check_timing)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("ไม่พบการถดถอยเมื่อเทียบกับค่าอ้างอิง")
+
+
+if __name__ == "__main__":
+    main()
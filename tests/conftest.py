@@ -0,0 +1,78 @@
+﻿import os
+import tempfile
+
+# ใช้ฐานข้อมูล SQLite และที่เก็บไฟล์ชั่วคราว ต้องตั้งก่อน import app (settings อ่านค่าตอน import)
+_TEST_DIR = tempfile.mkdtemp(prefix="savvy-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_TEST_DIR, 'test.db')}"
+os.environ["ATTACHMENT_STORE_DIR"] = os.path.join(_TEST_DIR, "attachments")
+os.environ["MESSAGE_CACHE_DIR"] = os.path.join(_TEST_DIR, "messages")
+
+import pytest
+
+from app.database import Base, SessionLocal, engine
+from app.models import ImapSetting, User
+from app.services.encryption_service import encrypt_password
+from app.services.init_data import create_initial_categories
+
+from .fake_imap import FakeIMAPServer
+
+
+@pytest.fixture
+def imap_server():
+    """เซิร์ฟเวอร์ IMAP จำลองที่เริ่มใหม่ทุกการทดสอบ"""
+    server = FakeIMAPServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def imap_setting(imap_server):
+    """การตั้งค่า IMAP ที่ชี้ไปยังเซิร์ฟเวอร์จำลอง (ไม่ได้บันทึกลงฐานข้อมูล)"""
+    return ImapSetting(
+        id=1,
+        user_id=1,
+        email=imap_server.username,
+        server="127.0.0.1",
+        port=imap_server.port,
+        username=imap_server.username,
+        password_encrypted=encrypt_password(imap_server.password),
+        use_ssl=False,
+        folder="INBOX"
+    )
+
+
+@pytest.fixture
+def db():
+    """session ของฐานข้อมูล SQLite ที่สร้างตารางใหม่ทุกการทดสอบ"""
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    create_initial_categories(session)
+    yield session
+    session.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def user(db):
+    user = User(username="tester", email="tester@example.com", password_hash="x")
+    db.add(user)
+    db.commit()
+    return user
+
+
+@pytest.fixture
+def stored_imap_setting(db, user, imap_server):
+    """การตั้งค่า IMAP ของ user ที่บันทึกในฐานข้อมูลแล้ว ชี้ไปยังเซิร์ฟเวอร์จำลอง"""
+    imap_setting = ImapSetting(
+        user_id=user.id,
+        email=imap_server.username,
+        server="127.0.0.1",
+        port=imap_server.port,
+        username=imap_server.username,
+        password_encrypted=encrypt_password(imap_server.password),
+        use_ssl=False,
+        folder="INBOX"
+    )
+    db.add(imap_setting)
+    db.commit()
+    return imap_setting
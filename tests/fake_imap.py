@@ -0,0 +1,440 @@
+﻿import email
+import re
+import select
+import socket
+import socketserver
+import threading
+import zlib
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+# ความสามารถเริ่มต้นของเซิร์ฟเวอร์จำลอง (ทดสอบกรณีไม่รองรับได้โดยแก้ FakeIMAPServer.capabilities)
+# CONDSTORE/QRESYNC ไม่ได้เปิดเป็นค่าเริ่มต้น การทดสอบที่ต้องการให้เพิ่ม "CONDSTORE" หรือ "ENABLE" กับ "QRESYNC" เอง
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "ESEARCH", "IDLE", "COMPRESS=DEFLATE")
+
+_LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+_FETCH_ITEM_RE = re.compile(r"BODY(?:\.PEEK)?\[[^\]]*\]|[A-Z0-9.]+")
+_SECTION_RE = re.compile(r"BODY(?:\.PEEK)?\[([^\]]*)\]")
+
+
+def make_message(from_: str, subject: str, body: str, html: str = None,
+                 date: str = "Mon, 13 Oct 2026 10:00:00 +0700", message_id: str = None) -> bytes:
+    """สร้างอีเมล RFC822 (CRLF) สำหรับใส่ในกล่องจดหมายจำลอง (เนื้อหา ASCII ส่งแบบ 7bit ส่วนภาษาอื่นเข้ารหัส base64)"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    def text_part(content, subtype):
+        return MIMEText(content, subtype, "us-ascii" if content.isascii() else "utf-8")
+
+    if html is None:
+        msg = text_part(body, "plain")
+    else:
+        msg = MIMEMultipart("alternative")
+        msg.attach(text_part(body, "plain"))
+        msg.attach(text_part(html, "html"))
+    msg["From"] = from_
+    msg["Subject"] = subject
+    msg["Date"] = date
+    msg["Message-ID"] = message_id or f"<{abs(hash((from_, subject, body)))}@fake.example>"
+    return msg.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def tokenize(line: str) -> list:
+    """แยกอาร์กิวเมนต์ของคำสั่ง สตริงในเครื่องหมายคำพูดคืนค่าเป็น ("Q", ค่า)"""
+    tokens = []
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if char.isspace():
+            i += 1
+        elif char in "()":
+            tokens.append(char)
+            i += 1
+        elif char == '"':
+            i += 1
+            value = ""
+            while line[i] != '"':
+                if line[i] == "\\":
+                    i += 1
+                value += line[i]
+                i += 1
+            tokens.append(("Q", value))
+            i += 1
+        else:
+            start = i
+            while i < len(line) and not line[i].isspace() and line[i] not in "()":
+                i += 1
+            tokens.append(line[start:i])
+    return tokens
+
+
+def _text(token) -> str:
+    return token[1] if isinstance(token, tuple) else token
+
+
+def parse_uid_set(spec: str, max_uid: int) -> set:
+    """แปลงชุด UID เช่น 1:3,7,10:* เป็นเซต"""
+    uids = set()
+    for part in spec.split(","):
+        bounds = [max_uid if value == "*" else int(value) for value in part.split(":")]
+        uids.update(range(min(bounds), max(bounds) + 1))
+    return uids
+
+
+def body_structure(part) -> str:
+    """BODYSTRUCTURE ของอีเมล (เฉพาะส่วนที่ IMAPClient ใช้)"""
+    if part.is_multipart():
+        children = "".join(body_structure(child) for child in part.get_payload())
+        return f'({children} "{part.get_content_subtype().upper()}")'
+    charset = part.get_content_charset()
+    params = f'("CHARSET" "{charset}")' if charset else "NIL"
+    encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+    payload = part.get_payload()
+    structure = (
+        f'"{part.get_content_maintype().upper()}" "{part.get_content_subtype().upper()}" {params} '
+        f'NIL NIL "{encoding}" {len(payload.encode())}'
+    )
+    if part.get_content_maintype() == "text":
+        structure += f" {payload.count(chr(10))}"
+    return f"({structure})"
+
+
+def message_section(msg, raw: bytes, section: str) -> bytes:
+    """เนื้อหาของ BODY[section]"""
+    if section == "":
+        return raw
+    if section.startswith("HEADER.FIELDS"):
+        names = re.search(r"\((.*)\)", section).group(1).split()
+        lines = [f"{name}: {msg[name]}\r\n" for name in names if msg[name] is not None]
+        return "".join(lines).encode() + b"\r\n"
+    if section == "HEADER":
+        return raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+    if section == "TEXT":
+        return raw.split(b"\r\n\r\n", 1)[1]
+    part = msg
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode()
+
+
+class FakeMailbox:
+    """โฟลเดอร์จำลอง: รายการ [UID, RFC822] เรียงตาม UID
+    ทุกการเปลี่ยนแปลงเพิ่ม highest_modseq และจำ UID ที่ถูกลบพร้อม modseq ไว้ตอบ VANISHED (RFC 7162)"""
+
+    def __init__(self, messages: List[bytes] = (), uid_validity: int = 1000, start_uid: int = 100):
+        self.uid_validity = uid_validity
+        self.next_uid = start_uid
+        self.highest_modseq = 1
+        self.messages = []
+        self.expunged: List[Tuple[int, int]] = []
+        self.lock = threading.Lock()
+        for raw in messages:
+            self.add(raw)
+
+    def add(self, raw: bytes) -> int:
+        """เพิ่มอีเมลใหม่ (ระหว่าง IDLE จะแจ้ง EXISTS ให้ client)"""
+        with self.lock:
+            uid = self.next_uid
+            self.messages.append([uid, raw])
+            self.next_uid += 1
+            self.highest_modseq += 1
+            return uid
+
+    def expunge(self, uid: int):
+        """ลบอีเมลออกจากโฟลเดอร์ (จำลองผู้ใช้ลบหรือย้ายอีเมล)"""
+        with self.lock:
+            self.messages = [message for message in self.messages if message[0] != uid]
+            self.highest_modseq += 1
+            self.expunged.append((uid, self.highest_modseq))
+
+    def vanished_since(self, modseq: int, uids: set) -> List[int]:
+        """UID ที่ถูกลบหลัง modseq ที่ระบุ (เฉพาะใน uids)"""
+        with self.lock:
+            return sorted(uid for uid, expunged_at in self.expunged if expunged_at > modseq and uid in uids)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """การเชื่อมต่อหนึ่งรายการของเซิร์ฟเวอร์จำลอง"""
+
+    def setup(self):
+        self.fake: "FakeIMAPServer" = self.server.fake
+        self.buffer = b""
+        self.compressor = None
+        self.decompressor = None
+        self.mailbox: Optional[FakeMailbox] = None
+        self.qresync_enabled = False
+        with self.fake.lock:
+            self.fake.connections += 1
+            self.fake.open_sockets.add(self.request)
+
+    def finish(self):
+        with self.fake.lock:
+            self.fake.open_sockets.discard(self.request)
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.request.sendall(data)
+
+    def _fill(self) -> bool:
+        chunk = self.request.recv(65536)
+        if not chunk:
+            return False
+        self.buffer += self.decompressor.decompress(chunk) if self.decompressor else chunk
+        return True
+
+    def read_line(self) -> bytes:
+        while b"\r\n" not in self.buffer:
+            if not self._fill():
+                return b""
+        line, self.buffer = self.buffer.split(b"\r\n", 1)
+        return line + b"\r\n"
+
+    def read_command(self) -> Optional[str]:
+        """อ่านคำสั่งหนึ่งบรรทัด รวม literal {n} (ตอบ + ก่อนรับข้อมูล)"""
+        line = self.read_line()
+        if not line:
+            return None
+        while True:
+            match = _LITERAL_RE.search(line)
+            if not match:
+                break
+            self.send("+ ready\r\n")
+            size = int(match.group(1))
+            while len(self.buffer) < size:
+                if not self._fill():
+                    return None
+            literal, self.buffer = self.buffer[:size], self.buffer[size:]
+            quoted = b'"' + literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+            line = line[:match.start()] + quoted + self.read_line()
+        return line.decode().rstrip("\r\n")
+
+    def handle(self):
+        self.send("* OK fake IMAP ready\r\n")
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            self.fake.commands.append(line)
+            tag, _, rest = line.partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+            handler = getattr(self, "do_" + command.replace(" ", "_"), None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command\r\n")
+                continue
+            if handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(f"* CAPABILITY {' '.join(self.fake.capabilities)}\r\n{tag} OK done\r\n")
+
+    def do_LOGIN(self, tag, args):
+        username, password = (_text(token) for token in tokenize(args))
+        if (username, password) != (self.fake.username, self.fake.password):
+            self.send(f"{tag} NO [AUTHENTICATIONFAILED] invalid credentials\r\n")
+            return
+        self.send(f"{tag} OK logged in\r\n")
+
+    def do_LOGOUT(self, tag, args):
+        self.send(f"* BYE logging out\r\n{tag} OK bye\r\n")
+        return False
+
+    def do_NOOP(self, tag, args):
+        if self.mailbox:
+            self.send(f"* {len(self.mailbox.messages)} EXISTS\r\n")
+        self.send(f"{tag} OK noop\r\n")
+
+    def do_ENABLE(self, tag, args):
+        enabled = [name for name in args.upper().split() if name in self.fake.capabilities]
+        if "QRESYNC" in enabled:
+            self.qresync_enabled = True
+        self.send(f"* ENABLED {' '.join(enabled)}\r\n{tag} OK enabled\r\n")
+
+    def do_COMPRESS(self, tag, args):
+        self.send(f"{tag} OK DEFLATE active\r\n")
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+    def do_SELECT(self, tag, args):
+        tokens = tokenize(args)
+        name = _text(tokens[0])
+        self.mailbox = self.fake.mailboxes.get(name)
+        if self.mailbox is None:
+            self.send(f"{tag} NO no such mailbox\r\n")
+            return
+        # SELECT "name" (QRESYNC (uidvalidity modseq [known-uids]))
+        qresync = tokens[4:-2] if tokens[2:3] == ["QRESYNC"] else None
+        if qresync is not None and not self.qresync_enabled:
+            self.send(f"{tag} BAD QRESYNC not enabled\r\n")
+            return
+
+        response = [
+            f"* {len(self.mailbox.messages)} EXISTS\r\n",
+            f"* OK [UIDVALIDITY {self.mailbox.uid_validity}] UIDs valid\r\n",
+            f"* OK [UIDNEXT {self.mailbox.next_uid}] predicted next UID\r\n"
+        ]
+        if "CONDSTORE" in self.fake.capabilities or self.qresync_enabled:
+            response.append(f"* OK [HIGHESTMODSEQ {self.mailbox.highest_modseq}] highest\r\n")
+        # UIDVALIDITY ไม่ตรงกัน ข้อมูลการลบเดิมใช้ไม่ได้ จึงไม่แจ้ง VANISHED
+        if qresync and int(qresync[0]) == self.mailbox.uid_validity:
+            known = parse_uid_set(qresync[2], self.mailbox.next_uid) if len(qresync) > 2 else set(range(1, self.mailbox.next_uid))
+            vanished = self.mailbox.vanished_since(int(qresync[1]), known)
+            if vanished:
+                response.append(f"* VANISHED (EARLIER) {','.join(map(str, vanished))}\r\n")
+        response.append(f"{tag} OK [READ-WRITE] selected\r\n")
+        self.send("".join(response))
+
+    def do_IDLE(self, tag, args):
+        self.send("+ idling\r\n")
+        known = len(self.mailbox.messages)
+        while True:
+            if b"\r\n" in self.buffer or select.select([self.request], [], [], 0.05)[0]:
+                line = self.read_line()
+                if not line:
+                    return False
+                if line.strip().upper() == b"DONE":
+                    break
+            if len(self.mailbox.messages) != known:
+                known = len(self.mailbox.messages)
+                self.send(f"* {known} EXISTS\r\n")
+        self.send(f"{tag} OK IDLE terminated\r\n")
+
+    def do_UID_SEARCH(self, tag, args):
+        tokens = tokenize(args)
+        esearch = tokens[:1] == ["RETURN"]
+        if esearch:
+            tokens = tokens[tokens.index(")") + 1:]
+        if tokens[:1] == ["CHARSET"]:
+            tokens = tokens[2:]
+        max_uid = max((uid for uid, _ in self.mailbox.messages), default=0)
+
+        def parse(i):
+            token = tokens[i]
+            if token == "(":
+                conditions = []
+                i += 1
+                while tokens[i] != ")":
+                    condition, i = parse(i)
+                    conditions.append(condition)
+                return (lambda uid, msg: all(c(uid, msg) for c in conditions)), i + 1
+            key = token.upper()
+            if key == "OR":
+                left, i = parse(i + 1)
+                right, i = parse(i)
+                return (lambda uid, msg: left(uid, msg) or right(uid, msg)), i
+            if key == "NOT":
+                inner, i = parse(i + 1)
+                return (lambda uid, msg: not inner(uid, msg)), i
+            if key in ("FROM", "SUBJECT"):
+                value = _text(tokens[i + 1]).lower()
+                return (lambda uid, msg: value in str(msg[key.title()] or "").lower()), i + 2
+            if key == "SINCE":
+                since = datetime.strptime(_text(tokens[i + 1]), "%d-%b-%Y").date()
+                return (lambda uid, msg: parsedate_to_datetime(msg["Date"]).date() >= since), i + 2
+            if key == "UID":
+                uids = parse_uid_set(tokens[i + 1], max_uid)
+                return (lambda uid, msg: uid in uids), i + 2
+            if key == "ALL":
+                return (lambda uid, msg: True), i + 1
+            raise ValueError(f"unsupported search key {key}")
+
+        conditions = []
+        i = 0
+        while i < len(tokens):
+            condition, i = parse(i)
+            conditions.append(condition)
+        matches = [
+            uid for uid, raw in self.mailbox.messages
+            if all(condition(uid, email.message_from_bytes(raw)) for condition in conditions)
+        ]
+
+        if esearch:
+            response = f'* ESEARCH (TAG "{tag}") UID'
+            if matches:
+                response += " ALL " + ",".join(map(str, matches))
+            self.send(f"{response}\r\n{tag} OK search done\r\n")
+        else:
+            self.send(f"* SEARCH {' '.join(map(str, matches))}\r\n{tag} OK search done\r\n")
+
+    def do_UID_FETCH(self, tag, args):
+        uid_set, _, items = args.partition(" ")
+        max_uid = max((uid for uid, _ in self.mailbox.messages), default=0)
+        uids = parse_uid_set(uid_set, max_uid)
+        names = _FETCH_ITEM_RE.findall(items.strip()[1:-1])
+        for sequence, (uid, raw) in enumerate(self.mailbox.messages, 1):
+            if uid not in uids:
+                continue
+            msg = email.message_from_bytes(raw)
+            response = [f"* {sequence} FETCH (UID {uid}".encode()]
+            for name in names:
+                if name == "RFC822":
+                    response.append(f" RFC822 {{{len(raw)}}}\r\n".encode() + raw)
+                elif name == "RFC822.SIZE":
+                    response.append(f" RFC822.SIZE {len(raw)}".encode())
+                elif name == "BODYSTRUCTURE":
+                    response.append(f" BODYSTRUCTURE {body_structure(msg)}".encode())
+                elif name.startswith("BODY"):
+                    section = _SECTION_RE.match(name).group(1)
+                    data = message_section(msg, raw, section)
+                    response.append(f" BODY[{section}] {{{len(data)}}}\r\n".encode() + data)
+            response.append(b")\r\n")
+            self.send(b"".join(response))
+        self.send(f"{tag} OK fetch done\r\n")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeIMAPServer:
+    """เซิร์ฟเวอร์ IMAP จำลองบน localhost สำหรับทดสอบ (รองรับเฉพาะคำสั่งที่ client ของแอปใช้)"""
+
+    def __init__(self, username: str = "user@example.com", password: str = "secret"):
+        self.username = username
+        self.password = password
+        self.capabilities = list(DEFAULT_CAPABILITIES)
+        self.mailboxes: Dict[str, FakeMailbox] = {"INBOX": FakeMailbox()}
+        self.commands: List[str] = []
+        self.connections = 0
+        self.open_sockets = set()
+        self.lock = threading.Lock()
+        self._server = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "FakeIMAPServer":
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop_connections(self):
+        """ตัดการเชื่อมต่อที่เปิดอยู่ทั้งหมดจากฝั่งเซิร์ฟเวอร์ (จำลองเซิร์ฟเวอร์ปิดการเชื่อมต่อที่ว่างนาน)"""
+        with self.lock:
+            sockets = list(self.open_sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def commands_named(self, name: str) -> List[str]:
+        """คำสั่งที่ได้รับ (ไม่รวม tag) ที่ขึ้นต้นด้วย name"""
+        commands = [command.partition(" ")[2] for command in self.commands]
+        return [command for command in commands if command.upper().startswith(name.upper())]
@@ -0,0 +1,179 @@
+﻿import asyncio
+
+import pytest
+
+from app.config import settings
+from app.services.async_imap_service import AsyncIMAPClient
+
+from .fake_imap import FakeMailbox, make_message
+
+SHOP_CRITERIA = 'FROM "shop.example"'
+
+
+@pytest.fixture
+def mailbox(imap_server):
+    """กล่องจดหมายที่มีใบเสร็จสามฉบับ (UID 100-102) และอีเมลอื่นหนึ่งฉบับ (UID 103)"""
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message("Shop <orders@shop.example>", "Receipt #1", "ยอดรวม 120.00 บาท"),
+        make_message("Shop <orders@shop.example>", "Receipt #2", "Total: 80.50 THB",
+                     html="<p>Total: <b>80.50</b> THB</p>"),
+        # header และเนื้อหาที่คล้ายไวยากรณ์ IMAP ต้องอ่านจาก literal ได้ถูกต้อง
+        make_message("Shop <orders@shop.example>", "Receipt #3 (paid) {12}", 'Total (VAT) {5}\r\n"350.00" THB'),
+        make_message("Friend <friend@mail.example>", "Lunch?", "See you at noon")
+    ])
+    return imap_server.mailboxes["INBOX"]
+
+
+def _client(imap_setting) -> AsyncIMAPClient:
+    return AsyncIMAPClient(imap_setting, timeout=5)
+
+
+def test_connect_reads_greeting_and_logs_in(imap_server, imap_setting):
+    async def run():
+        async with _client(imap_setting) as client:
+            return client.capabilities
+
+    capabilities = asyncio.run(run())
+
+    assert "ESEARCH" in capabilities
+    assert imap_server.commands_named("LOGIN")
+    assert imap_server.commands_named("CAPABILITY")
+    assert imap_server.commands_named("LOGOUT")
+
+
+def test_connect_fails_with_wrong_password(imap_server, imap_setting):
+    imap_server.password = "other"
+    client = _client(imap_setting)
+
+    assert asyncio.run(client.connect()) is False
+    assert client.writer is None
+
+
+def test_select_folder_returns_uid_validity(imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            return await client.select_folder(), client.exists
+
+    assert asyncio.run(run()) == (1000, 4)
+
+
+def test_select_missing_folder_returns_none(imap_setting, mailbox):
+    imap_setting.folder = "Receipts"
+
+    async def run():
+        async with _client(imap_setting) as client:
+            return await client.select_folder()
+
+    assert asyncio.run(run()) is None
+
+
+def test_search_uses_esearch(imap_server, imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            return await client.search_emails(days=0, search_criteria=SHOP_CRITERIA)
+
+    assert asyncio.run(run()) == [102, 101, 100]
+    assert imap_server.commands_named("UID SEARCH RETURN (ALL)")
+
+
+def test_search_falls_back_to_plain_search(imap_server, imap_setting, mailbox):
+    imap_server.capabilities.remove("ESEARCH")
+
+    async def run():
+        async with _client(imap_setting) as client:
+            return await client.search_emails(days=0, search_criteria=SHOP_CRITERIA)
+
+    assert asyncio.run(run()) == [102, 101, 100]
+    assert not imap_server.commands_named("UID SEARCH RETURN")
+    assert imap_server.commands_named("UID SEARCH")
+
+
+def test_search_since_uid_returns_only_newer_uids(imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            return await client.search_emails(days=0, search_criteria=SHOP_CRITERIA, since_uid=100)
+
+    assert asyncio.run(run()) == [101, 102]
+
+
+def test_fetch_reads_literals(imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            await client.select_folder()
+            headers = [header async for header in client.fetch_headers([100, 101, 102])]
+            text_parts = [email_data async for email_data in client.fetch_text_parts(headers)]
+            emails = [email_data async for email_data in client.fetch_emails([100, 101, 102])]
+            return headers, text_parts, emails
+
+    headers, text_parts, emails = asyncio.run(run())
+
+    assert [header["subject"] for header in headers] == ["Receipt #1", "Receipt #2", "Receipt #3 (paid) {12}"]
+    assert all(header["size"] > 0 and header["parts"] for header in headers)
+    assert {email_data["message_id"] for email_data in text_parts} == {100, 101, 102}
+    assert [email_data["message_id"] for email_data in emails] == [100, 101, 102]
+    assert "ยอดรวม 120.00 บาท" in emails[0]["body"]
+    assert 'Total (VAT) {5}\r\n"350.00" THB' in emails[2]["body"]
+    html_email = next(email_data for email_data in text_parts if email_data["message_id"] == 101)
+    assert "<b>80.50</b>" in html_email["body"]
+    assert "Total: 80.50 THB" in html_email["text"]
+
+
+def test_idle_reports_new_mail(imap_server, imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            await client.select_folder()
+            idle = asyncio.create_task(client.idle(5))
+            while not imap_server.commands_named("IDLE"):
+                await asyncio.sleep(0.01)
+            mailbox.add(make_message("Shop <orders@shop.example>", "Receipt #4", "Total: 10.00 THB"))
+            new_mail = await idle
+            # หลัง DONE การเชื่อมต่อต้องกลับมารับคำสั่งตามปกติ
+            return new_mail, client.exists, await client.noop()
+
+    assert asyncio.run(run()) == (True, 5, False)
+
+
+def test_idle_times_out_without_new_mail(imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            await client.select_folder()
+            return await client.idle(0.2), await client.search_emails(days=0, search_criteria=SHOP_CRITERIA)
+
+    assert asyncio.run(run()) == (False, [102, 101, 100])
+
+
+def test_compress_deflate_is_negotiated(imap_server, imap_setting, mailbox):
+    async def run():
+        async with _client(imap_setting) as client:
+            uids = await client.search_emails(days=0, search_criteria=SHOP_CRITERIA)
+            emails = [email_data async for email_data in client.fetch_emails(uids)]
+            return client.compression_enabled, len(emails)
+
+    assert asyncio.run(run()) == (True, 3)
+    assert imap_server.commands_named("COMPRESS DEFLATE")
+
+
+def test_compress_can_be_disabled(monkeypatch, imap_server, imap_setting, mailbox):
+    monkeypatch.setattr(settings, "IMAP_COMPRESS", False)
+
+    async def run():
+        async with _client(imap_setting) as client:
+            return client.compression_enabled
+
+    assert asyncio.run(run()) is False
+    assert not imap_server.commands_named("COMPRESS")
+
+
+def test_concurrent_sessions(imap_server, imap_setting, mailbox):
+    async def session():
+        async with _client(imap_setting) as client:
+            uids = await client.search_emails(days=0, search_criteria=SHOP_CRITERIA)
+            return [header["subject"] async for header in client.fetch_headers(uids)]
+
+    async def run():
+        return await asyncio.gather(*(session() for _ in range(20)))
+
+    results = asyncio.run(run())
+
+    assert all(result == ["Receipt #1", "Receipt #2", "Receipt #3 (paid) {12}"] for result in results)
+    assert imap_server.connections == 20
@@ -0,0 +1,67 @@
+﻿import hashlib
+import os
+
+import pytest
+
+from app.services.attachment_store import AttachmentStore
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 64
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AttachmentStore(str(tmp_path))
+
+
+def test_put_stream_round_trip(store):
+    stored = store.put_stream([PDF[:1000], PDF[1000:]])
+
+    sha256 = hashlib.sha256(PDF).hexdigest()
+    assert stored == {"sha256": sha256, "path": os.path.join(sha256[:2], sha256[2:4], sha256), "size": len(PDF)}
+    with open(store.absolute_path(stored["path"]), "rb") as stored_file:
+        assert stored_file.read() == PDF
+
+
+def test_put_stream_stores_duplicate_content_once(store):
+    first = store.put_stream([PDF])
+    second = store.put_stream([PDF[:10], PDF[10:]])
+
+    assert first == second
+    # ไม่มีไฟล์ชั่วคราวค้างอยู่
+    assert os.listdir(os.path.join(store.root_dir, "tmp")) == []
+
+
+def test_put_stream_removes_temporary_file_on_error(store):
+    def chunks():
+        yield PDF
+        raise IOError("connection lost")
+
+    with pytest.raises(IOError):
+        store.put_stream(chunks())
+
+    assert os.listdir(os.path.join(store.root_dir, "tmp")) == []
+
+
+@pytest.mark.parametrize("relative_path", [
+    None,
+    "",
+    "../../etc/passwd",
+    "/etc/passwd",
+    "invoice.pdf",
+    "tmp/" + "a" * 64,
+    # ต้องเป็นตำแหน่งตามรูปแบบ ab/cd/<sha256> เท่านั้น
+    "a" * 64,
+    os.path.join("ab", "cd", "a" * 64),
+    os.path.join("aa", "aa", "A" * 64),
+    os.path.join("..", "aa", "aa", "a" * 64),
+])
+def test_absolute_path_rejects_non_digest_paths(store, relative_path):
+    assert store.absolute_path(relative_path) is None
+
+
+def test_absolute_path_requires_existing_file(store):
+    stored = store.put_stream([PDF])
+    missing = store.relative_path("b" * 64)
+
+    assert store.absolute_path(stored["path"]) == os.path.join(store.root_dir, stored["path"])
+    assert store.absolute_path(missing) is None
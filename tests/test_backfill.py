@@ -0,0 +1,105 @@
+﻿import shutil
+from datetime import datetime
+
+import pytest
+
+from app.config import settings
+from app.models import Receipt
+from app.services.backfill import backfill_receipts
+from app.services.message_cache import message_cache
+
+from .fake_imap import make_message
+
+STEAM = "Steam <noreply@steampowered.com>"
+RECEIPT_DATE = datetime(2026, 10, 13, 10, 0)
+
+
+@pytest.fixture(autouse=True)
+def clear_message_cache():
+    yield
+    shutil.rmtree(settings.MESSAGE_CACHE_DIR, ignore_errors=True)
+
+
+def _receipt(db, user, imap_setting, uid, body=None, **fields) -> Receipt:
+    """ใบเสร็จที่บันทึกจากอีเมล UID ที่ระบุ (ถ้าระบุ body จะใส่อีเมลนั้นลงแคช)"""
+    if body is not None:
+        message_cache.put(imap_setting.id, 1000, uid, make_message(STEAM, f"Thank you for your purchase #{uid}", body))
+    values = dict(vendor_name="Steam", amount=34.0, currency="THB", receipt_date=RECEIPT_DATE)
+    values.update(fields)
+    receipt = Receipt(
+        user_id=user.id,
+        email_id=f"hash:{uid}",
+        imap_setting_id=imap_setting.id,
+        imap_uidvalidity=1000,
+        imap_uid=uid,
+        **values
+    )
+    db.add(receipt)
+    db.commit()
+    return receipt
+
+
+def test_backfill_updates_changed_fields(db, user, stored_imap_setting):
+    changed = _receipt(db, user, stored_imap_setting, 100, "รวมทั้งหมด: ฿34.00", amount=10.0)
+    unchanged = _receipt(db, user, stored_imap_setting, 101, "รวมทั้งหมด: ฿34.00")
+
+    summary = backfill_receipts(db, user_id=user.id, workers=0)
+
+    db.refresh(changed)
+    db.refresh(unchanged)
+    assert changed.amount == 34.0
+    assert unchanged.amount == 34.0
+    assert (summary["scanned"], summary["updated"]) == (2, 1)
+    assert summary["changed_fields"]["amount"] == 1
+    assert summary["samples"] == [{"receipt_id": changed.id, "field": "amount", "old": 10.0, "new": 34.0}]
+
+
+def test_backfill_pages_by_id(db, user, stored_imap_setting):
+    receipts = [_receipt(db, user, stored_imap_setting, uid, "รวมทั้งหมด: ฿34.00", amount=1.0) for uid in range(100, 105)]
+    progress = []
+
+    summary = backfill_receipts(
+        db, user_id=user.id, chunk_size=2, workers=0,
+        progress_callback=lambda current: progress.append((current["scanned"], current["updated"]))
+    )
+
+    # ชุดละ 2 รายการ ทุกใบเสร็จถูกอ่านครั้งเดียว แม้ชุดก่อนหน้าถูกอัปเดตไปแล้ว
+    assert progress == [(2, 2), (4, 4), (5, 5)]
+    assert summary["total"] == summary["scanned"] == 5
+    for receipt in receipts:
+        db.refresh(receipt)
+        assert receipt.amount == 34.0
+
+
+def test_backfill_skips_user_edited_receipts(db, user, stored_imap_setting):
+    edited = _receipt(db, user, stored_imap_setting, 100, "รวมทั้งหมด: ฿34.00", amount=10.0, user_edited=True)
+
+    summary = backfill_receipts(db, user_id=user.id, workers=0)
+
+    db.refresh(edited)
+    assert edited.amount == 10.0
+    assert (summary["total"], summary["scanned"], summary["skipped_user_edited"]) == (0, 0, 1)
+
+
+def test_backfill_keeps_receipt_when_amount_not_found(db, user, stored_imap_setting):
+    # อีเมลที่แยกใหม่แล้วหาจำนวนเงินไม่พบ (ได้ 0) ต้องไม่ทับจำนวนเงินเดิม
+    receipt = _receipt(db, user, stored_imap_setting, 100, "ไม่มีจำนวนเงิน", vendor_name="Old vendor")
+    missing = _receipt(db, user, stored_imap_setting, 101)
+
+    summary = backfill_receipts(db, user_id=user.id, workers=0)
+
+    db.refresh(receipt)
+    assert (receipt.amount, receipt.vendor_name) == (34.0, "Old vendor")
+    assert (summary["not_receipt"], summary["missing_source"], summary["updated"]) == (1, 1, 0)
+    assert missing.amount == 34.0
+
+
+def test_backfill_dry_run_reports_without_writing(db, user, stored_imap_setting):
+    receipt = _receipt(db, user, stored_imap_setting, 100, "รวมทั้งหมด: ฿34.00", amount=10.0, vendor_name="Old vendor")
+
+    summary = backfill_receipts(db, user_id=user.id, workers=0, dry_run=True)
+
+    db.refresh(receipt)
+    assert (receipt.amount, receipt.vendor_name) == (10.0, "Old vendor")
+    assert summary["updated"] == 1
+    assert summary["changed_fields"]["vendor_name"] == summary["changed_fields"]["category_id"] == 1
@@ -0,0 +1,54 @@
+﻿from app.services.email_text import build_email_text, email_text, html_to_text, plain_to_text
+
+
+def test_html_to_text_drops_hidden_content_and_decodes_entities():
+    html = (
+        "<html><head><title>Receipt</title><style>p { color: red; }</style></head>"
+        "<body><p>Hello&nbsp;<b>World</b> &amp; thanks</p><script>var total = 1;</script>"
+        "<!-- tracking --><div>Line 2</div></body></html>"
+    )
+
+    assert html_to_text(html) == "Hello World & thanks\nLine 2"
+
+
+def test_html_to_text_keeps_table_rows_on_one_line():
+    html = "<table><tr><td>Total</td><td>฿35.00</td></tr>\n<tr><th>VAT</th> <td>2.45</td></tr></table>"
+
+    assert html_to_text(html) == "Total\t฿35.00\nVAT\t2.45"
+
+
+def test_html_to_text_breaks_lines_on_block_tags_only():
+    assert html_to_text("A<br>B<br/>C<span>D</span>\n  E") == "A\nB\nCD E"
+
+
+def test_html_to_text_keeps_email_addresses_in_angle_brackets():
+    assert html_to_text("Contact <billing@shop.example> or &lt;help@shop.example&gt;") == (
+        "Contact <billing@shop.example> or <help@shop.example>"
+    )
+
+
+def test_html_to_text_removes_invisible_characters():
+    assert html_to_text("<p>\u200bTo\xadtal\ufeff: ฿10.00</p>") == "Total: ฿10.00"
+
+
+def test_html_to_text_empty():
+    assert html_to_text("") == ""
+    assert html_to_text(None) == ""
+
+
+def test_plain_to_text_normalizes_line_endings_and_spaces():
+    assert plain_to_text("Total:   ฿10.00\r\n\r\n  VAT\r2.00") == "Total: ฿10.00\nVAT\n2.00"
+
+
+def test_build_email_text_converts_each_part_by_type():
+    parts = [("text/plain", "Total: 10.00 THB"), ("text/html", "<p>Total: <b>10.00</b> THB</p>"), ("text/plain", "  ")]
+
+    assert build_email_text(parts) == "Total: 10.00 THB\nTotal: 10.00 THB"
+
+
+def test_email_text_is_computed_once():
+    email_data = {"body": "<p>Total</p>"}
+
+    assert email_text(email_data) == "Total"
+    email_data["body"] = "<p>changed</p>"
+    assert email_text(email_data) == "Total"
@@ -0,0 +1,98 @@
+﻿import pytest
+
+from app.services.encryption_service import encrypt_password
+from app.services.imap_pool import IMAPSessionPool
+
+
+def _pool(**overrides) -> IMAPSessionPool:
+    options = dict(idle_timeout=300, max_lifetime=1800, max_idle_per_setting=4, max_idle=50)
+    options.update(overrides)
+    return IMAPSessionPool(**options)
+
+
+@pytest.fixture
+def pool():
+    pool = _pool()
+    yield pool
+    pool.close_all()
+
+
+def test_released_session_is_reused(pool, imap_server, imap_setting):
+    client = pool.acquire(imap_setting)
+    client.select_folder()
+    pool.release(client)
+
+    reused = pool.acquire(imap_setting)
+
+    assert reused is client
+    # การเชื่อมต่อที่ยืมซ้ำต้องเลือกโฟลเดอร์ใหม่
+    assert reused.folder is None
+    assert imap_server.connections == 1
+    assert len(imap_server.commands_named("LOGIN")) == 1
+    pool.release(reused)
+
+
+def test_dead_session_is_evicted(pool, imap_server, imap_setting):
+    client = pool.acquire(imap_setting)
+    pool.release(client)
+    imap_server.drop_connections()
+
+    replacement = pool.acquire(imap_setting)
+
+    assert replacement is not None and replacement is not client
+    assert replacement.noop()
+    assert imap_server.connections == 2
+    pool.release(replacement)
+
+
+def test_expired_session_is_not_reused(imap_server, imap_setting):
+    pool = _pool(idle_timeout=0)
+    client = pool.acquire(imap_setting)
+    pool.release(client)
+
+    replacement = pool.acquire(imap_setting)
+
+    assert replacement is not client
+    assert imap_server.connections == 2
+    pool.release(replacement, reusable=False)
+
+
+def test_failed_session_is_closed_instead_of_returned(pool, imap_server, imap_setting):
+    client = pool.acquire(imap_setting)
+    pool.release(client, reusable=False)
+
+    replacement = pool.acquire(imap_setting)
+
+    assert replacement is not client
+    assert imap_server.connections == 2
+    pool.release(replacement)
+
+
+def test_pool_limits_idle_sessions_per_setting(imap_server, imap_setting):
+    pool = _pool(max_idle_per_setting=1)
+    first = pool.acquire(imap_setting)
+    second = pool.acquire(imap_setting)
+    pool.release(first)
+    pool.release(second)
+
+    reused = pool.acquire(imap_setting)
+    # การเชื่อมต่อที่เกินจำนวนถูกปิด จึงต้องเชื่อมต่อใหม่
+    replacement = pool.acquire(imap_setting)
+
+    assert reused is first
+    assert replacement is not second
+    assert imap_server.connections == 3
+    for client in (reused, replacement):
+        pool.release(client, reusable=False)
+
+
+def test_changed_password_does_not_reuse_session(pool, imap_server, imap_setting):
+    client = pool.acquire(imap_setting)
+    pool.release(client)
+    imap_setting.password_encrypted = encrypt_password(imap_server.password)
+
+    replacement = pool.acquire(imap_setting)
+
+    assert replacement is not client
+    assert imap_server.connections == 2
+    pool.release(replacement)
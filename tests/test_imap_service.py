@@ -0,0 +1,274 @@
+﻿import pytest
+
+from app.config import settings
+from app.services.imap_service import (
+    IMAPClient,
+    build_search_query,
+    classify_receipt_headers,
+    compile_search_criteria,
+    compress_uid_set,
+    parse_body_structure,
+    parse_fetch_response,
+    receipt_search_criteria
+)
+from app.services.vendor_rules import vendor_templates
+
+from .fake_imap import FakeMailbox, make_message
+
+
+def test_compress_uid_set_merges_consecutive_uids():
+    assert compress_uid_set([103, 101, 102, 155, 157, 158]) == "101:103,155,157:158"
+
+
+def test_compress_uid_set_removes_duplicates_and_accepts_strings():
+    assert compress_uid_set(["7", 7, b"8", 10]) == "7:8,10"
+
+
+def test_compress_uid_set_empty():
+    assert compress_uid_set([]) == ""
+
+
+def test_parse_fetch_response_reads_literals():
+    data = [
+        (b"1 (UID 101 RFC822.SIZE 42 RFC822 {11}", b"Hello (IMAP"),
+        b")",
+        (b"2 (UID 102 BODY[1] {5}", b"{3}\r\n"),
+        b' FLAGS (\\Seen) BODY[HEADER.FIELDS (SUBJECT)] "a \\"b\\"")'
+    ]
+
+    messages = parse_fetch_response(data)
+
+    assert messages == [
+        {"UID": 101, "RFC822.SIZE": 42, "RFC822": b"Hello (IMAP"},
+        {"UID": 102, "BODY[1]": b"{3}\r\n", "FLAGS": ["\\Seen"], "BODY[HEADER.FIELDS (SUBJECT)]": 'a "b"'}
+    ]
+
+
+def test_parse_fetch_response_normalizes_peek_and_nil():
+    data = [b"3 (UID 7 BODY.PEEK[2] NIL BODYSTRUCTURE (\"TEXT\" \"PLAIN\" NIL))"]
+
+    assert parse_fetch_response(data) == [
+        {"UID": 7, "BODY[2]": None, "BODYSTRUCTURE": ["TEXT", "PLAIN", None]}
+    ]
+
+
+def test_parse_fetch_response_skips_entries_without_uid():
+    data = [b"1 (FLAGS (\\Seen))", None, b"2 (UID 9 FLAGS ())"]
+
+    assert parse_fetch_response(data) == [{"UID": 9, "FLAGS": []}]
+
+
+def _source(from_=(), subject=()):
+    return {"name": "test", "from": list(from_), "subject": list(subject)}
+
+
+def test_compile_search_criteria_single_source():
+    assert compile_search_criteria([_source(["apple.com"], ["invoice"])]) == '(FROM "apple.com" SUBJECT "invoice")'
+
+
+def test_compile_search_criteria_nests_or_pairs():
+    sources = [_source(["a.example"]), _source(["b.example"]), _source(["c.example"])]
+
+    assert compile_search_criteria(sources) == 'OR (FROM "a.example") (OR (FROM "b.example") (FROM "c.example"))'
+
+
+def test_compile_search_criteria_drops_covered_sources():
+    sources = [
+        _source(["mail.shop.example"], ["receipt"]),
+        # SEARCH FROM เป็น substring จึงครอบคลุม mail.shop.example ทุกหัวข้อแล้ว
+        _source(["shop.example"]),
+        _source(["other.example"])
+    ]
+
+    assert compile_search_criteria(sources) == 'OR (FROM "shop.example") (FROM "other.example")'
+
+
+def test_compile_search_criteria_keeps_first_of_equal_sources():
+    sources = [_source(["shop.example"], ["Receipt"]), _source(["SHOP.example"], ["receipt"])]
+
+    assert compile_search_criteria(sources) == '(FROM "shop.example" SUBJECT "Receipt")'
+
+
+def test_compile_search_criteria_keeps_subject_only_source():
+    sources = [_source(["shop.example"]), _source(subject=["Steam Support"])]
+
+    assert compile_search_criteria(sources) == 'OR (FROM "shop.example") (SUBJECT "Steam Support")'
+
+
+def test_receipt_search_criteria_covers_catalog_sources():
+    catalog = vendor_templates.catalog()
+    criteria = receipt_search_criteria()
+
+    assert criteria == compile_search_criteria(catalog.sources)
+    # สร้างครั้งเดียวแล้วเก็บไว้ในชุดเทมเพลต
+    assert catalog.search_criteria is criteria
+    assert receipt_search_criteria() is criteria
+
+
+def test_build_search_query_uses_uid_range_for_incremental_sync():
+    assert build_search_query(30, '(FROM "shop.example")', since_uid=100) == '(UID 101:* (FROM "shop.example"))'
+    assert build_search_query(0, '(FROM "shop.example")') == '(FROM "shop.example")'
+
+
+def _body_structure(structure: bytes) -> list:
+    """BODYSTRUCTURE ที่แยกแล้วแบบเดียวกับที่ fetch_headers ได้รับ"""
+    return parse_fetch_response([b"1 (UID 1 BODYSTRUCTURE " + structure + b")"])[0]["BODYSTRUCTURE"]
+
+
+def test_parse_body_structure_single_part():
+    structure = _body_structure(b'("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 42 3 NIL NIL NIL NIL)')
+
+    assert parse_body_structure(structure) == [{
+        "section": "1",
+        "content_type": "text/plain",
+        "charset": "UTF-8",
+        "encoding": "7bit",
+        "size": 42,
+        "disposition": "",
+        "filename": ""
+    }]
+
+
+def test_parse_body_structure_nested_multipart_with_attachment():
+    structure = _body_structure(
+        b'((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+        b'("TEXT" "HTML" ("CHARSET" "TIS-620") NIL NIL "BASE64" 900 12 NIL NIL NIL NIL)'
+        b' "ALTERNATIVE" ("BOUNDARY" "alt") NIL NIL NIL)'
+        b'("APPLICATION" "PDF" ("NAME" "receipt.pdf") NIL NIL "BASE64" 5120 NIL'
+        b' ("ATTACHMENT" ("FILENAME" "receipt.pdf")) NIL NIL)'
+        b' "MIXED" ("BOUNDARY" "mix") NIL ("EN") NIL)'
+    )
+
+    parts = parse_body_structure(structure)
+
+    assert [(part["section"], part["content_type"]) for part in parts] == [
+        ("1.1", "text/plain"), ("1.2", "text/html"), ("2", "application/pdf")
+    ]
+    assert parts[1]["charset"] == "TIS-620"
+    assert (parts[2]["disposition"], parts[2]["filename"], parts[2]["size"]) == ("attachment", "receipt.pdf", 5120)
+
+
+def test_parse_body_structure_ignores_multipart_extension_lists():
+    # พารามิเตอร์ disposition และ language หลังชนิดย่อยเป็นรายการเช่นกัน แต่ไม่ใช่ส่วนย่อย
+    structure = _body_structure(
+        b'(("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+        b' "MIXED" ("BOUNDARY" "b") ("INLINE" NIL) ("EN" "TH") "http://example.com" ("X" "Y"))'
+    )
+
+    assert [part["section"] for part in parse_body_structure(structure)] == ["1"]
+
+
+def test_parse_body_structure_message_rfc822_disposition():
+    structure = _body_structure(
+        b'(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+        b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 300 (NIL "Fwd" NIL NIL NIL NIL NIL NIL NIL NIL)'
+        b' ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 20 2 NIL NIL NIL NIL) 9 NIL ("ATTACHMENT" ("FILENAME" "fwd.eml")) NIL NIL)'
+        b' "MIXED")'
+    )
+
+    parts = parse_body_structure(structure)
+
+    assert parts[0]["charset"] == "utf-8"
+    assert (parts[1]["section"], parts[1]["content_type"]) == ("2", "message/rfc822")
+    assert (parts[1]["disposition"], parts[1]["filename"]) == ("attachment", "fwd.eml")
+
+
+def test_parse_body_structure_invalid():
+    assert parse_body_structure(None) == []
+    assert parse_body_structure([]) == []
+    assert parse_body_structure(["TEXT", "PLAIN"]) == []
+
+
+
+@pytest.mark.parametrize("from_header, subject, source", [
+    ("Steam <noreply@steampowered.com>", "Thank you for your purchase!", "Steam"),
+    # คำบ่งบอกในหัวข้อไม่สนตัวพิมพ์ และใช้ได้กับภาษาไทย
+    ("Steam <noreply@steampowered.com>", "Your RECEIPT", "Steam"),
+    ("Steam <noreply@steampowered.com>", "ขอบคุณสำหรับการซื้อ", "Steam"),
+    # แหล่งที่ระบุคำในหัวข้อไม่ต้องผ่านคำบ่งบอกของผู้ส่ง
+    ("Steam Support <noreply@steampowered.com>", "Steam Support ticket #123", "Steam"),
+    ("Apple <no_reply@email.apple.com>", "Your invoice from Apple", "Apple"),
+    ("Netflix <info@mailer.netflix.com>", "Your membership payment", "Netflix"),
+    ("Spotify <no-reply@spotify.com>", "Your Spotify Premium receipt", "Spotify"),
+    ("YouTube <noreply-purchases@youtube.com>", "Your YouTube Premium receipt", "YouTube"),
+    ("Google Payments <payments-noreply@google.com>", "Your receipt from YouTube", "YouTube"),
+    ("KBank <kplus@kasikornbank.com>", "ผลการทำรายการ", "K Plus (Kasikorn Bank)"),
+    ("KPLUS <noreply@kplus.example>", "ผลการทำรายการ", "K Plus (Kasikorn Bank)"),
+])
+def test_classify_receipt_headers_accepts_receipts(from_header, subject, source):
+    assert classify_receipt_headers({"from": from_header, "subject": subject}) == source
+
+
+@pytest.mark.parametrize("from_header, subject", [
+    # อีเมลการตลาดจากผู้ส่งที่ต้องมีคำบ่งบอกในหัวข้อ
+    ("Steam <noreply@steampowered.com>", "Weekend Deal: up to 75% off"),
+    ("Spotify <no-reply@spotify.com>", "New playlist for you"),
+    ("Netflix <info@mailer.netflix.com>", "New arrivals this week"),
+    # แหล่งที่ต้องมีทั้งผู้ส่งและคำในหัวข้อ
+    ("Apple <news@insideapple.apple.com>", "Introducing the new iPhone"),
+    ("Google <no-reply@google.com>", "Security alert"),
+    ("Friend <friend@mail.example>", "Receipt for lunch"),
+    ("", ""),
+])
+def test_classify_receipt_headers_rejects_other_mail(from_header, subject):
+    assert classify_receipt_headers({"from": from_header, "subject": subject}) is None
+
+
+def test_classify_receipt_headers_handles_missing_headers():
+    assert classify_receipt_headers({}) is None
+    assert classify_receipt_headers({"from": None, "subject": "Steam Support"}) == "Steam"
+
+
+def _connect(imap_setting) -> IMAPClient:
+    client = IMAPClient(imap_setting)
+    assert client.connect()
+    return client
+
+
+def test_client_negotiates_compress_deflate(imap_server, imap_setting):
+    html = "<tr><td>Item</td><td>100.00 THB</td></tr>" * 200
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message("Shop <orders@shop.example>", "Receipt #1", "Total: 100.00 THB", html=html)
+    ])
+    client = _connect(imap_setting)
+    try:
+        assert client.compression_enabled
+        assert client.select_folder() == 1000
+        emails = list(client.fetch_emails([100]))
+        counters = client.transfer_counters()
+    finally:
+        client.disconnect()
+
+    assert imap_server.commands_named("COMPRESS DEFLATE")
+    # คำสั่งหลัง COMPRESS ถูกถอดรหัสได้ถูกต้องที่ฝั่งเซิร์ฟเวอร์
+    assert imap_server.commands_named("UID FETCH 100 (UID RFC822)")
+    assert [email_data["subject"] for email_data in emails] == ["Receipt #1"]
+    assert "100.00 THB" in emails[0]["body"]
+    # เนื้อหา HTML ที่ซ้ำกันถูกบีบอัดระหว่างส่งจริง
+    assert counters["wire_bytes"] * 5 < counters["bytes"]
+
+
+def test_client_skips_compress_when_disabled(monkeypatch, imap_server, imap_setting):
+    monkeypatch.setattr(settings, "IMAP_COMPRESS", False)
+    client = _connect(imap_setting)
+    try:
+        assert not client.compression_enabled
+        assert client.select_folder() == 1000
+    finally:
+        client.disconnect()
+
+    assert not imap_server.commands_named("COMPRESS")
+
+
+def test_client_without_server_support_uses_plain_connection(imap_server, imap_setting):
+    imap_server.capabilities.remove("COMPRESS=DEFLATE")
+    client = _connect(imap_setting)
+    try:
+        assert not client.compression_enabled
+        assert client.select_folder() == 1000
+        counters = client.transfer_counters()
+    finally:
+        client.disconnect()
+
+    assert not imap_server.commands_named("COMPRESS")
+    assert counters["wire_bytes"] == counters["bytes"] > 0
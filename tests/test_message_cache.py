@@ -0,0 +1,81 @@
+﻿import os
+
+import pytest
+
+from app.services.message_cache import MessageCache
+
+
+def _raw(uid: int) -> bytes:
+    # เนื้อหาที่บีบอัดไม่ได้ เพื่อให้ขนาดไฟล์ในแคชใกล้เคียงกันทุกฉบับ
+    return os.urandom(1000) + str(uid).encode()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MessageCache(str(tmp_path), max_bytes=10 ** 6, evict_interval=3600)
+
+
+def _fill(cache, uids):
+    """ใส่อีเมลลงแคช โดยให้ UID แรกเป็นฉบับที่ใช้งานล่าสุดนานที่สุด"""
+    for age, uid in enumerate(reversed(uids), 1):
+        cache.put(1, 1000, uid, _raw(uid))
+        os.utime(cache.path(1, 1000, uid), (1000000 - age * 60, 1000000 - age * 60))
+    return os.path.getsize(cache.path(1, 1000, uids[0]))
+
+
+def test_put_and_get_round_trip(cache):
+    raw = b"Subject: Receipt\r\n\r\nTotal 100.00 THB\r\n" * 50
+
+    assert cache.put(1, 1000, 101, raw)
+    assert cache.put(1, 1000, 101, raw, folder="[Gmail]/All Mail")
+
+    assert cache.get(1, 1000, 101) == raw
+    assert cache.get(1, 1000, 101, folder="[Gmail]/All Mail") == raw
+    assert cache.get(1, 1001, 101) is None
+    assert cache.get(1, None, 101) is None
+    assert os.path.getsize(cache.path(1, 1000, 101)) < len(raw)
+
+
+def test_evict_removes_least_recently_used_until_under_limit(cache):
+    size = _fill(cache, [100, 101, 102, 103])
+    # อ่านอีเมลเก่าสุด จึงกลายเป็นฉบับที่ใช้ล่าสุด
+    cache.get(1, 1000, 100)
+    cache.max_bytes = size * 2 + size // 2
+
+    assert cache.evict() == 2
+
+    assert cache.get(1, 1000, 100) is not None
+    assert cache.get(1, 1000, 103) is not None
+    assert cache.get(1, 1000, 101) is None
+    assert cache.get(1, 1000, 102) is None
+
+
+def test_evict_skips_files_being_written(cache):
+    size = _fill(cache, [100, 101])
+    # ไฟล์ .tmp ที่ process อื่นกำลังเขียน ต้องไม่ถูกนับขนาดหรือถูกลบ
+    in_flight = os.path.join(os.path.dirname(cache.path(1, 1000, 100)), "tmpabc.tmp")
+    with open(in_flight, "wb") as tmp_file:
+        tmp_file.write(os.urandom(size * 10))
+    cache.max_bytes = size * 2
+
+    assert cache.evict() == 0
+    assert os.path.exists(in_flight)
+
+    cache.max_bytes = size
+    assert cache.evict() == 1
+    assert os.path.exists(in_flight)
+    assert cache.get(1, 1000, 101) is not None
+
+
+def test_maybe_evict_scans_only_when_over_limit_or_due(cache):
+    size = _fill(cache, [100, 101])
+    cache.max_bytes = size * 3
+
+    # การเรียกครั้งแรกสำรวจขนาดจริง ครั้งต่อไปใช้ขนาดโดยประมาณ
+    assert cache.maybe_evict() == 0
+    cache.put(1, 1000, 102, _raw(102))
+    assert cache.maybe_evict() == 0
+
+    cache.put(1, 1000, 103, _raw(103))
+    assert cache.maybe_evict() == 1
+    assert cache.get(1, 1000, 100) is None
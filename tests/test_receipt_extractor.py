@@ -0,0 +1,103 @@
+﻿from datetime import datetime, timezone
+
+from app.services.receipt_extractor import best_amount, iter_amounts, receipt_identity
+
+
+def _email(**overrides):
+    email_data = {
+        "from": "Shop <orders@shop.example>",
+        "subject": "Receipt #1",
+        "date": datetime(2026, 10, 13, 10, 0, tzinfo=timezone.utc),
+        "message_id_header": "<abc123@shop.example>"
+    }
+    email_data.update(overrides)
+    return email_data
+
+
+def test_receipt_identity_uses_message_id():
+    identity = receipt_identity(_email())
+
+    assert identity["email_id"].startswith("mid:")
+    assert identity["message_id"] == "<abc123@shop.example>"
+    assert len(identity["content_hash"]) == 64
+
+
+def test_receipt_identity_is_stable_across_folders_and_formatting():
+    # อีเมลฉบับเดียวกันในโฟลเดอร์อื่น: UID ต่างกัน ตัวพิมพ์ของผู้ส่งและช่องว่างรอบ Message-ID ต่างกัน
+    other = _email(message_id=999, **{"from": "SHOP <Orders@Shop.example> ", "message_id_header": " <ABC123@shop.example> "})
+
+    assert receipt_identity(other)["email_id"] == receipt_identity(_email())["email_id"]
+
+
+def test_receipt_identity_separates_reused_message_ids():
+    first = receipt_identity(_email())
+    second = receipt_identity(_email(subject="Receipt #2"))
+
+    assert first["email_id"] != second["email_id"]
+
+
+def test_receipt_identity_falls_back_to_content_hash():
+    identity = receipt_identity(_email(message_id_header=""))
+
+    assert identity["email_id"] == "hash:" + identity["content_hash"]
+    assert identity["message_id"] is None
+
+
+def test_receipt_identity_handles_missing_fields():
+    identity = receipt_identity({"message_id_header": "<>"})
+
+    assert identity["email_id"].startswith("hash:")
+
+
+def test_receipt_identity_truncates_long_message_id():
+    identity = receipt_identity(_email(message_id_header="<" + "x" * 300 + "@shop.example>"))
+
+    assert len(identity["message_id"]) == 255
+
+
+def test_iter_amounts_reads_symbol_and_suffix_forms_in_order():
+    candidates = list(iter_amounts("฿10.00 ค่าส่ง 20.00 บาท และ USD 7.50"))
+
+    assert [(c.amount, c.currency) for c in candidates] == [(10.0, "THB"), (20.0, "THB"), (7.5, "USD")]
+    assert [c.position for c in candidates] == sorted(c.position for c in candidates)
+
+
+def test_iter_amounts_reads_keyword_before_symbol():
+    (candidate,) = iter_amounts("Total: ฿1,234.50")
+
+    assert candidate.amount == 1234.5
+    assert candidate.currency == "THB"
+    assert candidate.keyword == "Total"
+    assert candidate.priority == 0
+
+
+def test_iter_amounts_accepts_only_english_keywords_for_dollars():
+    (thai_keyword,) = iter_amounts("ราคา $4.00")
+    (english_keyword,) = iter_amounts("Amount $4.00")
+
+    assert thai_keyword.keyword is None
+    assert english_keyword.keyword == "Amount"
+    assert thai_keyword.priority > english_keyword.priority
+
+
+def test_iter_amounts_without_amount():
+    assert list(iter_amounts("")) == []
+    assert list(iter_amounts("ขอบคุณที่ใช้บริการ ฿ THB")) == []
+
+
+def test_best_amount_prefers_keyword_total():
+    assert best_amount("ค่าสินค้า ฿10.00 ยอดรวม ฿99.00").amount == 99.0
+
+
+def test_best_amount_prefers_baht_over_dollars():
+    best = best_amount("USD 7.50 (3.00 THB)")
+
+    assert (best.amount, best.currency) == (3.0, "THB")
+
+
+def test_best_amount_uses_first_of_equal_priority():
+    assert best_amount("฿15.00 ฿25.00").amount == 15.0
+
+
+def test_best_amount_without_amount():
+    assert best_amount("no amount here") is None
@@ -0,0 +1,59 @@
+﻿import pytest
+from fastapi import HTTPException
+
+from app.api.routes.receipts import create_receipt, download_receipt_attachment
+from app.models import Receipt
+from app.schemas.receipt import ReceiptCreate
+from app.services.attachment_store import attachment_store
+
+
+def test_create_receipt_with_duplicate_email_id_returns_409(db, user):
+    create_receipt(ReceiptCreate(email_id="manual-1", amount=100.0), db, user)
+
+    with pytest.raises(HTTPException) as error:
+        create_receipt(ReceiptCreate(email_id="manual-1", amount=50.0), db, user)
+
+    assert error.value.status_code == 409
+    # session ยังใช้งานต่อได้หลัง rollback
+    assert db.query(Receipt).filter(Receipt.user_id == user.id).count() == 1
+
+
+def test_create_receipt_without_email_id_allows_many(db, user):
+    create_receipt(ReceiptCreate(amount=100.0), db, user)
+    create_receipt(ReceiptCreate(amount=50.0), db, user)
+
+    assert db.query(Receipt).filter(Receipt.user_id == user.id).count() == 2
+
+
+def _receipt_with_file(db, user, receipt_file_path) -> Receipt:
+    receipt = Receipt(
+        user_id=user.id,
+        amount=35.0,
+        receipt_file_path=receipt_file_path,
+        receipt_file_name="invoice.pdf",
+        receipt_file_type="application/pdf"
+    )
+    db.add(receipt)
+    db.commit()
+    return receipt
+
+
+def test_download_attachment_streams_stored_file(db, user):
+    stored = attachment_store.put_stream([b"%PDF-1.4 invoice"])
+    receipt = _receipt_with_file(db, user, stored["path"])
+
+    response = download_receipt_attachment(receipt.id, db, user)
+
+    assert response.path == attachment_store.absolute_path(stored["path"])
+    assert response.media_type == "application/pdf"
+    assert 'filename="invoice.pdf"' in response.headers["content-disposition"]
+
+
+@pytest.mark.parametrize("receipt_file_path", ["../../../../etc/passwd", "/etc/passwd", "invoice.pdf", None])
+def test_download_attachment_rejects_paths_outside_store(db, user, receipt_file_path):
+    receipt = _receipt_with_file(db, user, receipt_file_path)
+
+    with pytest.raises(HTTPException) as error:
+        download_receipt_attachment(receipt.id, db, user)
+
+    assert error.value.status_code == 404
@@ -0,0 +1,217 @@
+﻿from datetime import datetime, timedelta
+
+import pytest
+
+from app.config import settings
+from app.models import ImapSetting, SyncJob
+from app.services.sync_job_service import (
+    MANUAL_PRIORITY,
+    SCHEDULED_PRIORITY,
+    claim_next_job,
+    enqueue_sync_job,
+    run_sync_job,
+    schedule_next_sync
+)
+from app.services.sync_scheduler import schedule_due_syncs
+
+
+def test_enqueue_merges_params_into_pending_job(db, stored_imap_setting):
+    scheduled = enqueue_sync_job(db, stored_imap_setting, days_back=30, max_emails=50, priority=SCHEDULED_PRIORITY)
+    manual = enqueue_sync_job(db, stored_imap_setting, days_back=90, max_emails=20, full_resync=True)
+
+    assert manual.id == scheduled.id
+    assert (manual.days_back, manual.max_emails, manual.full_resync) == (90, 50, True)
+    assert manual.priority == MANUAL_PRIORITY
+    assert db.query(SyncJob).count() == 1
+
+
+def test_enqueue_keeps_full_resync_and_unlimited_bounds(db, stored_imap_setting):
+    enqueue_sync_job(db, stored_imap_setting, days_back=0, max_emails=50, full_resync=True)
+    job = enqueue_sync_job(db, stored_imap_setting, days_back=30, max_emails=0)
+
+    # 0 หมายถึงไม่จำกัด จึงกว้างกว่าทุกค่า
+    assert (job.days_back, job.max_emails, job.full_resync) == (0, 0, True)
+
+
+def test_enqueue_full_resync_clears_retry_checkpoint(db, stored_imap_setting):
+    job = enqueue_sync_job(db, stored_imap_setting)
+    job.checkpoint_uid = 120
+    db.commit()
+
+    job = enqueue_sync_job(db, stored_imap_setting, full_resync=True)
+
+    assert job.full_resync is True
+    assert job.checkpoint_uid is None
+
+
+def test_enqueue_during_running_job_reruns_with_requested_params(db, stored_imap_setting):
+    enqueue_sync_job(db, stored_imap_setting, days_back=30, max_emails=50, priority=SCHEDULED_PRIORITY)
+    running = claim_next_job(db, "worker-1")
+
+    first = enqueue_sync_job(db, stored_imap_setting, days_back=7, max_emails=200)
+    second = enqueue_sync_job(db, stored_imap_setting, days_back=60, max_emails=10, full_resync=True)
+
+    assert first.id == second.id == running.id
+    assert claim_next_job(db, "worker-2") is None
+    assert (running.rerun_days_back, running.rerun_max_emails, running.rerun_full_resync) == (60, 200, True)
+    # พารามิเตอร์ของงานที่กำลังทำไม่เปลี่ยน
+    assert (running.days_back, running.max_emails, running.full_resync) == (30, 50, False)
+
+    run_sync_job(db, running)
+
+    assert running.status == "completed"
+    follow_up = db.query(SyncJob).filter(SyncJob.id != running.id).one()
+    assert follow_up.status == "pending"
+    assert (follow_up.days_back, follow_up.max_emails, follow_up.full_resync) == (60, 200, True)
+    assert follow_up.priority == MANUAL_PRIORITY
+
+
+def test_claim_reclaims_stale_running_job(db, stored_imap_setting):
+    job = enqueue_sync_job(db, stored_imap_setting)
+    claim_next_job(db, "worker-1")
+
+    # งานที่ worker ยังส่ง heartbeat อยู่จะไม่ถูกนำกลับมาทำ
+    assert claim_next_job(db, "worker-2") is None
+
+    job.locked_at = datetime.now() - timedelta(seconds=settings.SYNC_JOB_LOCK_TIMEOUT + 1)
+    db.commit()
+    reclaimed = claim_next_job(db, "worker-2")
+
+    assert reclaimed.id == job.id
+    assert (reclaimed.status, reclaimed.locked_by, reclaimed.attempts) == ("running", "worker-2", 2)
+
+
+def test_stale_job_out_of_attempts_is_failed(db, stored_imap_setting):
+    job = enqueue_sync_job(db, stored_imap_setting)
+    claim_next_job(db, "worker-1")
+    job.attempts = settings.SYNC_JOB_MAX_ATTEMPTS
+    job.locked_at = datetime.now() - timedelta(seconds=settings.SYNC_JOB_LOCK_TIMEOUT + 1)
+    db.commit()
+
+    assert claim_next_job(db, "worker-2") is None
+    assert job.status == "failed"
+    assert "worker-1" in job.error
+    assert job.locked_by is None
+
+
+def test_failed_sync_is_retried_with_backoff(db, stored_imap_setting, imap_server):
+    imap_server.password = "other"
+    enqueue_sync_job(db, stored_imap_setting)
+
+    job = claim_next_job(db, "worker-1")
+    before = datetime.now()
+    run_sync_job(db, job)
+
+    assert (job.status, job.locked_by) == ("pending", None)
+    assert job.error
+    delay = job.run_after - before
+    assert timedelta(seconds=settings.SYNC_JOB_RETRY_DELAY - 5) <= delay <= timedelta(seconds=settings.SYNC_JOB_RETRY_DELAY + 5)
+    # ยังไม่ถึงเวลาลองใหม่
+    assert claim_next_job(db, "worker-1") is None
+
+    # ระยะรอเพิ่มขึ้นตามจำนวนครั้งที่ล้มเหลว
+    job.run_after = datetime.now()
+    db.commit()
+    job = claim_next_job(db, "worker-1")
+    assert job.attempts == 2
+    before = datetime.now()
+    run_sync_job(db, job)
+    assert job.run_after - before >= timedelta(seconds=2 * settings.SYNC_JOB_RETRY_DELAY - 5)
+
+
+def test_sync_fails_after_max_attempts(db, stored_imap_setting, imap_server):
+    imap_server.password = "other"
+    job = enqueue_sync_job(db, stored_imap_setting)
+    job.attempts = settings.SYNC_JOB_MAX_ATTEMPTS - 1
+    db.commit()
+
+    job = claim_next_job(db, "worker-1")
+    run_sync_job(db, job)
+
+    assert job.status == "failed"
+    assert job.finished_at is not None
+    assert claim_next_job(db, "worker-1") is None
+    # บัญชีที่ซิงค์ล้มเหลวยังถูกตั้งเวลาซิงค์อัตโนมัติครั้งถัดไป
+    assert stored_imap_setting.next_sync_at is not None
+    assert stored_imap_setting.last_sync is None
+
+
+def _account(db, user, server, **fields) -> ImapSetting:
+    imap_setting = ImapSetting(
+        user_id=user.id,
+        email=f"{server}@example.com",
+        server=server,
+        port=993,
+        username="user",
+        password_encrypted="x",
+        **fields
+    )
+    db.add(imap_setting)
+    db.commit()
+    return imap_setting
+
+
+def test_claim_respects_per_host_cap(monkeypatch, db, user):
+    monkeypatch.setattr(settings, "IMAP_MAX_SYNCS_PER_HOST", 1)
+    # ชื่อเซิร์ฟเวอร์เทียบแบบไม่สนตัวพิมพ์
+    first = enqueue_sync_job(db, _account(db, user, "IMAP.example.com"))
+    second = enqueue_sync_job(db, _account(db, user, "imap.example.com"))
+    other_host = enqueue_sync_job(db, _account(db, user, "mail.other.example"))
+
+    assert claim_next_job(db, "worker-1").id == first.id
+    # เซิร์ฟเวอร์เดียวกันมีงานครบจำนวนแล้ว จึงได้งานของเซิร์ฟเวอร์อื่นแทน
+    assert claim_next_job(db, "worker-2").id == other_host.id
+    assert claim_next_job(db, "worker-3") is None
+
+    first.status = "completed"
+    db.commit()
+    assert claim_next_job(db, "worker-3").id == second.id
+
+
+def test_stale_job_does_not_count_towards_host_cap(monkeypatch, db, user):
+    monkeypatch.setattr(settings, "IMAP_MAX_SYNCS_PER_HOST", 1)
+    first = enqueue_sync_job(db, _account(db, user, "imap.example.com"))
+    second = enqueue_sync_job(db, _account(db, user, "imap.example.com"))
+    claim_next_job(db, "worker-1")
+    first.locked_at = datetime.now() - timedelta(seconds=settings.SYNC_JOB_LOCK_TIMEOUT + 1)
+    first.priority = second.priority - 1
+    db.commit()
+
+    assert claim_next_job(db, "worker-2").id == second.id
+
+
+@pytest.mark.parametrize("interval, new_emails, expected", [
+    (1200, 3, 600),
+    (1200, 0, 2400),
+    (None, 0, 600),
+    # ไม่ต่ำกว่า SYNC_MIN_INTERVAL และไม่เกิน SYNC_MAX_INTERVAL
+    (400, 1, 300),
+    (300, 1, 300),
+    (4 * 3600, 0, 6 * 3600),
+])
+def test_schedule_next_sync_adapts_interval(monkeypatch, interval, new_emails, expected):
+    monkeypatch.setattr(settings, "SYNC_MIN_INTERVAL", 300)
+    monkeypatch.setattr(settings, "SYNC_MAX_INTERVAL", 6 * 3600)
+    imap_setting = ImapSetting(sync_interval=interval)
+
+    before = datetime.now()
+    schedule_next_sync(imap_setting, new_emails=new_emails)
+
+    assert imap_setting.sync_interval == expected
+    assert imap_setting.next_sync_at - before >= timedelta(seconds=expected)
+
+
+def test_schedule_due_syncs_enqueues_each_due_account_once(db, user):
+    due = _account(db, user, "imap.example.com", auto_sync=True, next_sync_at=datetime.now() - timedelta(minutes=1))
+    never_synced = _account(db, user, "imap.example.com", auto_sync=True)
+    _account(db, user, "imap.example.com", auto_sync=True, next_sync_at=datetime.now() + timedelta(hours=1))
+    _account(db, user, "imap.example.com", auto_sync=False)
+
+    assert schedule_due_syncs(db) == 2
+    # บัญชีที่มีงานค้างอยู่แล้วไม่ถูกเพิ่มงานซ้ำ
+    assert schedule_due_syncs(db) == 0
+
+    jobs = db.query(SyncJob).order_by(SyncJob.id).all()
+    assert [job.imap_setting_id for job in jobs] == [never_synced.id, due.id]
+    assert all(job.priority == SCHEDULED_PRIORITY for job in jobs)
+    assert all(job.max_emails == settings.SYNC_SCHEDULE_MAX_EMAILS for job in jobs)
@@ -0,0 +1,256 @@
+﻿import shutil
+from datetime import datetime
+
+import pytest
+
+from app.config import settings
+from app.models import ImapFolderState, Receipt
+from app.services.imap_pool import imap_pool
+from app.services.sync_service import SyncPipeline, plan_uid_shards
+
+from .fake_imap import FakeMailbox, make_message
+
+STEAM = "Steam <noreply@steampowered.com>"
+STEAM_SUBJECT = "Thank you for your purchase"
+
+
+@pytest.fixture(autouse=True)
+def clean_sync_state():
+    """ปิดการเชื่อมต่อที่ค้างใน pool และล้างแคชอีเมลหลังแต่ละการทดสอบ
+    (เซิร์ฟเวอร์จำลองเริ่มใหม่ทุกครั้ง และ UID ของอีเมลในแต่ละการทดสอบซ้ำกัน)"""
+    yield
+    imap_pool.close_all()
+    shutil.rmtree(settings.MESSAGE_CACHE_DIR, ignore_errors=True)
+
+
+def _sync(db, imap_setting, full_resync=False):
+    return SyncPipeline(db, imap_setting, days_back=0, limit=0, full_resync=full_resync).run()
+
+
+def test_incremental_sync_resumes_after_last_uid(db, stored_imap_setting, imap_server):
+    mailbox = FakeMailbox([make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")])
+    imap_server.mailboxes["INBOX"] = mailbox
+
+    first = _sync(db, stored_imap_setting)
+    assert (first["found"], first["receipts_created"], first["last_uid"]) == (1, 1, 100)
+    assert (stored_imap_setting.uid_validity, stored_imap_setting.last_uid) == (1000, 100)
+
+    mailbox.add(make_message(STEAM, "Thank you for your purchase #2", "รวมทั้งหมด: ฿99.00", message_id="<s2@steam>"))
+    second = _sync(db, stored_imap_setting)
+
+    # รอบที่สองค้นหาเฉพาะ UID ที่ใหม่กว่าที่บันทึกไว้
+    assert "UID 101:*" in imap_server.commands_named("UID SEARCH")[-1]
+    assert (second["found"], second["receipts_created"], second["last_uid"]) == (1, 1, 101)
+    assert stored_imap_setting.last_uid == 101
+    assert db.query(Receipt).count() == 2
+
+    # ไม่มีอีเมลใหม่ UID ล่าสุดไม่เปลี่ยน
+    third = _sync(db, stored_imap_setting)
+    assert (third["found"], third["receipts_created"]) == (0, 0)
+    assert stored_imap_setting.last_uid == 101
+
+
+def test_full_resync_adopts_legacy_receipt(db, user, stored_imap_setting, imap_server):
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")
+    ])
+    # ใบเสร็จที่บันทึกก่อนมีรหัสใหม่ (ฐานข้อมูลเก็บวันที่โดยไม่มีเขตเวลา)
+    legacy = Receipt(
+        user_id=user.id,
+        email_id="imap_5",
+        email_from=STEAM,
+        email_subject=STEAM_SUBJECT,
+        email_date=datetime(2026, 10, 13, 10, 0),
+        vendor_name="Steam",
+        amount=34.0
+    )
+    db.add(legacy)
+    db.commit()
+
+    result = _sync(db, stored_imap_setting, full_resync=True)
+
+    assert result["receipts_created"] == 0
+    assert result["legacy_adopted"] == 1
+    receipt = db.query(Receipt).one()
+    assert receipt.id == legacy.id
+    assert receipt.email_id.startswith("mid:")
+    assert receipt.message_id == "<s1@steam>"
+    assert (receipt.imap_folder, receipt.imap_uidvalidity, receipt.imap_uid) == (None, 1000, 100)
+    # อีเมลที่ตรงกับใบเสร็จเดิมไม่ต้องดาวน์โหลดเนื้อหา
+    assert len(imap_server.commands_named("UID FETCH")) == 1
+
+    # ซิงค์ซ้ำอีกครั้งยังคงไม่สร้างใบเสร็จซ้ำ
+    assert _sync(db, stored_imap_setting, full_resync=True)["receipts_created"] == 0
+    assert db.query(Receipt).count() == 1
+
+
+def test_legacy_match_requires_same_sender_subject_and_date(db, user, stored_imap_setting, imap_server):
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")
+    ])
+    db.add(Receipt(
+        user_id=user.id,
+        email_id="imap_5",
+        email_from=STEAM,
+        email_subject=STEAM_SUBJECT,
+        email_date=datetime(2026, 10, 12, 10, 0),
+        vendor_name="Steam",
+        amount=34.0
+    ))
+    db.commit()
+
+    result = _sync(db, stored_imap_setting, full_resync=True)
+
+    assert (result["receipts_created"], result["legacy_adopted"]) == (1, 0)
+    assert db.query(Receipt).filter(Receipt.email_id == "imap_5").count() == 1
+
+
+def test_search_reuses_folder_selection(db, stored_imap_setting, imap_server):
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")
+    ])
+
+    result = _sync(db, stored_imap_setting)
+
+    assert result["receipts_created"] == 1
+    # เลือกโฟลเดอร์ครั้งเดียวแล้วค้นหาต่อโดยไม่ SELECT ซ้ำ
+    assert len(imap_server.commands_named("SELECT")) == 1
+
+
+def test_plan_uid_shards_splits_sorted_uids():
+    assert plan_uid_shards([100, 101, 102, 103, 104], 2) == [[100, 101], [102, 103], [104]]
+    assert plan_uid_shards([100, 101], 0) == [[100], [101]]
+    assert plan_uid_shards([], 1000) == []
+
+
+def test_large_folder_is_split_into_uid_shards(monkeypatch, db, stored_imap_setting, imap_server):
+    monkeypatch.setattr(settings, "SYNC_SHARD_SIZE", 2)
+    monkeypatch.setattr(settings, "IMAP_MAX_CONNECTIONS_PER_SYNC", 3)
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message(STEAM, f"{STEAM_SUBJECT} #{number}", f"รวมทั้งหมด: ฿{number}.00", message_id=f"<s{number}@steam>")
+        for number in range(1, 6)
+    ])
+
+    result = _sync(db, stored_imap_setting)
+
+    assert (result["found"], result["receipts_created"], result["last_uid"]) == (5, 5, 104)
+    # 5 UID แบ่งเป็น 3 ช่วง ดึงพร้อมกันด้วยการเชื่อมต่อหลักและการเชื่อมต่อเพิ่มอีก 2 รายการ
+    assert imap_server.connections == 3
+    header_fetches = [command for command in imap_server.commands_named("UID FETCH") if "BODYSTRUCTURE" in command]
+    assert sorted(command.split()[2] for command in header_fetches) == ["100:101", "102:103", "104"]
+
+
+def test_consecutive_syncs_reuse_pooled_connection(db, stored_imap_setting, imap_server):
+    imap_server.mailboxes["INBOX"] = FakeMailbox([
+        make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")
+    ])
+
+    _sync(db, stored_imap_setting)
+    _sync(db, stored_imap_setting)
+    assert imap_server.connections == 1
+    assert len(imap_server.commands_named("LOGIN")) == 1
+
+    # เซิร์ฟเวอร์ตัดการเชื่อมต่อที่ว่างอยู่ รอบถัดไปต้องเชื่อมต่อใหม่แทนการใช้การเชื่อมต่อที่ตายแล้ว
+    imap_server.drop_connections()
+    result = _sync(db, stored_imap_setting)
+    assert result["found"] == 0
+    assert imap_server.connections == 2
+
+
+def test_message_in_several_folders_is_imported_once(monkeypatch, db, stored_imap_setting, imap_server):
+    # ดึงทีละโฟลเดอร์ตามลำดับ เพื่อให้โฟลเดอร์หลักเป็นฝ่ายได้ดึงอีเมลที่ซ้ำ
+    monkeypatch.setattr(settings, "IMAP_MAX_CONNECTIONS_PER_SYNC", 1)
+    receipt = make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>")
+    imap_server.mailboxes["INBOX"] = FakeMailbox([receipt])
+    imap_server.mailboxes["Archive"] = FakeMailbox([
+        receipt,
+        make_message(STEAM, "Thank you for your purchase #2", "รวมทั้งหมด: ฿99.00", message_id="<s2@steam>")
+    ], uid_validity=2000, start_uid=500)
+    db.add(ImapFolderState(imap_setting_id=stored_imap_setting.id, folder="Archive"))
+    db.commit()
+    db.refresh(stored_imap_setting)
+
+    result = _sync(db, stored_imap_setting)
+
+    assert result["folders"] == {
+        "INBOX": {"found": 1, "last_uid": 100},
+        "Archive": {"found": 2, "last_uid": 501}
+    }
+    assert result["receipts_created"] == 2
+    assert db.query(Receipt).filter(Receipt.message_id == "<s1@steam>").count() == 1
+    # อีเมลที่ซ้ำถูกดึงเนื้อหาเพียงครั้งเดียว ส่วน UID ของทั้งสองโฟลเดอร์ถือว่าทำเสร็จแล้ว
+    text_fetches = [command for command in imap_server.commands_named("UID FETCH") if "BODYSTRUCTURE" not in command]
+    assert [command.split()[2] for command in text_fetches] == ["100", "501"]
+    archive = stored_imap_setting.folder_states[0]
+    assert (archive.uid_validity, archive.last_uid) == (2000, 501)
+
+
+def _receipt_mailbox(**options) -> FakeMailbox:
+    return FakeMailbox([
+        make_message(STEAM, STEAM_SUBJECT, "รวมทั้งหมด: ฿34.00", message_id="<s1@steam>"),
+        make_message(STEAM, "Thank you for your purchase #2", "รวมทั้งหมด: ฿99.00", message_id="<s2@steam>")
+    ], **options)
+
+
+def test_qresync_vanished_marks_source_deleted(db, stored_imap_setting, imap_server):
+    imap_server.capabilities += ["ENABLE", "CONDSTORE", "QRESYNC"]
+    mailbox = imap_server.mailboxes["INBOX"] = _receipt_mailbox()
+    _sync(db, stored_imap_setting)
+    assert stored_imap_setting.highest_modseq == mailbox.highest_modseq
+
+    mailbox.expunge(100)
+    result = _sync(db, stored_imap_setting)
+
+    # รายการ UID ที่ถูกลบมาพร้อม SELECT โดยไม่ต้องค้นหาเพิ่ม
+    select = imap_server.commands_named("SELECT")[-1]
+    assert f"(QRESYNC (1000 {mailbox.highest_modseq - 1} 100:101))" in select
+    assert result["source_deleted"] == 1
+    deleted = {receipt.imap_uid: receipt.source_deleted for receipt in db.query(Receipt)}
+    assert deleted == {100: True, 101: False}
+    assert stored_imap_setting.highest_modseq == mailbox.highest_modseq
+
+    # ใบเสร็จที่ทำเครื่องหมายแล้วไม่ถูกส่งไปตรวจซ้ำ
+    _sync(db, stored_imap_setting)
+    assert "(QRESYNC (1000 " in imap_server.commands_named("SELECT")[-1]
+    assert imap_server.commands_named("SELECT")[-1].endswith(" 101))")
+
+
+def test_condstore_without_qresync_searches_known_uids(db, stored_imap_setting, imap_server):
+    imap_server.capabilities.append("CONDSTORE")
+    mailbox = imap_server.mailboxes["INBOX"] = _receipt_mailbox()
+    _sync(db, stored_imap_setting)
+
+    # HIGHESTMODSEQ ไม่เปลี่ยน จึงไม่ต้องตรวจ UID เดิม
+    searches = len(imap_server.commands_named("UID SEARCH"))
+    assert _sync(db, stored_imap_setting)["source_deleted"] == 0
+    assert len(imap_server.commands_named("UID SEARCH")) == searches + 1
+
+    mailbox.expunge(101)
+    result = _sync(db, stored_imap_setting)
+
+    assert "UID 100:101" in imap_server.commands_named("UID SEARCH")[-2]
+    assert result["source_deleted"] == 1
+    assert db.query(Receipt).filter(Receipt.source_deleted.is_(True)).one().imap_uid == 101
+
+
+def test_uidvalidity_change_resets_folder_state(db, stored_imap_setting, imap_server):
+    imap_server.capabilities += ["ENABLE", "CONDSTORE", "QRESYNC"]
+    imap_server.mailboxes["INBOX"] = _receipt_mailbox()
+    _sync(db, stored_imap_setting)
+    assert (stored_imap_setting.uid_validity, stored_imap_setting.last_uid) == (1000, 101)
+
+    # โฟลเดอร์ถูกสร้างใหม่: UID เดิมใช้ไม่ได้ และ UID ใหม่ต่ำกว่า last_uid ที่บันทึกไว้
+    mailbox = _receipt_mailbox(uid_validity=2000, start_uid=10)
+    mailbox.add(make_message(STEAM, "Thank you for your purchase #3", "รวมทั้งหมด: ฿10.00", message_id="<s3@steam>"))
+    imap_server.mailboxes["INBOX"] = mailbox
+
+    result = _sync(db, stored_imap_setting)
+
+    # ค้นหาใหม่ทั้งโฟลเดอร์ ไม่ใช่ตั้งแต่ UID 102
+    assert "UID 102:*" not in imap_server.commands_named("UID SEARCH")[-1]
+    assert result["found"] == 3
+    assert result["source_deleted"] == 0
+    # อีเมลเดิมถูกตรวจซ้ำด้วยรหัสใบเสร็จ จึงสร้างเฉพาะใบเสร็จใหม่
+    assert result["receipts_created"] == 1
+    assert (stored_imap_setting.uid_validity, stored_imap_setting.last_uid) == (2000, 12)
+    assert db.query(Receipt).count() == 3
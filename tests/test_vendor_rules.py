@@ -0,0 +1,174 @@
+﻿import json
+import os
+
+import pytest
+
+from app.services.receipt_extractor import ReceiptExtractor
+from app.services.vendor_rules import (
+    VendorRegistry,
+    VendorRule,
+    VendorTemplateStore,
+    load_vendor_templates,
+    sender_domain
+)
+
+
+def _rule(name, domains, sender_keywords=()) -> VendorRule:
+    return VendorRule(name, domains, lambda email_data, result: result, sender_keywords)
+
+
+@pytest.fixture
+def registry():
+    registry = VendorRegistry()
+    registry.register(_rule("Apple", ["apple.com"]))
+    registry.register(_rule("Apple Support", ["support.apple.com"]))
+    registry.register(_rule("Steam", ["steampowered.com"]))
+    return registry
+
+
+@pytest.mark.parametrize("from_header, domain", [
+    ("Steam <noreply@SteamPowered.com>", "steampowered.com"),
+    ("no_reply@email.apple.com", "email.apple.com"),
+    ('"apple.com" <billing@evil.example>', "evil.example"),
+    ("", ""),
+])
+def test_sender_domain(from_header, domain):
+    assert sender_domain(from_header) == domain
+
+
+@pytest.mark.parametrize("from_header, vendor", [
+    ("Apple <no_reply@apple.com>", "Apple"),
+    # โดเมนย่อยใช้กฎของโดเมนหลัก เว้นแต่มีกฎของโดเมนย่อยนั้นเอง
+    ("Apple <no_reply@email.apple.com>", "Apple"),
+    ("Apple <help@support.apple.com>", "Apple Support"),
+    ("Apple <help@mail.support.apple.com>", "Apple Support"),
+    ("STEAM <NOREPLY@STEAMPOWERED.COM>", "Steam"),
+])
+def test_registry_matches_domain_and_parent_domains(registry, from_header, vendor):
+    assert registry.match(from_header).name == vendor
+
+
+@pytest.mark.parametrize("from_header", [
+    # ต้องตรงทั้งส่วนของโดเมน ไม่ใช่แค่ลงท้ายด้วยข้อความเดียวกัน
+    "Shop <billing@notapple.com>",
+    # ชื่อผู้ส่งที่ดูเหมือนโดเมนไม่นับ ใช้เฉพาะที่อยู่อีเมล
+    '"apple.com" <billing@evil.example>',
+    "Friend <friend@mail.example>",
+    "",
+])
+def test_registry_rejects_other_senders(registry, from_header):
+    assert registry.match(from_header) is None
+
+
+def test_registry_rejects_duplicate_domain(registry):
+    with pytest.raises(ValueError):
+        registry.register(_rule("Other", ["Apple.com"]))
+
+
+def test_registry_falls_back_to_sender_keywords(registry):
+    kplus = registry.register(_rule("K Plus", ["kasikornbank.com"], sender_keywords=["KPlus"]))
+
+    assert registry.match("KPLUS <noreply@kbank.example>") is kplus
+    assert registry.match("alerts@kplus.example") is kplus
+    # กฎจากโดเมนมาก่อนคำในชื่อผู้ส่ง
+    assert registry.match("KPlus via Apple <no_reply@apple.com>").name == "Apple"
+
+
+def test_bundled_kplus_template_matches_kplus_sender():
+    email_data = {
+        "message_id": 1,
+        "from": "KPLUS <noreply@kplus.example>",
+        "subject": "ผลการทำรายการ",
+        "date": None,
+        "body": "วันที่ทำรายการ: 01/10/2026\nจำนวนเงิน (บาท): 1,250.00",
+        "attachments": []
+    }
+
+    result = ReceiptExtractor.extract_receipt_info(email_data)
+
+    assert (result["vendor_name"], result["amount"]) == ("K Plus (Kasikorn Bank)", 1250.0)
+
+
+def _write_template(directory, filename, template):
+    path = os.path.join(directory, filename)
+    with open(path, "w", encoding="utf-8") as template_file:
+        if isinstance(template, str):
+            template_file.write(template)
+        else:
+            json.dump(template, template_file)
+    return path
+
+
+SHOP = {"name": "Shop", "domains": ["shop.example"], "amount_patterns": ["Total: ([\\d.]+)"]}
+
+
+def test_bundled_templates_are_valid():
+    templates = load_vendor_templates(os.path.join(os.path.dirname(__file__), "..", "app", "vendor_templates"))
+
+    assert {template.name for template in templates} >= {"Apple", "Steam", "K Plus (Kasikorn Bank)"}
+
+
+def test_template_store_reloads_changed_files(tmp_path):
+    path = _write_template(tmp_path, "shop.json", SHOP)
+    store = VendorTemplateStore(str(tmp_path), reload_interval=0)
+    first = store.catalog()
+    assert first.registry.match("orders@shop.example").name == "Shop"
+
+    # ไม่มีไฟล์เปลี่ยน ใช้ชุดเดิม
+    assert store.catalog() is first
+
+    _write_template(tmp_path, "shop.json", {**SHOP, "name": "Shop v2"})
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+    _write_template(tmp_path, "other.json", {"name": "Other", "domains": ["other.example"]})
+
+    reloaded = store.catalog()
+    assert reloaded is not first
+    assert reloaded.registry.match("orders@shop.example").name == "Shop v2"
+    assert reloaded.registry.match("billing@other.example").name == "Other"
+
+
+def test_template_store_checks_files_at_most_every_interval(tmp_path):
+    _write_template(tmp_path, "shop.json", SHOP)
+    store = VendorTemplateStore(str(tmp_path), reload_interval=3600)
+    first = store.catalog()
+
+    _write_template(tmp_path, "other.json", {"name": "Other", "domains": ["other.example"]})
+
+    assert store.catalog() is first
+
+
+@pytest.mark.parametrize("content", [
+    "{not json",
+    {"name": "Shop", "domains": ["shop.example"], "unknown": True},
+    # regex ต้องมีกลุ่มสำหรับค่าที่ต้องการ
+    {"name": "Shop", "domains": ["shop.example"], "amount_patterns": ["Total: \\d+"]},
+    {"name": "Shop", "search": [{}]},
+    {"name": "Shop", "date_patterns": [{"pattern": "(\\d+", "formats": ["%d"]}]},
+])
+def test_invalid_template_fails_first_load(tmp_path, content):
+    _write_template(tmp_path, "shop.json", content)
+    store = VendorTemplateStore(str(tmp_path), reload_interval=0)
+
+    with pytest.raises(ValueError, match="shop.json"):
+        store.catalog()
+
+
+def test_invalid_template_keeps_previous_catalog(tmp_path):
+    _write_template(tmp_path, "shop.json", SHOP)
+    store = VendorTemplateStore(str(tmp_path), reload_interval=0)
+    first = store.catalog()
+
+    _write_template(tmp_path, "broken.json", "{not json")
+    assert store.catalog() is first
+
+    # แก้ไฟล์ให้ถูกต้องแล้วโหลดใหม่ได้
+    _write_template(tmp_path, "broken.json", {"name": "Fixed", "domains": ["fixed.example"]})
+    assert store.catalog().registry.match("a@fixed.example").name == "Fixed"
+
+
+def test_duplicate_domain_across_templates_is_rejected(tmp_path):
+    _write_template(tmp_path, "a.json", SHOP)
+    _write_template(tmp_path, "b.json", {"name": "Copy", "domains": ["SHOP.example"]})
+
+    with pytest.raises(ValueError, match="shop.example"):
+        VendorTemplateStore(str(tmp_path), reload_interval=0).catalog()